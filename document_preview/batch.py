@@ -0,0 +1,435 @@
+"""Batch previews of files outside of Assemblyline, ie. to backfill results after retuning OCR terms or heuristics.
+
+Each worker process runs its own instance of the service (with its own browsers and DocBuilder worker) over the
+files it's given. Results are written as JSON lines as soon as each file is done, along with the preview images, so
+that an interrupted run picks up where it left off when it's restarted with the same output directory:
+
+    python -m document_preview.batch samples/ --output backfill/ --workers 4
+    python -m document_preview.batch --manifest files.txt --output backfill/ -s run_ocr_on_first_n_pages=5
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
+from time import perf_counter
+
+SERVICE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+os.environ.setdefault("SERVICE_MANIFEST_PATH", os.path.join(SERVICE_FOLDER, "service_manifest.yml"))
+
+RESULTS_FILE = "results.jsonl"
+PREVIEWS_FOLDER = "previews"
+
+# Statuses of files that don't need to be processed again when resuming
+DONE_STATUSES = {"completed", "failed", "rejected"}
+
+# Number of times a file can be in flight when a worker process dies before it's recorded as failed
+MAX_CRASHES = 2
+
+# The service instance of the worker process
+_worker = None
+
+
+class BatchWorker:
+    """A service instance that processes files one at a time, as the service would inside of Assemblyline."""
+
+    def __init__(self, output_directory: str, submission_params: dict, deep_scan: bool = False) -> None:
+        """Start the service.
+
+        Args:
+            output_directory (str): The directory to copy the previews to.
+            submission_params (dict): The submission parameters to analyze files with.
+            deep_scan (bool, optional): Analyze files as a deep scan. Defaults to False.
+
+        """
+        # Files, results and working directories of the service are kept apart from those of other workers
+        self.tasking_directory = tempfile.mkdtemp(prefix="document_preview_batch_")
+        os.environ["TASKING_DIR"] = self.tasking_directory
+
+        from assemblyline.common import forge
+
+        from document_preview.document_preview import DocumentPreview
+
+        self.output_directory = output_directory
+        self.submission_params = submission_params
+        self.deep_scan = deep_scan
+        self.identify = forge.get_identify(use_cache=False)
+        self.classification = forge.get_classification().UNRESTRICTED
+        self.service = DocumentPreview()
+        self.service.start_service()
+
+    def stop(self) -> None:
+        """Stop the service and clean up."""
+        self.service.stop_service()
+        self.identify.stop()
+        shutil.rmtree(self.tasking_directory, ignore_errors=True)
+
+    def _accepts(self, file_type: str) -> bool:
+        """Check whether the service would be sent a file type.
+
+        Args:
+            file_type (str): The Assemblyline file type.
+
+        Returns:
+            bool: Whether the service accepts the file type.
+
+        """
+        attributes = self.service.service_attributes
+        return bool(re.match(attributes.accepts, file_type)) and not re.match(attributes.rejects, file_type)
+
+    def process(self, path: str) -> dict:
+        """Analyze a file.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            dict: What was found, or why the analysis failed.
+
+        """
+        from assemblyline.common.uid import get_random_id
+        from assemblyline.odm.messages.task import Task as ServiceTask
+
+        start = perf_counter()
+        record = {"path": path}
+        try:
+            file_info = self.identify.fileinfo(path, skip_fuzzy_hashes=True, calculate_entropy=False)
+            for key in ["ascii", "hex", "entropy"]:
+                file_info.pop(key, None)
+            sha256 = file_info["sha256"]
+            record.update(sha256=sha256, file_type=file_info["type"])
+            if not self._accepts(file_info["type"]):
+                record["status"] = "rejected"
+                return record
+
+            # The service expects the file to be named after its hash in the tasking directory
+            shutil.copyfile(path, os.path.join(self.tasking_directory, sha256))
+            task = ServiceTask(
+                {
+                    "sid": get_random_id(),
+                    "metadata": {},
+                    "service_name": self.service.service_attributes.name,
+                    "service_config": self.submission_params,
+                    "fileinfo": file_info,
+                    "filename": os.path.basename(path),
+                    "min_classification": self.classification,
+                    "max_files": 501,
+                    "ttl": 0,
+                    "deep_scan": self.deep_scan,
+                }
+            )
+            self.service.handle_task(task)
+            record.update(self._collect(task.sid, sha256))
+        except Exception as e:  # noqa: BLE001
+            record.update(status="failed", error=str(e))
+        finally:
+            self._clean_up()
+            record["runtime_s"] = round(perf_counter() - start, 3)
+        return record
+
+    def _collect(self, sid: str, sha256: str) -> dict:
+        """Collect the result (or error) of an analysis, copying out its previews.
+
+        Args:
+            sid (str): The ID of the analysis.
+            sha256 (str): The SHA256 of the file.
+
+        Returns:
+            dict: The status of the analysis, along with its result or error.
+
+        """
+        error_path = os.path.join(self.tasking_directory, f"{sid}_{sha256}_error.json")
+        if os.path.exists(error_path):
+            with open(error_path) as fh:
+                response = json.load(fh)["response"]
+            # Recoverable errors are retried when resuming
+            status = "failed" if response["status"] == "FAIL_NONRECOVERABLE" else "recoverable"
+            return {"status": status, "error": response["message"]}
+
+        with open(os.path.join(self.tasking_directory, f"{sid}_{sha256}_result.json")) as fh:
+            result = json.load(fh)
+
+        previews = []
+        preview_directory = os.path.join(self.output_directory, PREVIEWS_FOLDER, sha256)
+        for supplementary in result["response"]["supplementary"]:
+            # Pages of the gallery are the supplementary files named after them (skipping their thumbnails)
+            if supplementary["name"].startswith("page_") and supplementary["name"].endswith(".png"):
+                os.makedirs(preview_directory, exist_ok=True)
+                shutil.copyfile(supplementary["path"], os.path.join(preview_directory, supplementary["name"]))
+                previews.append(os.path.join(PREVIEWS_FOLDER, sha256, supplementary["name"]))
+
+        return {
+            "status": "completed",
+            "result": result["result"],
+            "extracted": [extracted["name"] for extracted in result["response"]["extracted"]],
+            "previews": previews,
+            "passwords": result["temp_submission_data"].get("passwords", []),
+        }
+
+    def _clean_up(self) -> None:
+        """Remove everything the analysis left in the tasking directory."""
+        for name in os.listdir(self.tasking_directory):
+            path = os.path.join(self.tasking_directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def _init_worker(output_directory: str, submission_params: dict, deep_scan: bool, log_level: int) -> None:
+    global _worker
+    logging.getLogger("assemblyline").setLevel(log_level)
+    _worker = BatchWorker(output_directory, submission_params, deep_scan)
+    # Worker processes exit without running atexit handlers
+    Finalize(_worker, _worker.stop, exitpriority=10)
+
+
+def _process(path: str) -> dict:
+    return _worker.process(path)
+
+
+def submission_params(overrides: list[str]) -> dict:
+    """Get the submission parameters, starting from the defaults in the service manifest.
+
+    Args:
+        overrides (list[str]): Parameters to override, as "name=value".
+
+    Returns:
+        dict: The value of each submission parameter.
+
+    Raises:
+        ValueError: If an override isn't for a known parameter.
+
+    """
+    from assemblyline_v4_service.common.helper import get_service_manifest
+
+    declared = {param["name"]: param for param in get_service_manifest().get("submission_params", [])}
+    params = {name: param["default"] for name, param in declared.items()}
+    for override in overrides:
+        name, _, value = override.partition("=")
+        if name not in declared:
+            raise ValueError(f"Unknown submission parameter: {name}")
+        if declared[name]["type"] == "int":
+            params[name] = int(value)
+        elif declared[name]["type"] == "bool":
+            params[name] = value.lower() in ("true", "yes", "1")
+        else:
+            params[name] = value
+    return params
+
+
+def find_files(inputs: list[str], manifest: str | None = None) -> Iterator[str]:
+    """List the files to process.
+
+    Args:
+        inputs (list[str]): Files, and directories to search recursively.
+        manifest (str, optional): A file listing the paths of files to process, one per line. Defaults to None.
+
+    Yields:
+        str: The path of each file, in a stable order.
+
+    """
+    if manifest:
+        with open(manifest) as fh:
+            yield from (line.strip() for line in fh if line.strip())
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                yield from (os.path.join(root, name) for name in sorted(files))
+        else:
+            yield path
+
+
+def completed_paths(results_path: str) -> set[str]:
+    """Get the files that were already processed by a previous run.
+
+    Args:
+        results_path (str): The path to the results of the previous run.
+
+    Returns:
+        set[str]: The paths of files that don't need to be processed again.
+
+    """
+    if not os.path.exists(results_path):
+        return set()
+
+    done = set()
+    with open(results_path) as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written when the previous run was killed
+                continue
+            if record.get("status") in DONE_STATUSES:
+                done.add(record["path"])
+    return done
+
+
+def summarize(records: list[dict], elapsed: float, workers: int) -> str:
+    """Summarize the throughput of a run, by file type.
+
+    Args:
+        records (list[dict]): The results of the files processed.
+        elapsed (float): The time taken by the run, in seconds.
+        workers (int): The number of worker processes.
+
+    Returns:
+        str: The summary, as a table.
+
+    """
+    by_type: dict[str, list[dict]] = {}
+    for record in records:
+        by_type.setdefault(record.get("file_type", "unknown"), []).append(record)
+
+    lines = [f"{'file type':<32} {'files':>7} {'failed':>7} {'mean s':>8} {'files/s':>8}"]
+    for file_type, type_records in sorted(by_type.items()):
+        runtime = sum(record["runtime_s"] for record in type_records)
+        failed = sum(record["status"] in ("failed", "recoverable") for record in type_records)
+        # With every worker busy, each one gets through files of this type at this rate
+        lines.append(
+            f"{file_type:<32} {len(type_records):>7} {failed:>7} {runtime / len(type_records):>8.2f} "
+            f"{workers * len(type_records) / runtime if runtime else 0:>8.2f}"
+        )
+    lines.append(
+        f"{'total':<32} {len(records):>7} "
+        f"{sum(record['status'] in ('failed', 'recoverable') for record in records):>7} {'':>8} "
+        f"{len(records) / elapsed if elapsed else 0:>8.2f}"
+    )
+    return "\n".join(lines)
+
+
+def run_pool(
+    executor: ProcessPoolExecutor, queue: deque[str], workers: int, write: Callable[[dict], None]
+) -> list[str]:
+    """Process files with a pool of worker processes, until there are none left or a worker process dies.
+
+    Files are handed out as workers free up rather than all at once, so that a worker dying (ie. killed for running out
+    of memory) only takes down the files that were being processed.
+
+    Args:
+        executor (ProcessPoolExecutor): The pool.
+        queue (deque[str]): The paths of the files left to process, taken from as they're handed out.
+        workers (int): The number of worker processes.
+        write (Callable[[dict], None]): Called with the result of each file as soon as it's done.
+
+    Returns:
+        list[str]: The paths of the files that were being processed when the pool broke, empty if it didn't.
+
+    Raises:
+        KeyboardInterrupt: If the run is interrupted, once the files that haven't started are cancelled.
+
+    """
+    futures: dict[Future, str] = {}
+    broken = []
+    pool_broken = False
+    try:
+        while futures or (queue and not pool_broken):
+            while queue and not pool_broken and len(futures) < workers:
+                path = queue.popleft()
+                try:
+                    futures[executor.submit(_process, path)] = path
+                except BrokenProcessPool:
+                    # A worker died since the last file was done, which the files in flight are about to report
+                    queue.appendleft(path)
+                    pool_broken = True
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                try:
+                    write(future.result())
+                except BrokenProcessPool:
+                    broken.append(path)
+                    pool_broken = True
+    except KeyboardInterrupt:
+        # What's been written so far is kept, the rest is picked up when resuming
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    return broken
+
+
+def main() -> int:
+    """Run the batch.
+
+    Returns:
+        int: The exit code, non-zero if any file failed.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="*", help="Files, or directories to search recursively")
+    parser.add_argument("-m", "--manifest", help="File listing the paths of files to process, one per line")
+    parser.add_argument("-o", "--output", required=True, help="Directory to write the results and previews to")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument(
+        "-s", "--submission", action="append", default=[], help="Set a submission parameter, as name=value"
+    )
+    parser.add_argument("--deep-scan", action="store_true", help="Analyze files as a deep scan")
+    parser.add_argument("--restart", action="store_true", help="Process every file, ignoring previous results")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the logs of the service")
+    args = parser.parse_args()
+    if not args.inputs and not args.manifest:
+        parser.error("no files to process, give inputs or a manifest")
+    try:
+        params = submission_params(args.submission)
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output, exist_ok=True)
+    results_path = os.path.join(args.output, RESULTS_FILE)
+    if args.restart and os.path.exists(results_path):
+        os.remove(results_path)
+    done = completed_paths(results_path)
+    paths = [path for path in find_files(args.inputs, args.manifest) if path not in done]
+    print(f"{len(paths)} file(s) to process, {len(done)} already done")
+
+    records = []
+    start = perf_counter()
+    workers = max(min(args.workers, len(paths)), 1)
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    queue = deque(paths)
+    crashes: dict[str, int] = {}
+    with open(results_path, "a") as results:
+
+        def write(record: dict) -> None:
+            records.append(record)
+            results.write(json.dumps(record) + "\n")
+            results.flush()
+            print(f"[{len(records)}/{len(paths)}] {record['status']:<11} {record['path']}")
+
+        while queue:
+            # Spawned rather than forked, the service's browsers and pools don't survive a fork
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(os.path.abspath(args.output), params, args.deep_scan, log_level),
+            ) as executor:
+                broken = run_pool(executor, queue, workers, write)
+
+            # Files that were being processed when a worker died go back in the queue of the recreated pool
+            for path in reversed(broken):
+                crashes[path] = crashes.get(path, 0) + 1
+                if crashes[path] < MAX_CRASHES:
+                    # May have been taken down by another file being processed at the same time, try it again
+                    queue.appendleft(path)
+                else:
+                    write({"path": path, "status": "failed", "error": "Worker process died", "runtime_s": 0})
+
+    if records:
+        print(summarize(records, perf_counter() - start, workers))
+    return 1 if any(record["status"] in ("failed", "recoverable") for record in records) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
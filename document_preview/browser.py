@@ -0,0 +1,267 @@
+"""Browser session management for rendering HTML content."""
+
+import logging
+import os
+import threading
+from collections.abc import Callable, Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic
+from typing import Any
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver import Chrome, ChromeOptions, ChromeService
+
+CHROMEDRIVER_PATH = "/usr/bin/chromedriver"
+
+
+class BrowserSession:
+    """A browser instance along with the home tab that's kept clean between renders."""
+
+    def __init__(self, options: ChromeOptions, command_timeout: float = 5) -> None:
+        """Launch the browser.
+
+        Args:
+            options (ChromeOptions): The options to launch the browser with.
+            command_timeout (float, optional): Seconds the browser has to answer a health check, reset or shutdown
+                before it's considered hung, 0 to wait on it indefinitely. Defaults to 5.
+
+        """
+        service = None
+        if os.path.exists(CHROMEDRIVER_PATH):
+            service = ChromeService(executable_path=CHROMEDRIVER_PATH)
+        self.driver = Chrome(options=options, service=service)
+
+        # Run browser in offline mode only
+        self.driver.set_network_conditions(offline=True, latency=5, throughput=500 * 1024)
+        self.driver.set_window_size(1080, 1920)
+        self.home = self.driver.current_window_handle
+        self.uses = 0
+        self.last_used = monotonic()
+        self.command_timeout = command_timeout
+        # Housekeeping commands are sent from a thread of their own, so that a hung browser can be given up on
+        self._commands = ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser-command")
+
+    def _bounded(self, command: Callable[[], Any]) -> Any:
+        """Send a command to the browser, giving up on it after the command timeout.
+
+        Args:
+            command (Callable[[], Any]): The command.
+
+        Returns:
+            Any: What the command returned.
+
+        Raises:
+            WebDriverException: If the browser didn't answer in time.
+
+        """
+        future = self._commands.submit(command)
+        try:
+            return future.result(timeout=self.command_timeout or None)
+        except TimeoutError:
+            raise WebDriverException(f"Browser didn't answer within {self.command_timeout}s") from None
+
+    def healthy(self) -> bool:
+        """Check that the browser is still responding.
+
+        Returns:
+            bool: Whether the browser can be used, False if it crashed or hung.
+
+        """
+        try:
+            return self.home in self._bounded(lambda: self.driver.window_handles)
+        except Exception:  # noqa: BLE001
+            # Crashed browsers raise WebDriverException, as do hung ones once they're given up on
+            return False
+
+    def reset(self) -> None:
+        """Close all windows opened during a render, leaving only the home tab.
+
+        Raises:
+            WebDriverException: If the browser can't be reset and shouldn't be reused.
+
+        """
+        handles = self._bounded(lambda: self.driver.window_handles)
+        if self.home not in handles:
+            raise WebDriverException("Home tab of the browser session was closed")
+        self._bounded(lambda: self._close_windows(handles))
+
+    def _close_windows(self, handles: list[str]) -> None:
+        """Close the windows opened during a render.
+
+        Args:
+            handles (list[str]): The handles of the open windows.
+
+        """
+        for handle in handles:
+            # In the event we load JS that spawns a bunch of windows, let's clean them up
+            if handle != self.home:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+        self.driver.switch_to.window(self.home)
+
+    def quit(self) -> None:
+        """Shut down the browser."""
+        try:
+            self._bounded(self.driver.quit)
+        except Exception:  # noqa: BLE001
+            # Browser is already gone or isn't responding, make sure chromedriver (and the browser with it) goes away
+            process = getattr(self.driver.service, "process", None)
+            if process:
+                process.kill()
+        finally:
+            # Any command still waiting on the browser fails once it's gone
+            self._commands.shutdown(wait=False, cancel_futures=True)
+
+
+class BrowserPool:
+    """A pool of browser sessions that are only launched once they're needed.
+
+    Sessions are health-checked before each use (and relaunched if they crashed or hung), reset when returned,
+    recycled after repeated use and shut down once they've sat idle for a while.
+    """
+
+    def __init__(
+        self,
+        options: ChromeOptions,
+        size: int = 1,
+        max_uses: int = 50,
+        idle_timeout: float = 300,
+        command_timeout: float = 5,
+        log: logging.Logger | None = None,
+    ) -> None:
+        """Initialize the pool, without launching any browser sessions.
+
+        Args:
+            options (ChromeOptions): The options to launch browsers with.
+            size (int, optional): The maximum number of browser sessions in use at once. Defaults to 1.
+            max_uses (int, optional): The number of renders after which a browser session is relaunched to contain
+                anything that leaked from hostile pages, 0 to never relaunch. Defaults to 50.
+            idle_timeout (float, optional): Seconds after which an unused browser session is shut down, 0 to keep
+                sessions until the pool is closed. Defaults to 300.
+            command_timeout (float, optional): Seconds a browser has to answer a health check, reset or shutdown
+                before it's considered hung and relaunched, 0 to wait on it indefinitely. Defaults to 5.
+            log (logging.Logger, optional): The logger to use. Defaults to None.
+
+        """
+        self.options = options
+        self.size = max(size, 1)
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+        self.log = log or logging.getLogger(__name__)
+        # Idle sessions, the most recently used last
+        self._idle: list[BrowserSession] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._closed = threading.Event()
+        self._reaper = None
+
+    def _launch(self) -> BrowserSession:
+        """Launch a browser session, and start watching for idle sessions if needed.
+
+        Returns:
+            BrowserSession: The new session.
+
+        """
+        start = monotonic()
+        session = BrowserSession(self.options, self.command_timeout)
+        self.log.debug(f"Launched a browser in {monotonic() - start:.2f}s")
+        with self._lock:
+            if self.idle_timeout and self._reaper is None:
+                self._closed.clear()
+                self._reaper = threading.Thread(target=self._reap_idle, name="browser-reaper", daemon=True)
+                self._reaper.start()
+        return session
+
+    def _reap_idle(self) -> None:
+        """Shut down sessions that have been idle for longer than the idle timeout, until the pool is closed."""
+        while not self._closed.wait(min(self.idle_timeout, 30)):
+            cutoff = monotonic() - self.idle_timeout
+            with self._lock:
+                expired = [session for session in self._idle if session.last_used < cutoff]
+                self._idle = [session for session in self._idle if session.last_used >= cutoff]
+            for session in expired:
+                self.log.debug("Shutting down a browser that's been idle")
+                session.quit()
+
+    def warm_up(self) -> threading.Thread:
+        """Launch a browser session in the background, so that the first render doesn't wait on it.
+
+        Returns:
+            threading.Thread: The thread launching the session.
+
+        """
+
+        def launch() -> None:
+            if not self._slots.acquire(blocking=False):
+                # Every session is already in use
+                return
+            try:
+                session = self._launch()
+                with self._lock:
+                    self._idle.append(session)
+            except WebDriverException as e:
+                self.log.warning(f"Unable to launch a browser ahead of time: {e}")
+            finally:
+                self._slots.release()
+
+        thread = threading.Thread(target=launch, name="browser-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def _acquire(self) -> BrowserSession:
+        """Take a working session from the idle ones, or launch a new one.
+
+        Returns:
+            BrowserSession: The session.
+
+        """
+        while True:
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+            if session is None:
+                return self._launch()
+            if session.healthy():
+                return session
+            # The browser crashed or hung since it was last used, replace it
+            self.log.warning("Browser stopped responding, relaunching it")
+            session.quit()
+
+    @contextmanager
+    def session(self) -> Generator[Chrome, None, None]:
+        """Borrow a browser session from the pool, waiting for one to be returned if they're all in use.
+
+        Yields:
+            Chrome: The browser to render with.
+
+        """
+        with self._slots:
+            session = self._acquire()
+            try:
+                yield session.driver
+            finally:
+                session.uses += 1
+                session.last_used = monotonic()
+                try:
+                    session.reset()
+                except Exception:  # noqa: BLE001
+                    # Browser is in a bad state, retire it
+                    session.quit()
+                else:
+                    if self.max_uses and session.uses >= self.max_uses:
+                        session.quit()
+                    else:
+                        with self._lock:
+                            self._idle.append(session)
+
+    def close(self) -> None:
+        """Shut down all idle browser sessions."""
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+            reaper, self._reaper = self._reaper, None
+        for session in idle:
+            session.quit()
+        if reaper:
+            reaper.join()
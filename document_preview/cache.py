@@ -0,0 +1,182 @@
+"""Content-addressed, on-disk cache of converted documents and rendered pages.
+
+Entries are written to a staging directory and renamed into place so that several service instances can share
+the same cache volume without ever seeing a partially-written entry.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from hashlib import sha256
+from time import time
+
+# Bump this whenever a change to conversion or rendering invalidates what's been cached
+CACHE_VERSION = 3
+
+MANIFEST = "manifest.json"
+
+# Age after which an abandoned staging directory is removed
+STALE_SECONDS = 3600
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hard-link a file if possible, otherwise copy it.
+
+    Args:
+        src (str): The source file.
+        dst (str): The destination path.
+
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class RenderCache:
+    """Cache of converted PDFs and rendered pages, bounded in size with least-recently-used eviction."""
+
+    def __init__(self, directory: str, max_size_mb: int = 512, log: logging.Logger | None = None) -> None:
+        """Initialize the cache.
+
+        Args:
+            directory (str): The directory to keep cache entries in.
+            max_size_mb (int, optional): The total size of entries to keep, in MB. Defaults to 512.
+            log (logging.Logger, optional): The logger to use. Defaults to None.
+
+        """
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.log = log or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*params: object) -> str:
+        """Compute the cache key for the given render parameters.
+
+        Args:
+            *params (object): The values that determine the render output (file hash, file type, etc.).
+
+        Returns:
+            str: The cache key.
+
+        """
+        return sha256(json.dumps([CACHE_VERSION, *params]).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key: str, output_directory: str) -> list[tuple[str, str]] | None:
+        """Copy a cached entry into the output directory.
+
+        Args:
+            key (str): The cache key.
+            output_directory (str): The directory to copy the PDFs and pages to.
+
+        Returns:
+            list[tuple[str, str]] | None: The context and path of each converted PDF, or None if the entry isn't
+            cached.
+
+        """
+        entry = self._entry_path(key)
+        copied = []
+        try:
+            with open(os.path.join(entry, MANIFEST)) as fh:
+                manifest = json.load(fh)
+
+            pdf_paths = []
+            for context, name in manifest["pdfs"]:
+                path = os.path.join(output_directory, f"cached_{name}")
+                _link_or_copy(os.path.join(entry, name), path)
+                copied.append(path)
+                pdf_paths.append((context, path))
+            for name in manifest["pages"]:
+                path = os.path.join(output_directory, name)
+                _link_or_copy(os.path.join(entry, name), path)
+                copied.append(path)
+
+            # Mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            # Entry is missing, or was evicted while we were reading it
+            for path in copied:
+                os.remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return pdf_paths
+
+    def store(self, key: str, pdf_paths: list[tuple[str, str]], page_paths: list[str]) -> None:
+        """Add an entry to the cache.
+
+        Args:
+            key (str): The cache key.
+            pdf_paths (list[tuple[str, str]]): The context and path of each converted PDF.
+            page_paths (list[str]): The paths of the rendered pages, named as "output_{context}-{page}.png".
+
+        """
+        entry = self._entry_path(key)
+        if os.path.exists(entry):
+            return
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".staging-")
+        try:
+            manifest = {"pdfs": [], "pages": []}
+            for context, path in pdf_paths:
+                name = f"{context}.pdf"
+                shutil.copyfile(path, os.path.join(staging, name))
+                manifest["pdfs"].append((context, name))
+            for path in page_paths:
+                name = os.path.basename(path)
+                shutil.copyfile(path, os.path.join(staging, name))
+                manifest["pages"].append(name)
+            with open(os.path.join(staging, MANIFEST), "w") as fh:
+                json.dump(manifest, fh)
+
+            # Publish the entry atomically, if another instance beat us to it then keep theirs
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least-recently-used entries until the cache fits in its size budget."""
+        entries = []
+        total = 0
+        for shard in os.scandir(self.directory):
+            if shard.name.startswith("."):
+                # Clean up after instances that died while writing or evicting an entry
+                if shard.is_dir() and time() - shard.stat().st_mtime > STALE_SECONDS:
+                    shutil.rmtree(shard.path, ignore_errors=True)
+                continue
+            elif not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except OSError:
+                    # Entry was evicted by another instance
+                    continue
+                total += size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            # Move the entry out of the way first so readers never see it half-deleted
+            trash = tempfile.mkdtemp(dir=self.directory, prefix=".evicted-")
+            try:
+                os.rename(path, os.path.join(trash, "entry"))
+            except OSError:
+                # Entry was already evicted by another instance
+                pass
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
@@ -0,0 +1,199 @@
+"""Office document conversion using a long-lived DocBuilder worker process."""
+
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from time import time
+
+
+class ConversionError(Exception):
+    """Raised when the worker is unable to convert a document."""
+
+
+class ConversionTimeout(ConversionError):
+    """Raised when a conversion doesn't finish in time."""
+
+
+def _conversion_worker(conn: Connection) -> None:
+    """Convert documents to PDF as they're requested (runs inside the worker process).
+
+    Args:
+        conn (Connection): The pipe to receive jobs from and send results back through.
+
+    """
+    # Only the worker needs DocBuilder, keeping the engine loaded in between conversions
+    from documentbuilder.docbuilder import CDocBuilder
+
+    builder = CDocBuilder()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # Parent went away
+            break
+        if job is None:
+            break
+
+        fp, output_path, landscape = job
+        error = None
+        try:
+            # Ref: https://api.onlyoffice.com/docs/office-api/get-started/overview/
+            builder.OpenFile(fp, "")
+            if landscape:
+                # Adjust the orientation of spreadsheets before conversion
+                api = builder.GetContext().GetGlobal()["Api"]
+                spreadsheet = api.Call("GetActiveSheet")
+                spreadsheet.SetProperty("PageOrientation", "xlLandscape")
+            builder.SaveFile("pdf", output_path)
+        except Exception as e:  # noqa: BLE001
+            error = str(e) or e.__class__.__name__
+
+        try:
+            # Close the document even if the conversion failed, so that it isn't carried over into the next job
+            builder.CloseFile()
+        except Exception:  # noqa: BLE001
+            # The builder can't be trusted with another document, have a new worker started for the next job
+            conn.send((error, True))
+            break
+        conn.send((error, False))
+
+
+def _rss_mb(pid: int) -> float:
+    """Get the resident memory of a process.
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        float: The resident set size in MB, or 0 if it can't be determined.
+
+    """
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class ConversionWorker:
+    """A DocBuilder worker process that's restarted on timeouts and recycled as it ages."""
+
+    def __init__(
+        self,
+        timeout: float = 30,
+        max_conversions: int = 100,
+        max_rss_mb: int = 1024,
+        log: logging.Logger | None = None,
+    ) -> None:
+        """Initialize the worker (the process is started on first use).
+
+        Args:
+            timeout (float, optional): Seconds to wait on a conversion before killing the worker. Defaults to 30.
+            max_conversions (int, optional): Number of conversions before the worker is recycled, 0 to never
+                recycle. Defaults to 100.
+            max_rss_mb (int, optional): Resident memory (MB) past which the worker is recycled, 0 to never recycle.
+                Defaults to 1024.
+            log (logging.Logger, optional): The logger to use. Defaults to None.
+
+        """
+        self.timeout = timeout
+        self.max_conversions = max_conversions
+        self.max_rss_mb = max_rss_mb
+        self.log = log or logging.getLogger(__name__)
+        self.conversions = 0
+        self.last_latency = 0.0
+        self._process = None
+        self._conn = None
+
+    def start(self) -> None:
+        """Start the worker process if it isn't already running."""
+        if self._process and self._process.is_alive():
+            return
+
+        if self._conn:
+            self._conn.close()
+
+        ctx = multiprocessing.get_context("forkserver")
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_conversion_worker, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self.conversions = 0
+
+    def stop(self) -> None:
+        """Stop the worker process, killing it if it doesn't exit on its own."""
+        if self._process is None:
+            return
+
+        try:
+            self._conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._conn.close()
+        self._process, self._conn = None, None
+
+    def _kill(self) -> None:
+        """Kill the worker process without waiting on it to finish its current job."""
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+        self._process, self._conn = None, None
+
+    def convert(self, fp: str, output_path: str, landscape: bool = False) -> float:
+        """Convert a document to PDF.
+
+        Args:
+            fp (str): The path to the document to convert.
+            output_path (str): The path to write the PDF to.
+            landscape (bool, optional): Set the active spreadsheet to landscape orientation. Defaults to False.
+
+        Returns:
+            float: The time taken by the conversion, in seconds.
+
+        Raises:
+            ConversionTimeout: If the conversion took longer than the timeout, the worker is killed.
+            ConversionError: If the worker failed to convert the document or died during the conversion.
+
+        """
+        self.start()
+        start = time()
+        try:
+            self._conn.send((fp, output_path, landscape))
+            if not self._conn.poll(self.timeout):
+                # Pathological document, don't let it hold up the service
+                self._kill()
+                raise ConversionTimeout(f"Conversion took longer than {self.timeout}s")
+            error, retired = self._conn.recv()
+        except (EOFError, OSError):
+            # Worker crashed during the conversion
+            self._kill()
+            raise ConversionError("Conversion worker terminated unexpectedly")
+
+        self.last_latency = time() - start
+        self.conversions += 1
+        if retired:
+            # Worker couldn't close the document and is exiting
+            self.log.debug("Restarting conversion worker that was unable to close a document")
+            self.stop()
+        else:
+            self._recycle_if_needed()
+        if error:
+            raise ConversionError(error)
+        return self.last_latency
+
+    def _recycle_if_needed(self) -> None:
+        """Restart the worker once it's reached its conversion or memory limits."""
+        if self.max_conversions and self.conversions >= self.max_conversions:
+            self.log.debug(f"Recycling conversion worker after {self.conversions} conversions")
+        elif self.max_rss_mb and (rss := _rss_mb(self._process.pid)) > self.max_rss_mb:
+            self.log.debug(f"Recycling conversion worker using {rss:.0f}MB of memory")
+        else:
+            return
+        self.stop()
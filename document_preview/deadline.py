@@ -0,0 +1,79 @@
+"""Time budget of an analysis, shared by its stages."""
+
+import logging
+from time import monotonic
+
+
+class Deadline:
+    """The time left to analyze a file before the service times out.
+
+    Stages are run in order of their value, optional stages are skipped (or cut short) once there isn't enough time
+    left to run them and still return what was found so far.
+    """
+
+    def __init__(
+        self,
+        budget: float = 0,
+        reserve: float = 0,
+        costs: dict[str, float] | None = None,
+        log: logging.Logger | None = None,
+    ) -> None:
+        """Start the clock.
+
+        Args:
+            budget (float, optional): The number of seconds the analysis has, 0 for no limit. Defaults to 0.
+            reserve (float, optional): The number of seconds kept back to put together and return the result.
+                Defaults to 0.
+            costs (dict[str, float], optional): The least number of seconds each stage takes to be worth starting.
+                Defaults to None (any time left is enough).
+            log (logging.Logger, optional): The logger to use. Defaults to None.
+
+        """
+        self.budget = budget
+        self.reserve = reserve
+        self.costs = costs or {}
+        self.log = log or logging.getLogger(__name__)
+        self.start = monotonic()
+        # Reason each stage was skipped or cut short, in the order it happened
+        self.skipped: dict[str, str] = {}
+
+    def remaining(self) -> float | None:
+        """Get the time that optional stages can still use.
+
+        Returns:
+            float | None: The number of seconds left before the reserve, or None if there's no limit.
+
+        """
+        if not self.budget:
+            return None
+        return max(self.budget - self.reserve - (monotonic() - self.start), 0)
+
+    def allows(self, stage: str) -> bool:
+        """Check whether there's time left to run an optional stage, recording it as skipped if there isn't.
+
+        Args:
+            stage (str): The name of the stage.
+
+        Returns:
+            bool: Whether the stage should run.
+
+        """
+        remaining = self.remaining()
+        cost = self.costs.get(stage, 0)
+        # A stage that can't get through its least amount of work only holds up the stages after it
+        if remaining is None or remaining > cost:
+            return True
+        self.skip(stage, f"Not enough time left ({remaining:.1f}s, needs at least {cost}s)")
+        return False
+
+    def skip(self, stage: str, reason: str) -> None:
+        """Record that a stage was skipped or cut short.
+
+        Args:
+            stage (str): The name of the stage.
+            reason (str): What was left out.
+
+        """
+        if stage not in self.skipped:
+            self.log.warning(f"Skipping {stage} with {monotonic() - self.start:.1f}s elapsed: {reason}")
+            self.skipped[stage] = reason
@@ -1,26 +1,24 @@
 """Main service module."""
 
 import email
-import functools
+import json
+import math
 import os
 import re
 import subprocess
 import tempfile
 from base64 import b64decode, b64encode
-from hashlib import sha256
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO, StringIO
 from tempfile import NamedTemporaryFile
 from time import time
-from zipfile import BadZipFile, ZipFile
 
-import fitz
 import pandas
-from assemblyline.common import forge
 from assemblyline.common.exceptions import RecoverableError
 from assemblyline.odm.base import FULL_URI
 from assemblyline_v4_service.common.base import ServiceBase
-from assemblyline_v4_service.common.ocr import detections as indicator_detections
-from assemblyline_v4_service.common.ocr import ocr_detections
 from assemblyline_v4_service.common.request import ServiceRequest as Request
 from assemblyline_v4_service.common.result import (
     Heuristic,
@@ -32,73 +30,73 @@ from assemblyline_v4_service.common.result import (
 )
 from assemblyline_v4_service.common.utils import extract_passwords
 from bs4 import BeautifulSoup
-from documentbuilder.docbuilder import CDocBuilder
 from eml2pdf.libeml2pdf import _Header as Header
 from eml2pdf.libeml2pdf import _walk_eml as walk_eml
 from multidecoder.decoders.network import find_emails, find_urls
 from natsort import natsorted
-from PIL import Image, ImageOps
+from PIL import Image
 from selenium.common.exceptions import NoAlertPresentException, WebDriverException
-from selenium.webdriver import Chrome, ChromeOptions, ChromeService
-
-PDF_DPI = int(os.environ.get("PDF_DPI", 150))
-IDENTIFY = forge.get_identify(use_cache=os.environ.get("PRIVILEGED", "false").lower() == "true")
-
-# Ignore default max image pixels limit imposed by Pillow
-Image.MAX_IMAGE_PIXELS = None
-
-
-@functools.lru_cache(maxsize=32)
-def _read_file_bytes(fp: str) -> bytes:
-    """Read and cache file contents.
-
-    Args:
-        fp (str): The file path to read.
-
-    Returns:
-        bytes: The contents of the file as bytes.
-
-    """
-    with open(fp, "rb") as f:
-        return f.read()
-
-
-@functools.lru_cache(maxsize=8)
-def _open_fitz_doc(fp: str) -> fitz.Document:
-    """Open and cache a PyMuPDF document.
-
-    Args:
-        fp (str): The file path to the PDF document.
+from selenium.webdriver import Chrome, ChromeOptions
+
+from document_preview.browser import BrowserPool
+from document_preview.cache import RenderCache
+from document_preview.conversion import ConversionError, ConversionWorker
+from document_preview.deadline import Deadline
+from document_preview.images import ImageExtractor, extract_office_images
+from document_preview.indicators import IndicatorDetector
+from document_preview.memory import release_free_memory
+from document_preview.metrics import StageMetrics, stage_totals
+from document_preview.msg import msg_to_email
+from document_preview.ocr import EmbeddedImageOCR
+from document_preview.qr import BACKEND as QR_BACKEND
+from document_preview.qr import QRDecodeError, batch_scan_for_QR_codes, iter_qr_candidates, scan_qr_candidates
+from document_preview.render import (
+    BYTES_PER_PIXEL,
+    DOCUMENT_CACHE,
+    PDF_DPI,
+    DocumentAnalysis,
+    RenderedPage,
+    _open_fitz_doc,
+    analyze_pages,
+    create_render_pool,
+    release_documents,
+    select_ocr_pages,
+)
+from document_preview.similarity import PerceptualIndex, dhash
 
-    Returns:
-        fitz.Document: The opened PyMuPDF document.
+# Office formats converted to PDF by DocBuilder
+OFFICE_FILE_TYPES = [f"document/office/{ms_product}" for ms_product in ["word", "excel", "powerpoint", "rtf"]]
 
-    """
-    return fitz.open(fp)
+# Only as much of a CSV as can be shown on the rendered (landscape) pages is converted
+CSV_ROWS_PER_PAGE = 50
+CSV_BYTES_PER_PAGE = 1024 * 1024
+# Widest column allowed in a spreadsheet
+MAX_COLUMN_WIDTH = 255
 
 
 def _clear_caches():
-    """Clear all file-level LRU caches between analysis runs."""
-    _read_file_bytes.cache_clear()
-    _open_fitz_doc.cache_clear()
+    """Clear all file-level caches between analysis runs."""
+    DOCUMENT_CACHE.clear()
 
 
 # MARK: EML2HTML
-def eml2html(file_contents: bytes) -> str:
+def eml2html(file_contents: bytes | email.message.Message) -> str:
     """Convert an EML file to HTML format.
 
     This is derived from the eml2pdf's `processs_eml` function but omits attachment handling since we're only
     interested in rendering the email body for previewing.
 
     Args:
-        file_contents (bytes): The content of the EML document.
+        file_contents (bytes | email.message.Message): The content of the EML document, or the already parsed message.
 
     Returns:
         str: The HTML content as a string.
 
     """
     # Open and parse the .eml file
-    msg = email.message_from_bytes(file_contents)
+    msg = file_contents
+    if isinstance(file_contents, bytes):
+        msg = email.message_from_bytes(file_contents)
 
     email_header = Header(msg, "<in-memory>")
     html_content, _ = walk_eml(msg, "<in-memory>")
@@ -114,31 +112,6 @@ def eml2html(file_contents: bytes) -> str:
     """
 
 
-# MARK: PDF rendering
-def render_pages(
-    fp: str, output_directory: str, first_page: int = 1, last_page: int | None = None, context: str = "original"
-) -> None:
-    """Convert PDF/Mobi/EPUB to images using PyMuPDF.
-
-    Args:
-        fp (str): The file path to the PDF document.
-        output_directory (str): The directory where the output images will be saved.
-        first_page (int, optional): The first page to convert. Defaults to 1.
-        last_page (int, optional): The last page to convert. Defaults to None, which means all pages.
-        context (str, optional): A context string to include in the output file names. Defaults to "original".
-
-    """
-    doc = _open_fitz_doc(fp)
-    end_page = min(last_page, doc.page_count) if last_page else doc.page_count
-    for page_num in range(first_page - 1, end_page):
-        page = doc[page_num]
-        zoom = PDF_DPI / 72  # 72 is the default DPI for PDFs
-        matrix = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=matrix)
-        output_path = os.path.join(output_directory, f"output_{context}-{page_num + 1}.png")
-        pix.save(output_path)
-
-
 # MARK: Service class
 class DocumentPreview(ServiceBase):
     """Service to render document previews and extract text/images from documents."""
@@ -153,73 +126,179 @@ class DocumentPreview(ServiceBase):
         [browser_options.add_argument(arg) for arg in browser_cfg.get("arguments", [])]
         [browser_options.set_capability(cap_n, cap_v) for cap_n, cap_v in browser_cfg.get("capabilities", {}).items()]
 
-        # Run browser in offline mode only
-        service = None
-        if os.path.exists("/usr/bin/chromedriver"):
-            service = ChromeService(executable_path="/usr/bin/chromedriver")
-        self.browser = Chrome(options=browser_options, service=service)
-        self.browser.set_network_conditions(offline=True, latency=5, throughput=500 * 1024)
-        self.browser.set_window_size(1080, 1920)
+        # Browsers are launched on the first HTML or email render, so that multiple renders can happen at the same time
+        self.browser_pool = BrowserPool(
+            browser_options,
+            size=int(self.config.get("browser_pool_size", 1)),
+            max_uses=int(self.config.get("browser_max_uses", 50)),
+            idle_timeout=float(self.config.get("browser_idle_timeout", 300)),
+            command_timeout=float(self.config.get("browser_command_timeout", 5)),
+            log=self.log,
+        )
+        self.browser_warm_up = self.config.get("browser_warm_up", False)
+
+        # HTML and emails can be captured as screenshots straight from the browser instead of being printed to PDF
+        html_capture_cfg = self.config.get("html_capture", {})
+        self.html_screenshots = html_capture_cfg.get("mode", "pdf") == "screenshot"
+        self.html_full_page = html_capture_cfg.get("full_page", False)
+
+        # Number of worker processes used to rasterize pages in parallel (0 or 1 renders in the service process)
+        self.render_workers = int(self.config.get("render_workers", 0))
+        self.render_pool = None
+
+        # Memory that rendered pages can take up, oversized pages are rendered at a lower resolution to fit
+        render_budget_cfg = self.config.get("render_budget", {})
+        self.max_page_pixels = render_budget_cfg.get("max_page_mb", 64) * 1024 * 1024 // BYTES_PER_PIXEL
+        self.max_total_pixels = render_budget_cfg.get("max_total_mb", 512) * 1024 * 1024 // BYTES_PER_PIXEL
+        # Images decoded with Pillow (ie. embedded images) are held to the same limit as a rendered page, Pillow refuses
+        # anything over twice that as a decompression bomb
+        Image.MAX_IMAGE_PIXELS = self.max_page_pixels or None
+
+        # Pages that only go into the gallery can be rendered with less detail than the pages that are run through OCR
+        tiered_rendering_cfg = self.config.get("tiered_rendering", {})
+        self.tiered_rendering = tiered_rendering_cfg.get("enabled", False)
+        self.preview_dpi = tiered_rendering_cfg.get("preview_dpi", 96)
+        self.preview_grayscale = tiered_rendering_cfg.get("grayscale", False)
+
+        # Office documents are converted by a long-lived DocBuilder process so the engine stays loaded
+        conversion_cfg = self.config.get("conversion", {})
+        self.converter = ConversionWorker(
+            timeout=conversion_cfg.get("timeout", 30),
+            max_conversions=conversion_cfg.get("max_conversions", 100),
+            max_rss_mb=conversion_cfg.get("max_rss_mb", 1024),
+            log=self.log,
+        )
+
+        # Keep converted documents and rendered pages around for files that are submitted again
+        cache_cfg = self.config.get("render_cache", {})
+        self.render_cache = None
+        if cache_cfg.get("enabled", False):
+            self.render_cache = RenderCache(
+                cache_cfg.get("directory", os.path.join(tempfile.gettempdir(), "document_preview_cache")),
+                max_size_mb=cache_cfg.get("max_size_mb", 512),
+                log=self.log,
+            )
+
+        # Limits on the media extracted from Office documents, which also guard against zip bombs
+        office_media_cfg = self.config.get("office_media", {})
+        self.media_limits = {
+            "max_members": office_media_cfg.get("max_members", 500),
+            "max_member_size": office_media_cfg.get("max_member_size_mb", 50) * 1024 * 1024,
+            "max_total_size": office_media_cfg.get("max_total_size_mb", 250) * 1024 * 1024,
+        }
+
+        # Limits on the images extracted from documents, checked before they're decoded
+        embedded_images_cfg = self.config.get("embedded_images", {})
+        self.image_limits = {
+            "min_dimension": embedded_images_cfg.get("min_dimension", 16),
+            "max_dimension": embedded_images_cfg.get("max_dimension", 10000),
+            "max_bytes": embedded_images_cfg.get("max_size_mb", 20) * 1024 * 1024,
+        }
+
+        # Maximum number of ways to reassemble embedded images that might be pieces of a QR code
+        self.qr_max_combinations = int(self.config.get("qr_max_combinations", 64))
+
+        # Images embedded in documents are run through OCR in parallel, skipping icons and duplicates
+        embedded_ocr_cfg = self.config.get("embedded_image_ocr", {})
+        self.embedded_ocr = EmbeddedImageOCR(
+            workers=embedded_ocr_cfg.get("workers", 4),
+            min_pixels=embedded_ocr_cfg.get("min_pixels", 1024),
+            log=self.log,
+        )
+
+        # Pages that look like one already seen (ie. the "original" and "plain" renders of an email, repeated template
+        # pages) reuse its OCR result instead of going through OCR again, they're still scanned for QR codes as a
+        # code is too small a part of a page to tell two pages apart
+        near_duplicates_cfg = self.config.get("near_duplicate_pages", {})
+        self.near_duplicates = near_duplicates_cfg.get("enabled", False)
+        self.near_duplicate_distance = near_duplicates_cfg.get("max_distance", 8)
+        self.page_hash_size = near_duplicates_cfg.get("hash_size", 16)
+        self.collapse_near_duplicates = near_duplicates_cfg.get("collapse", False)
+
+        # Whether each page goes through OCR is decided from its text layer, rather than from the whole document
+        ocr_routing_cfg = self.config.get("ocr_routing", {})
+        self.ocr_routing = ocr_routing_cfg.get("enabled", False)
+        self.ocr_routing_thresholds = {
+            "min_chars": ocr_routing_cfg.get("min_chars", 50),
+            "min_image_coverage": ocr_routing_cfg.get("min_image_coverage", 0.5),
+            "min_density": ocr_routing_cfg.get("min_chars_per_sq_inch", 5),
+        }
+
+        # Optional stages are skipped or cut short once the analysis nears the service timeout
+        deadline_cfg = self.config.get("deadline", {})
+        self.deadline_budget = self.service_attributes.timeout if deadline_cfg.get("enabled", True) else 0
+        self.deadline_reserve = deadline_cfg.get("reserve_s", 10)
+        self.deadline_costs = deadline_cfg.get("stage_costs_s", {})
+        self.deadline = Deadline()
+
+        # What's held in memory during an analysis is bounded by size, and released early if memory runs low
+        memory_cfg = self.config.get("memory", {})
+        DOCUMENT_CACHE.max_bytes = memory_cfg.get("document_cache_mb", 256) * 1024 * 1024
+        self.qr_image_bytes = memory_cfg.get("qr_images_mb", 64) * 1024 * 1024
+        self.memory_limit_mb = memory_cfg.get("pressure_ratio", 0.8) * self.service_attributes.docker_config.ram_mb
+        # Pages of the current analysis that haven't been attached yet, released to disk if memory runs low
+        self.previews: list[RenderedPage] = []
+
+        # Time and resources used by each stage of the current analysis
+        self.metrics = StageMetrics()
+        self.stage_metrics_supplementary = self.config.get("stage_metrics_supplementary", False)
+        # Totals of each stage across analyses are logged every so many analyses, and when the service stops
+        self.stage_totals_interval = int(self.config.get("stage_totals_interval", 100))
+        self.analyses = 0
 
     def start(self):
         """Start the DocumentPreview service."""
-        self.log.debug("Document preview service started")
+        if self.render_workers > 1:
+            self.render_pool = create_render_pool(self.render_workers)
+        self.converter.start()
+        self.embedded_ocr.start()
+        if self.browser_warm_up:
+            # Have a browser ready for the first HTML or email without holding up the start of the service
+            self.browser_pool.warm_up()
+        self.log.debug(f"Document preview service started, decoding QR codes using {QR_BACKEND}")
 
     def stop(self):
         """Stop the DocumentPreview service."""
+        if self.render_pool:
+            self.render_pool.shutdown(cancel_futures=True)
+            self.render_pool = None
+        self.browser_pool.close()
+        self.converter.stop()
+        self.embedded_ocr.stop()
+        self.log_stage_totals()
         self.log.debug("Document preview service ended")
 
     # MARK: PDF text extraction
-    def extract_pdf_text(self, path: str, max_pages: int) -> None | str:
-        """Extract text from a PDF document.
+    def extract_pdf_text(self, analysis: DocumentAnalysis) -> Iterator[str]:
+        """Extract text from a PDF document, one page at a time.
 
         Args:
-            path (str): The path to the PDF document.
-            max_pages (int): The maximum number of pages to extract.
+            analysis (DocumentAnalysis): The text collected from the pages of the PDF document.
 
-        Returns:
-            str: The path to the extracted text file.
+        Yields:
+            str: The text of each page that has any.
         """
-        output_path = os.path.join(self.working_directory, "extracted_text")
-        doc = _open_fitz_doc(path)
-        text = ""
-        for page_num in range(min(max_pages, doc.page_count)):
-            text += doc[page_num].get_text()
-
-        if text.strip():
-            with open(output_path, "w") as f:
-                f.write(text)
-            return output_path
+        for text in analysis.text:
+            if text.strip():
+                yield text
 
-    # MARK: PDF image extraction
-    def extract_pdf_images(self, path: str, max_pages: int) -> list[str]:
-        """Extract images from a PDF document.
+    # MARK: Office conversion
+    def extract_office_media(self, file: str, request: Request) -> None:
+        """Extract any images from the media of an Office document.
 
         Args:
-            path (str): The path to the PDF document.
-            max_pages (int): The maximum number of pages to extract.
+            file (str): The path to the Office document.
+            request (Request): The service request object containing parameters and file information.
 
-        Returns:
-            list[str]: A list of paths to the extracted image files.
         """
-        image_paths = []
-        doc = _open_fitz_doc(path)
-        img_index = 0
-        for page_num in range(min(max_pages, doc.page_count)):
-            for img_ref in doc[page_num].get_images(full=True):
-                xref = img_ref[0]
-                base_image = doc.extract_image(xref)
-                if base_image:
-                    ext = base_image["ext"]
-                    image_data = base_image["image"]
-                    output_path = os.path.join(self.working_directory, f"extracted_image-{img_index:03d}.{ext}")
-                    with open(output_path, "wb") as f:
-                        f.write(image_data)
-                    image_paths.append(output_path)
-                    img_index += 1
-        return image_paths
+        # Extract all media from the Office document if they're an image
+        if request.file_type == "text/csv":
+            return
+
+        extracted_images_dir = os.path.join(self.working_directory, "extracted_media")
+        for media_path, name in extract_office_images(file, extracted_images_dir, **self.media_limits, log=self.log):
+            request.add_extracted(media_path, name=name, description="Extracted media from Office document")
 
-    # MARK: Office conversion
     def office_conversion(self, file: str, request: Request) -> str:
         """Convert Office document to PDF and extract any media if possible.
 
@@ -231,164 +310,203 @@ class DocumentPreview(ServiceBase):
             str: The path to the converted PDF file, or None if conversion failed.
 
         """
-        # Extract all media from the Office document if they're an image
-        if request.file_type != "text/csv":
-            try:
-                with ZipFile(file, "r") as zf:
-                    extracted_images_dir = os.path.join(self.working_directory, "extracted_media")
-                    for media in zf.filelist:
-                        if media.is_dir():
-                            # Skipping directories
-                            continue
-                        elif "/media/" not in media.filename:
-                            # Not a media file, skip
-                            continue
-
-                        # Extract the media file
-                        zf.extract(media, extracted_images_dir)
-                        media_path = os.path.join(extracted_images_dir, media.filename)
-                        # Ensure the media extracted is an image
-                        if IDENTIFY.fileinfo(
-                            media_path,
-                            generate_hashes=False,
-                            skip_fuzzy_hashes=True,
-                            calculate_entropy=False,
-                        )["type"].startswith("image/"):
-                            request.add_extracted(
-                                media_path,
-                                name=media.filename,
-                                description="Extracted media from Office document",
-                            )
-            except BadZipFile:
-                # Can't extract media from the file, likely not a valid Office document
-                pass
-
-        # Convert Office documents to PDF using CDocBuilder
-        # Ref: https://api.onlyoffice.com/docs/office-api/get-started/overview/
+        # Convert Office documents to PDF using CDocBuilder, extracting media while the conversion runs
         output_path = os.path.join(self.working_directory, "converted.pdf")
-        builder = CDocBuilder()
-        builder.OpenFile(file, "")
-
-        if request.file_type == "document/office/excel" or request.file_type == "text/csv":
-            # Adjust the orientation of spreadsheets before conversion
-            api = builder.GetContext().GetGlobal()["Api"]
-            spreadsheet = api.Call("GetActiveSheet")
-            spreadsheet.SetProperty("PageOrientation", "xlLandscape")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            media_extraction = executor.submit(self.extract_office_media, file, request)
+            try:
+                with self.metrics.stage("conversion.docbuilder"):
+                    latency = self.converter.convert(
+                        file,
+                        output_path,
+                        # Adjust the orientation of spreadsheets before conversion
+                        landscape=request.file_type == "document/office/excel" or request.file_type == "text/csv",
+                    )
+                self.log.debug(f"Converted {request.file_type} to PDF in {latency:.2f}s")
+            except ConversionError as e:
+                self.log.warning(f"Unable to convert {request.file_type} to PDF: {e}")
+                if os.path.exists(output_path):
+                    # Don't try to render what may be a partially-written PDF
+                    os.remove(output_path)
+            media_extraction.result()
 
-        builder.SaveFile("pdf", output_path)
-        builder.CloseFile()
         if os.path.exists(output_path):
             return output_path
 
     # MARK: HTML rendering
-    def html_render(self, file_contents: bytes, max_pages: int = 1) -> None | str:
+    def html_screenshot(self, browser: Chrome, context: str, max_pages: int = 1) -> None:
+        """Capture the page loaded in the browser as screenshots, one viewport-high slice per page.
+
+        Args:
+            browser (Chrome): The browser the page is loaded in.
+            context (str): The context of the render, used to name the screenshots.
+            max_pages (int): The maximum number of slices to capture.
+        """
+        layout = browser.execute_cdp_cmd("Page.getLayoutMetrics", {})
+        content = layout.get("cssContentSize") or layout["contentSize"]
+        viewport = layout.get("cssLayoutViewport") or layout["layoutViewport"]
+        width = max(content["width"], 1)
+        height = max(content["height"], 1)
+        slice_height = viewport["clientHeight"] or height
+        slices = min(max_pages, math.ceil(height / slice_height))
+        if self.html_full_page:
+            # A single screenshot of everything that would have been on the rendered pages
+            slice_height, slices = min(height, slice_height * slices), 1
+        scale = 1
+        if self.max_page_pixels and width * slice_height > self.max_page_pixels:
+            # Oversized (or crafted) page, capture it at a lower resolution to stay within the budget of a page
+            scale = math.sqrt(self.max_page_pixels / (width * slice_height))
+
+        for page in range(slices):
+            top = page * slice_height
+            screenshot = browser.execute_cdp_cmd(
+                "Page.captureScreenshot",
+                {
+                    "format": "png",
+                    "clip": {
+                        "x": 0,
+                        "y": top,
+                        "width": width,
+                        "height": min(slice_height, height - top),
+                        "scale": scale,
+                    },
+                    "captureBeyondViewport": True,
+                },
+            )
+            with open(os.path.join(self.working_directory, f"output_{context}-{page + 1}.png"), "wb") as fh:
+                fh.write(b64decode(screenshot["data"]))
+
+    def html_render(
+        self, file_contents: bytes, max_pages: int = 1, context: str = "original", pdf: bool = True
+    ) -> None | str:
         """Render HTML content in a browser and save as PDF.
 
         Args:
             file_contents (bytes): The HTML content to render.
             max_pages (int): The maximum number of pages to render.
+            context (str, optional): The context of the render, used to name screenshots. Defaults to "original".
+            pdf (bool, optional): Whether a PDF is needed when capturing screenshots (ie. for text extraction).
+                Defaults to True.
 
         Returns:
-            None | str: The path to the rendered PDF file, or None if rendering failed.
+            None | str: The path to the rendered PDF file, or None if rendering failed or no PDF was needed.
         """
         if b"window.location.href = " in file_contents:
             # Document contains code that will cause a redirect, something we likely can't follow
             return
 
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_pdf:
-            # Load base64'd HTML contents directly into new tab
-            self.browser.switch_to.new_window("tab")
-            self.browser.get(f"data:text/html;base64,{b64encode(file_contents).decode()}")
+        with self.metrics.stage("conversion.chrome"), self.browser_pool.session() as browser:
+            # Load base64'd HTML contents directly into new tab, the browser is reset once it's returned to the pool
+            browser.switch_to.new_window("tab")
+            browser.get(f"data:text/html;base64,{b64encode(file_contents).decode()}")
 
             # Check to see if there's an alert raised on page load
             try:
                 # If there is any alert, dismiss it before continuing render
                 while True:
-                    alert = self.browser.switch_to.alert
+                    alert = browser.switch_to.alert
                     alert.dismiss()
             except NoAlertPresentException:
                 # No alert raised, continue with render
                 pass
 
+            if self.html_screenshots:
+                # Previews come straight from the browser, the PDF is only printed for its text and links
+                self.html_screenshot(browser, context, max_pages)
+                if not pdf:
+                    return
+
             try:
-                # Use Chrome's Developer Protocol directly
-                result = self.browser.execute_cdp_cmd(
-                    "Page.printToPDF",
-                    {
-                        "pageRanges": f"1-{max_pages}",
-                        "printBackground": True,
-                        "transferMode": "ReturnAsStream",
-                    },
-                )
+                return self.print_to_pdf(browser, max_pages)
+            except WebDriverException:
+                # We aren't able to print the page to PDF, take a screenshot instead
+                # Named after the context, as the other contexts may be rendering at the same time
+                if not self.html_screenshots:
+                    browser.save_screenshot(os.path.join(self.working_directory, f"output_{context}-1.png"))
+                return
 
-                # Read the PDF stream in chunks and write to file
-                stream_handle = result["stream"]
+    def print_to_pdf(self, browser: Chrome, max_pages: int = 1) -> str:
+        """Print the page loaded in the browser to PDF.
+
+        Args:
+            browser (Chrome): The browser the page is loaded in.
+            max_pages (int, optional): The maximum number of pages to print. Defaults to 1.
+
+        Returns:
+            str: The path to the PDF file.
+
+        """
+        # Use Chrome's Developer Protocol directly
+        result = browser.execute_cdp_cmd(
+            "Page.printToPDF",
+            {
+                "pageRanges": f"1-{max_pages}",
+                "printBackground": True,
+                "transferMode": "ReturnAsStream",
+            },
+        )
+
+        # Read the PDF stream in chunks and write to file
+        stream_handle = result["stream"]
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_pdf:
+            try:
                 while True:
-                    chunk = self.browser.execute_cdp_cmd("IO.read", {"handle": stream_handle, "size": 65536})
+                    chunk = browser.execute_cdp_cmd("IO.read", {"handle": stream_handle, "size": 65536})
                     tmp_pdf.write(b64decode(chunk["data"]) if chunk.get("base64Encoded") else chunk["data"].encode())
                     if chunk.get("eof"):
                         # We've reached the end of the stream
                         break
-                self.browser.execute_cdp_cmd("IO.close", {"handle": stream_handle})
-                return tmp_pdf.name
-            except WebDriverException:
-                # We aren't able to print the page to PDF, take a screenshot instead
-                self.browser.save_screenshot(os.path.join(self.working_directory, "output_screenshot-1.png"))
-                return
-            finally:
-                # Reset browser for next run by closing all windows (except for the first one which we created)
-
-                # Check to see if the current window handle was deleted
-                if self.browser.current_window_handle not in self.browser.window_handles:
-                    # Set current window to the last that was created
-                    self.browser.switch_to.window(self.browser.window_handles[-1])
-
-                while len(self.browser.window_handles) > 1:
-                    # In the event we load JS that spawns a bunch of windows, let's clean them up
-                    self.browser.close()
-                    self.browser.switch_to.window(self.browser.window_handles[-1])
+                browser.execute_cdp_cmd("IO.close", {"handle": stream_handle})
+            except BaseException:
+                # Don't leave a partial PDF behind
+                os.remove(tmp_pdf.name)
+                raise
+        return tmp_pdf.name
 
     # MARK: Rendering entrypoint
-    def render_documents(self, request: Request, max_pages=1) -> list[tuple[str, str]] | None:
+    def render_documents(self, request: Request, max_pages=1, extract: bool = True) -> list[tuple[str, str]] | None:
         """Render documents based on their file type.
 
         Args:
             request (Request): The request object containing file information.
             max_pages (int, optional): The maximum number of pages to render. Defaults to 1.
+            extract (bool, optional): Whether text and links will be extracted from the rendered PDF, HTML captured
+                as screenshots is only printed to PDF if they are. Defaults to True.
 
         Returns:
             list[tuple[str, str]] | None: A list of tuples containing the context and path to the rendered PDF,
             or None if rendering failed.
         """
         # Word/Excel/Powerpoint/RTF/ODT
-        if request.file_type.startswith("document/odt") or any(
-            request.file_type == f"document/office/{ms_product}"
-            for ms_product in ["word", "excel", "powerpoint", "rtf"]
-        ):
+        if request.file_type.startswith("document/odt") or request.file_type in OFFICE_FILE_TYPES:
             return [("original", self.office_conversion(request.file_path, request))]
         # CSV
         elif request.file_type == "text/csv":
+            # Only read the rows that can be shown on the rendered pages, however large the file is
+            with open(request.file_path, "rb") as fh:
+                head = fh.read(CSV_BYTES_PER_PAGE * max_pages)
+                if fh.read(1) and b"\n" in head:
+                    # Drop the partial row at the end
+                    head = head[: head.rindex(b"\n") + 1]
+
             with tempfile.NamedTemporaryFile(dir=self.working_directory) as tmp:
                 with pandas.ExcelWriter(tmp) as writer:
                     # Convert CSV to Excel spreadsheet, then render
-                    df = pandas.read_csv(request.file_path, on_bad_lines="skip")
+                    df = pandas.read_csv(BytesIO(head), nrows=CSV_ROWS_PER_PAGE * max_pages, on_bad_lines="skip")
                     df.to_excel(writer, index=False)
                     worksheet = writer.sheets["Sheet1"]
 
                     # Expand columns
                     # Ref: https://stackoverflow.com/questions/17326973/is-there-a-way-to-auto-adjust-excel-column-widths-with-pandas-excelwriter
-                    for idx, col in enumerate(df):  # loop through all columns
-                        series = df[col]
+                    for idx, (name, series) in enumerate(df.items()):  # loop through all columns
                         max_len = (
                             max(
-                                (
-                                    series.astype(str).map(len).max(),  # len of largest item
-                                    len(str(series.name)),  # len of column name/header
-                                )
+                                series.astype(str).str.len().max() if len(series) else 0,  # len of largest item
+                                len(str(name)),  # len of column name/header
                             )
                             + 1
                         )  # adding a little extra space
-                        worksheet.set_column(idx, idx, max_len)  # set column width
+                        worksheet.set_column(idx, idx, min(max_len, MAX_COLUMN_WIDTH))  # set column width
 
                 return [("original", self.office_conversion(tmp.name, request))]
 
@@ -397,39 +515,248 @@ class DocumentPreview(ServiceBase):
             return [("original", request.file_path)]
         # EML/MSG
         elif request.file_type.endswith("email"):
-            file_contents = request.file_contents
-            file_contents_peek = file_contents[:30].lower()
             # Convert MSG to EML where applicable
             if request.file_type == "document/office/email":
-                with tempfile.NamedTemporaryFile(suffix=".eml") as tmp:
-                    subprocess.run(
-                        ["msgconvert", "-outfile", tmp.name, request.file_path],
-                        capture_output=True,
-                    )
-                    tmp.seek(0)
-                    file_contents = tmp.read()
-            elif request.file_type == "document/email" and (
-                b"<html" in file_contents_peek or b"<!doctype html" in file_contents_peek
-            ):
-                # We're dealing with an HTML-formatted email
-                return [("original", self.html_render(request.file_contents, max_pages))]
+                try:
+                    with self.metrics.stage("conversion.msg"):
+                        file_contents = msg_to_email(request.file_path)
+                except Exception as e:  # noqa: BLE001
+                    # Leave anything we can't parse ourselves (ie. signed messages) to msgconvert
+                    self.log.debug(f"Converting MSG with msgconvert: {e}")
+                    with (
+                        tempfile.NamedTemporaryFile(suffix=".eml") as tmp,
+                        self.metrics.stage("conversion.msgconvert"),
+                    ):
+                        process = subprocess.run(
+                            ["msgconvert", "-outfile", tmp.name, request.file_path],
+                            capture_output=True,
+                            check=False,
+                        )
+                        if process.returncode:
+                            # Whatever was written out is incomplete, there's nothing to render
+                            self.log.warning(f"msgconvert failed: {process.stderr.decode(errors='replace').strip()}")
+                            return None
+                        tmp.seek(0)
+                        file_contents = tmp.read()
+            else:
+                # The file is only read once, request.file_contents reads it again on every access
+                file_contents = request.file_contents
+                file_contents_peek = file_contents[:30].lower()
+                if request.file_type == "document/email" and (
+                    b"<html" in file_contents_peek or b"<!doctype html" in file_contents_peek
+                ):
+                    # We're dealing with an HTML-formatted email
+                    return [("original", self.html_render(file_contents, max_pages, pdf=extract))]
 
             # Render EML as PNG
             # If we have internet access, we'll attempt to load external images
-            return [("original", self.html_render(eml2html(file_contents).encode(), max_pages))]
+            return [("original", self.html_render(eml2html(file_contents).encode(), max_pages, pdf=extract))]
         # HTML
         elif request.file_type == "code/html":
             # Render the original HTML first
-            pdf_files = []
-            pdf_files.append(("original", self.html_render(request.file_contents, max_pages)))
+            file_contents = request.file_contents
+            renders = [("original", file_contents)]
 
             # Render the HTML with scripts and styling removed
-            if b"<script" in request.file_contents or b"<style" in request.file_contents:
-                bsoup = BeautifulSoup(request.file_contents, "html.parser")
+            if b"<script" in file_contents or b"<style" in file_contents:
+                bsoup = BeautifulSoup(file_contents, "html.parser")
                 [s.decompose() for s in bsoup("script")]
                 [s.decompose() for s in bsoup("style")]
-                pdf_files.append(("plain", self.html_render(str(bsoup).encode(), max_pages)))
-            return pdf_files
+                renders.append(("plain", str(bsoup).encode()))
+
+            # Render all contexts at the same time, as far as the browser pool allows
+            contexts, contents = zip(*renders)
+            with ThreadPoolExecutor(max_workers=min(len(renders), self.browser_pool.size)) as executor:
+                return list(
+                    zip(
+                        contexts,
+                        executor.map(
+                            lambda context, html: self.html_render(html, max_pages, context, pdf=extract),
+                            contexts,
+                            contents,
+                        ),
+                    )
+                )
+
+    # MARK: Preview rendering
+    def is_captured(self, request: Request) -> bool:
+        """Check whether the previews of a file are captured by the browser rather than rendered from a PDF.
+
+        Args:
+            request (Request): The request object containing file information.
+
+        Returns:
+            bool: Whether the previews are browser screenshots, which don't line up with the pages of the PDF.
+
+        """
+        return self.html_screenshots and (request.file_type == "code/html" or request.file_type.endswith("email"))
+
+    def select_ocr_pages(
+        self,
+        request: Request,
+        analyses: list[DocumentAnalysis],
+        page_keys: Iterable[tuple[str, int]],
+        ocr_pages: int,
+    ) -> set[tuple[str, int]]:
+        """Pick the pages to run through OCR.
+
+        The same pages are picked before the pages are rendered (so that they're the ones rendered with more detail)
+        and when they're attached to the result.
+
+        Args:
+            request (Request): The request object containing file information.
+            analyses (list[DocumentAnalysis]): What was collected from each PDF, empty if there's none (ie. images).
+            page_keys (Iterable[tuple[str, int]]): The context and number of each page.
+            ocr_pages (int): The number of leading pages to run through OCR, unless it's a deep scan.
+
+        Returns:
+            set[tuple[str, int]]: The context and number of each page to run through OCR.
+
+        """
+        routing = self.ocr_routing_thresholds if self.ocr_routing and not self.is_captured(request) else None
+        return select_ocr_pages(analyses, page_keys, ocr_pages, request.deep_scan, routing)
+
+    def render_previews(
+        self, request: Request, max_pages: int = 1, extract: bool = False, ocr_pages: int = 0
+    ) -> list[DocumentAnalysis]:
+        """Render previews of the document, reusing a previous render of the same file when it's cached.
+
+        Args:
+            request (Request): The request object containing file information.
+            max_pages (int, optional): The maximum number of pages to render. Defaults to 1.
+            extract (bool, optional): Collect the text, images and links of the rendered pages. Defaults to False.
+            ocr_pages (int, optional): The number of leading pages that may be run through OCR, unless it's a deep
+                scan. Defaults to 0.
+
+        Returns:
+            list[DocumentAnalysis]: What was collected from each rendered PDF, in a single pass over its pages unless
+            the pages picked for OCR have to be known before rendering. Cached pages are copied to the working directory
+            instead of being included.
+        """
+        # Unless tiered rendering is enabled, all pages get the same detail
+        # Pages are scanned for QR codes from these renders, so with tiered rendering gallery-only pages are scanned at
+        # the preview resolution (rendering every page with full detail for QR codes would leave nothing to save)
+        tiers = {"dpi": PDF_DPI}
+        detail = None
+        if self.tiered_rendering:
+            tiers = {"dpi": self.preview_dpi, "detail_dpi": PDF_DPI, "grayscale": self.preview_grayscale}
+            # What decides the pages that are rendered with more detail, as they're the ones picked for OCR
+            detail = {
+                "ocr_pages": ocr_pages if extract else 0,
+                "deep_scan": request.deep_scan,
+                "routing": self.ocr_routing and self.ocr_routing_thresholds,
+            }
+
+        # Previews of HTML and emails may be captured by the browser, leaving their PDF (if any) for extraction only
+        captured = self.is_captured(request)
+        capture = {"full_page": self.html_full_page, "pdf": extract} if captured else None
+
+        cache_key = None
+        pdf_paths = None
+        if self.render_cache:
+            cache_key = RenderCache.key(
+                request.sha256,
+                request.file_type,
+                max_pages,
+                self.max_page_pixels,
+                self.max_total_pixels,
+                tiers,
+                detail,
+                capture,
+            )
+            with self.metrics.stage("render_cache"):
+                pdf_paths = self.render_cache.fetch(cache_key, self.working_directory)
+            self.log.debug(
+                f"Render cache {'miss' if pdf_paths is None else 'hit'} "
+                f"(hits: {self.render_cache.hits}, misses: {self.render_cache.misses})"
+            )
+            if pdf_paths is not None and (
+                request.file_type.startswith("document/odt") or request.file_type in OFFICE_FILE_TYPES
+            ):
+                # Media is extracted alongside conversion, which we're skipping
+                self.extract_office_media(request.file_path, request)
+
+        render = pdf_paths is None
+        if render:
+            pdf_paths = [
+                (ctx, path) for ctx, path in self.render_documents(request, max_pages, extract=extract) or [] if path
+            ]
+
+        # If converting the document took most of the time we have, the first page is what matters most
+        last_page = max_pages
+        if render and max_pages > 1 and not self.deadline.allows("render_pages.later_pages"):
+            last_page = 1
+
+        # The pages picked for OCR depend on what's collected from the pages, so they're rendered once that's done
+        render_detail = render and not captured and detail is not None and detail["ocr_pages"]
+
+        # Convert PDF to images for ImageSection
+        with self.metrics.stage("render_pages"):
+            analyses = [
+                analyze_pages(
+                    pdf_path,
+                    first_page=1,
+                    last_page=last_page,
+                    context=context,
+                    render=render and not captured and not render_detail,
+                    extract=extract,
+                    # Pages are only measured when they're routed to OCR based on their text layer
+                    layout=extract and self.ocr_routing and not captured,
+                    pool=self.render_pool,
+                    workers=self.render_workers,
+                    max_page_pixels=self.max_page_pixels,
+                    max_total_pixels=self.max_total_pixels,
+                    **tiers,
+                )
+                for context, pdf_path in pdf_paths
+            ]
+            if render_detail:
+                ocr_keys = self.select_ocr_pages(
+                    request,
+                    analyses,
+                    [(analysis.context, page_number) for analysis in analyses for page_number in analysis.page_numbers],
+                    ocr_pages,
+                )
+                for analysis in analyses:
+                    rendered = analyze_pages(
+                        analysis.path,
+                        first_page=1,
+                        last_page=last_page,
+                        context=analysis.context,
+                        extract=False,
+                        pool=self.render_pool,
+                        workers=self.render_workers,
+                        max_page_pixels=self.max_page_pixels,
+                        max_total_pixels=self.max_total_pixels,
+                        detail_pages={page_number for context, page_number in ocr_keys if context == analysis.context},
+                        **tiers,
+                    )
+                    analysis.pages, analysis.unrendered = rendered.pages, rendered.unrendered
+            self.previews = [page for analysis in analyses for page in analysis.pages]
+        rendered_pages = [page for analysis in analyses for page in analysis.pages]
+        unrendered = sum(len(analysis.unrendered) for analysis in analyses)
+        if unrendered:
+            self.deadline.skip(
+                "render_pages.pixel_budget",
+                f"{unrendered} page(s) weren't rendered, they would have gone over the "
+                f"{self.max_total_pixels * BYTES_PER_PIXEL // 1024 // 1024}MB rendering budget",
+            )
+
+        if cache_key and render and last_page == max_pages:
+            # Include any previews that were written directly to disk (ie. screenshots)
+            rendered_paths = {page.path for page in rendered_pages}
+            page_paths = [
+                os.path.join(self.working_directory, s)
+                for s in os.listdir(self.working_directory)
+                if s.startswith("output") and os.path.join(self.working_directory, s) not in rendered_paths
+            ]
+            if pdf_paths or page_paths:
+                # Pages have to be encoded for the cache, they won't be encoded again when added to the result
+                with self.metrics.stage("render_cache"):
+                    page_paths += [page.save(self.working_directory) for page in rendered_pages]
+                    self.render_cache.store(cache_key, pdf_paths, page_paths)
+
+        return analyses
 
     # MARK: IOC tagging
     def tag_network_iocs(self, section: ResultSection, ocr_content: str) -> None:
@@ -442,38 +769,6 @@ class DocumentPreview(ServiceBase):
         [section.add_tag("network.email.address", node.value) for node in find_emails(ocr_content.encode())]
         [section.add_tag("network.static.uri", node.value) for node in find_urls(ocr_content.encode())]
 
-    # MARK: QR code scanning
-    def scan_for_QR_codes(self, image: Image) -> str:
-        """Scan the given image for QR codes and return the decoded content if found.
-
-        Args:
-            image (Image): The image to scan for QR codes.
-
-        Returns:
-            str: The decoded content of the QR code if found, otherwise an empty string.
-        """
-        # Try scanning the image as-is for QR codes
-        with NamedTemporaryFile() as tmp_qr:
-            image.save(tmp_qr.name, format="PNG")
-            qr_results = subprocess.run(
-                ["zbarimg", "-q", tmp_qr.name],
-                capture_output=True,
-                text=True,
-            ).stdout.strip()
-
-            if qr_results:
-                # We were able to decode a QR code without any image manipulation, return the result
-                return qr_results
-            else:
-                # Try scanning with a color invert of the image
-                tmp_qr.seek(0)
-                ImageOps.invert(image.convert("RGB")).save(tmp_qr.name, format="PNG")
-                return subprocess.run(
-                    ["zbarimg", "-q", tmp_qr.name],
-                    capture_output=True,
-                    text=True,
-                ).stdout.strip()
-
     # MARK: Main execution
     def execute(self, request):
         """Main execution point for the service.
@@ -486,18 +781,25 @@ class DocumentPreview(ServiceBase):
         """
         _clear_caches()
         start = time()
+        self.metrics = StageMetrics(self.memory_limit_mb, on_memory_pressure=self.release_memory)
+        self.previews = []
+        self.deadline = Deadline(self.deadline_budget, self.deadline_reserve, self.deadline_costs, log=self.log)
         result = Result()
 
         # Attempt to render documents given and dump them to the working directory
         max_pages = int(request.get_param("max_pages_rendered"))
         save_ocr_output = request.get_param("save_ocr_output").lower()
+        run_ocr_on_first_n_pages = request.get_param("run_ocr_on_first_n_pages")
         try:
-            pdf_paths = self.render_documents(request, max_pages)
-            if pdf_paths:
-                pdf_paths = [(ctx, path) for ctx, path in pdf_paths if path]
-                # Convert PDF to images for ImageSection
-                for context, pdf_path in pdf_paths:
-                    render_pages(pdf_path, self.working_directory, first_page=1, last_page=max_pages, context=context)
+            # Text, images and links are only needed from the PDF if we're going to look for indicators
+            analyses = self.render_previews(
+                request, max_pages, extract=bool(run_ocr_on_first_n_pages), ocr_pages=run_ocr_on_first_n_pages
+            )
+        except BrokenProcessPool:
+            # A rendering worker died (ie. OOM-killed), replace the pool and try again
+            self.render_pool.shutdown(wait=False, cancel_futures=True)
+            self.render_pool = create_render_pool(self.render_workers)
+            raise RecoverableError("Rendering worker terminated unexpectedly, retrying analysis..")
         except Exception as e:  # noqa: BLE001
             # If we run into an error with no message, raise as a recoverable error to try again
             if not str(e):
@@ -506,41 +808,141 @@ class DocumentPreview(ServiceBase):
                 # Unable to complete analysis after unexpected error, log exception and give up
                 self.log.error(e)
                 request.result = result
+                self.report_stage_metrics(request, time() - start)
                 return
         # Create an image gallery section to show the renderings
         image_section = ResultImageSection(request, "Preview Image(s)")
-        run_ocr_on_first_n_pages = request.get_param("run_ocr_on_first_n_pages")
-        previews = [s for s in os.listdir(self.working_directory) if "output" in s]
-        preview_hashes = []
+        rendered_pages = [page for analysis in analyses for page in analysis.pages]
+        # Include any previews that were written directly to disk instead of being rendered (ie. screenshots)
+        rendered_paths = {page.path for page in rendered_pages}
+        previews = rendered_pages + [
+            RenderedPage.from_file(os.path.join(self.working_directory, s))
+            for s in os.listdir(self.working_directory)
+            if s.startswith("output") and os.path.join(self.working_directory, s) not in rendered_paths
+        ]
+        self.previews = previews
+        preview_hashes = set()
+        # Pages that were attached, indexed by how they look, along with their QR results and the pages that were OCRed
+        page_index = None
+        if self.near_duplicates:
+            page_index = PerceptualIndex(self.near_duplicate_distance, self.page_hash_size**2)
+        page_qr_results, page_ocr_pages = {}, set()
 
         if not previews:
             # No previews found, unable to proceed
             request.result = result
+            self.report_stage_metrics(request, time() - start)
             return
 
-        def attach_images_to_section(run_ocr=False) -> str:
-            extracted_text = ""
-            for i, preview in enumerate(natsorted(previews)):
-                fp = os.path.join(self.working_directory, preview)
-                file_bytes = _read_file_bytes(fp)
-                preview_hash = sha256(file_bytes).hexdigest()
-                if preview_hash in preview_hashes:
-                    # We've already added this image, skip it
+        # Extracted text is consumed as it's produced rather than being collected for the end of the analysis
+        indicator_detector = IndicatorDetector()
+        pw_list = set(request.temp_submission_data.get("passwords", []))
+        mentions_click = False
+        extracted_text_path = None
+        if run_ocr_on_first_n_pages and save_ocr_output != "no":
+            # The file is only opened while text is being written to it, so no handle is left open if the analysis fails
+            extracted_text_path = os.path.join(self.working_directory, "ocr_output_dump.txt")
+            with open(extracted_text_path, "w"):
+                pass
+
+        def consume_text(text: str, detect: bool = False) -> None:
+            nonlocal mentions_click
+            if detect:
+                indicator_detector.feed(text)
+
+            # Check the extracted text for any potential passwords as well
+            # Let's make the assumption that a password in a phishing document is likely to be a weak password
+            # Ref: https://www.bleepingcomputer.com/news/security/virustotal-finds-hidden-malware-phishing-campaign-in-svg-files/amp/
+            pw_list.update(
+                {pw for pw in extract_passwords(text) if 3 <= len(pw) <= 20 and pw.isupper() and pw.isalnum()}
+            )
+
+            # Tag any network IOCs found in OCR output
+            self.tag_network_iocs(image_section, text)
+
+            mentions_click = mentions_click or "click" in text.lower()
+            if extracted_text_path:
+                with open(extracted_text_path, "a") as fh:
+                    fh.write(text)
+
+        sorted_previews = natsorted(previews, key=lambda p: p.name)
+
+        def scan_previews() -> dict[str, tuple[str, str]]:
+            new_previews, near_duplicates = {}, {}
+
+            def scan_batch(batch: list[RenderedPage]) -> None:
+                # Pages that look like one that was already seen are matched to it, to reuse its OCR result
+                if page_index is not None:
+                    with self.metrics.stage("page_hash"):
+                        for p in batch:
+                            page_hash = dhash(p.grayscale(), self.page_hash_size)
+                            original = page_index.find(page_hash)
+                            if original:
+                                near_duplicates[p.digest] = original
+                            else:
+                                page_index.add(page_hash, (p.digest, f"{p.context} page {str(p.page_number).zfill(3)}"))
+
+                if self.deadline.allows("qr_scan.pages"):
+                    with self.metrics.stage("qr_scan"):
+                        try:
+                            page_qr_results.update(
+                                zip([p.digest for p in batch], batch_scan_for_QR_codes([p.grayscale() for p in batch]))
+                            )
+                        except QRDecodeError as e:
+                            self.deadline.skip("qr_scan.pages", f"Unable to scan the pages for QR codes: {e}")
+                for p in batch:
+                    p.release_grayscale()
+
+            # New pages are scanned in batches, only holding on to the grayscale copies of one batch at a time
+            batch, batch_bytes = [], 0
+            for p in sorted_previews:
+                if p.digest in new_previews:
+                    continue
+                new_previews[p.digest] = p
+                batch.append(p)
+                batch_bytes += p.width * p.height
+                if batch_bytes >= self.qr_image_bytes:
+                    scan_batch(batch)
+                    batch, batch_bytes = [], 0
+            if batch:
+                scan_batch(batch)
+            return near_duplicates
+
+        def attach_images_to_section(near_duplicates, ocr_keys=None) -> None:
+            run_ocr = bool(ocr_keys)
+            for i, preview in enumerate(sorted_previews):
+                original_digest, original_name = near_duplicates.get(preview.digest, (None, None))
+                # Codes on near-duplicates were already reported with the page they look like, unless it's the code
+                # that differs (ie. a template page sent with a different link)
+                qr_result = page_qr_results.get(preview.digest)
+                if original_digest and qr_result != page_qr_results.get(original_digest):
+                    original_digest, original_name = None, None
+                elif original_digest:
+                    qr_result = None
+                if preview.digest in preview_hashes or (original_digest and self.collapse_near_duplicates):
+                    # We've already added this image (or one that looks just like it), skip it
+                    preview.close()
                     continue
                 else:
-                    preview_hashes.append(preview_hash)
+                    preview_hashes.add(preview.digest)
 
                 ocr_heur_id, ocr_io = None, None
                 if run_ocr:
-                    # Trigger OCR on the first N pages as specified in the submission
-                    ocr_heur_id = 1 if request.deep_scan or (i < run_ocr_on_first_n_pages) else None
+                    # The pages to OCR were picked as the pages were rendered
+                    ocr_heur_id = 1 if (preview.context, preview.page_number) in ocr_keys else None
+                    if ocr_heur_id and i and not self.deadline.allows("ocr.later_pages"):
+                        ocr_heur_id = None
+                    if ocr_heur_id and original_digest in page_ocr_pages:
+                        # The text of the page was already extracted from the page it looks like
+                        ocr_heur_id = None
                     ocr_io = StringIO()
 
-                context, pg_no = preview[7:].split("-")
-                pg_no = pg_no[:-4].zfill(3)
+                context, pg_no = preview.context, str(preview.page_number).zfill(3)
+                description = f"Here's the preview for {context} page {pg_no}"
+                if original_digest:
+                    description += f" (near-duplicate of {original_name})"
 
-                # Analyze the preview to check if there's any QR code we can extract from it
-                qr_result = self.scan_for_QR_codes(Image.open(BytesIO(_read_file_bytes(fp))))
+                # Check if there's any QR code we were able to extract from the preview
                 if qr_result:
                     code_type, code_value = qr_result.split(":", 1)
                     if re.match(FULL_URI, code_value):
@@ -558,128 +960,76 @@ class DocumentPreview(ServiceBase):
                             safelist_interface=self.api_interface,
                         )
 
+                # This is the only time the page gets encoded, as the gallery needs a file to upload
+                with self.metrics.stage("upload"):
+                    fp = preview.save(self.working_directory)
+                # Everything else works from the file, there's no need to keep the pixels around
+                preview.close()
                 img_name = f"page_{pg_no}_{context}.png"
-                image_section.add_image(
-                    fp,
-                    name=img_name,
-                    description=f"Here's the preview for {context} page {pg_no}",
-                    ocr_heuristic_id=ocr_heur_id,
-                    ocr_io=ocr_io,
-                )
-
-                if request.get_param("analyze_render"):
-                    request.add_extracted(
+                with self.metrics.stage("ocr" if ocr_heur_id else "upload"):
+                    image_section.add_image(
                         fp,
                         name=img_name,
-                        description=f"Here's the preview for page {i}",
+                        description=description,
+                        ocr_heuristic_id=ocr_heur_id,
+                        ocr_io=ocr_io,
                     )
+                if ocr_heur_id:
+                    page_ocr_pages.add(preview.digest)
+
+                if request.get_param("analyze_render"):
+                    with self.metrics.stage("upload"):
+                        request.add_extracted(
+                            fp,
+                            name=img_name,
+                            description=f"Here's the preview for page {i}",
+                        )
                 if run_ocr:
-                    extracted_text += f"{ocr_io.read()}\n\n"
-            return extracted_text
+                    consume_text(f"{ocr_io.read()}\n\n")
 
         if not run_ocr_on_first_n_pages:
             # Add all images to section (no need to run OCR)
-            attach_images_to_section()
+            attach_images_to_section(scan_previews())
         else:
             # If we have a PDF at our disposal,
             # try to extract the text from that rather than relying on OCR for everything
-            extracted_text = ""
-            pw_list = set(request.temp_submission_data.get("passwords", []))
-            if pdf_paths:
-                for _, pdf_path in pdf_paths:
-                    embedded_image_paths = self.extract_pdf_images(pdf_path, max_pages)
-                    extracted_text_path = self.extract_pdf_text(pdf_path, max_pages)
+            if analyses:
+                # Each distinct image is only extracted once, however many pages or documents it appears in
+                image_extractor = ImageExtractor(self.working_directory, **self.image_limits)
+                embedded_images, page_texts = [], []
+                for analysis in analyses:
+                    with self.metrics.stage("image_extraction"):
+                        embedded_images.append(image_extractor.extract(analysis))
+                    page_texts.append(list(self.extract_pdf_text(analysis)))
 
                     # Check if we can extract any hyperlinked content from the PDF
-                    doc = _open_fitz_doc(pdf_path)
-                    for page in doc:
-                        for link in page.get_links():
-                            link_uri = link.get("uri", "")
-                            if not link_uri:
-                                continue
-                            if link_uri.startswith("mailto:"):
-                                # Tag email address
-                                image_section.add_tag("network.email.address", link_uri[7:])
-                            else:
-                                # Assume this is a URI
-                                image_section.add_tag("network.static.uri", link_uri)
-
-                    if extracted_text_path is not None:
-                        with open(extracted_text_path, "r") as fh:
-                            extracted_text += fh.read()
-                        # Add all images to section
-                        attach_images_to_section()
-
-                        # We were able to extract content, perform term detection
-                        detections = indicator_detections(extracted_text)
-
-                        # Try to extract any images from the page range and run them through OCR
-                        for image_path in embedded_image_paths:
-                            d = ocr_detections(image_path)
-
-                            # Merge indicator detections
-                            for k in set(list(d.keys()) + list(detections.keys())):
-                                detections[k] = list(set(detections.get(k, []) + d.get(k, [])))
-
-                        if detections:
-                            # If we were able to detect potential passwords, add it to the submission's password list
-                            if detections.get("password"):
-                                [pw_list.update(extract_passwords(pw_string)) for pw_string in detections["password"]]
-
-                            heuristic = Heuristic(
-                                1,
-                                signatures={f"{k}_strings": len(v) for k, v in detections.items()},
-                            )
-                            ocr_section = ResultKeyValueSection(
-                                f"Suspicious strings found during OCR analysis on file {request.file_name}"
-                            )
-                            ocr_section.set_heuristic(heuristic)
-                            for k, v in detections.items():
-                                ocr_section.set_item(k, v)
-                            image_section.add_subsection(ocr_section)
-                    else:
-                        # Unable to extract text from PDF, run it through Tesseract for term detection
-                        extracted_text += attach_images_to_section(run_ocr=True)
+                    for link_uri in analysis.links:
+                        if link_uri.startswith("mailto:"):
+                            # Tag email address
+                            image_section.add_tag("network.email.address", link_uri[7:])
+                        else:
+                            # Assume this is a URI
+                            image_section.add_tag("network.static.uri", link_uri)
 
+                # QR codes and text are quick to go through compared to OCR, so they're all done before any OCR runs
+                near_duplicates = scan_previews()
+                for images in embedded_images:
                     # Check for the presence of any QR codes embedded in the document
-                    embedded_images = [Image.open(image_path) for image_path in embedded_image_paths]
+                    # This includes codes that were split into several images to deter scanning
                     qr_code_detections = []
-                    for index, image in enumerate(embedded_images):
-                        ratio = image.size[0] / image.size[1]
-                        if image.size[0] == image.size[1]:
-                            # Image is a perfect square, let's check if it's a QR code
-                            qr_result = self.scan_for_QR_codes(image)
-                            if qr_result:
-                                qr_code_detections.append(qr_result)
-
-                        # Check if the ratio between the height and width is 1:2 or vice-versa
-                        # This could be a technique to deter tools that scan images in a document for QR codes,
-                        elif ratio in [0.5, 2.0]:
-                            # Image has a 1:2 or 2:1 ratio, let's check if we can find their other half
-
-                            # Make sure we're not going out of bounds of the embedded images
-                            # when looking for the other half
-                            if index + 1 >= len(embedded_images):
-                                continue
-
-                            for other_half in embedded_images[index + 1 :]:
-                                if image.size == other_half.size:
-                                    # We found the other half, let's combine them and check if it's a QR code
-                                    size = max(image.size[0], image.size[1])
-                                    combined_image = Image.new("RGB", (size, size))
-                                    if ratio == 0.5:
-                                        # Image is taller than it is wider, stack them side-by-side
-                                        combined_image.paste(image, (0, 0))
-                                        combined_image.paste(other_half, (image.size[0], 0))
-                                    else:
-                                        # Image is wider than it is taller, stack them top-to-bottom
-                                        combined_image.paste(image, (0, 0))
-                                        combined_image.paste(other_half, (0, image.size[1]))
-
-                                    qr_result = self.scan_for_QR_codes(combined_image)
-                                    if qr_result:
-                                        qr_code_detections.append(qr_result)
-                                    break
+                    if self.deadline.allows("qr_scan.embedded_images"):
+                        with self.metrics.stage("qr_scan"):
+                            qr_candidates = iter_qr_candidates(
+                                images, self.qr_max_combinations, max_bytes=self.qr_image_bytes
+                            )
+                            try:
+                                qr_code_detections = scan_qr_candidates(
+                                    qr_candidates, max_batch_bytes=self.qr_image_bytes
+                                )
+                            except QRDecodeError as e:
+                                self.deadline.skip(
+                                    "qr_scan.embedded_images", f"Unable to scan the embedded images for QR codes: {e}"
+                                )
 
                     # If there are QR code detections, include it as part of the output
                     for i, detection in enumerate(qr_code_detections):
@@ -699,49 +1049,92 @@ class DocumentPreview(ServiceBase):
                                 safelist_interface=self.api_interface,
                             )
 
+                # We were able to extract content, perform term detection page by page
+                # Detections build up from one document to the next, as if their text was one
+                text_detections = []
+                for texts in page_texts:
+                    if texts and self.deadline.allows("text_extraction"):
+                        with self.metrics.stage("text_extraction"):
+                            for page_text in texts:
+                                consume_text(page_text, detect=True)
+                    text_detections.append(indicator_detector.detections)
+
+                # Add all images to section, running OCR on the pages that are mostly images, or on all the pages if we
+                # were unable to extract text from the PDF
+                if self.is_captured(request):
+                    page_keys = [(preview.context, preview.page_number) for preview in previews]
+                else:
+                    page_keys = [
+                        (analysis.context, page_number)
+                        for analysis in analyses
+                        for page_number in analysis.page_numbers
+                    ]
+                ocr_keys = self.select_ocr_pages(request, analyses, page_keys, run_ocr_on_first_n_pages)
+                self.log.debug(f"{len(ocr_keys)} of {len(page_keys)} page(s) picked for OCR")
+                attach_images_to_section(near_duplicates, ocr_keys)
+
+                for images, texts, detections in zip(embedded_images, page_texts, text_detections):
+                    if not texts:
+                        continue
+
+                    # Try to extract any images from the page range and run them through OCR
+                    image_detections = {}
+                    if self.deadline.allows("ocr.embedded_images"):
+                        with self.metrics.stage("ocr"):
+                            image_detections = self.embedded_ocr.detections(images, self.deadline)
+                    for k, v in image_detections.items():
+                        # Merge indicator detections
+                        detections[k] = list(dict.fromkeys(detections.get(k, []) + v))
+
+                    if detections:
+                        # If we were able to detect potential passwords, add it to the submission's password list
+                        if detections.get("password"):
+                            [pw_list.update(extract_passwords(pw_string)) for pw_string in detections["password"]]
+
+                        heuristic = Heuristic(
+                            1,
+                            signatures={f"{k}_strings": len(v) for k, v in detections.items()},
+                        )
+                        ocr_section = ResultKeyValueSection(
+                            f"Suspicious strings found during OCR analysis on file {request.file_name}"
+                        )
+                        ocr_section.set_heuristic(heuristic)
+                        for k, v in detections.items():
+                            ocr_section.set_item(k, v)
+                        image_section.add_subsection(ocr_section)
+
             else:
                 # Extract text via OCR for non-PDF documents (images)
-                attach_images_to_section(run_ocr=True)
-
-            # Check the extracted text for any potential passwords as well
-            # Let's make the assumption that a password in a phishing document is likely to be a weak password
-            # Ref: https://www.bleepingcomputer.com/news/security/virustotal-finds-hidden-malware-phishing-campaign-in-svg-files/amp/
-            pw_list.update(
-                {pw for pw in extract_passwords(extracted_text) if 3 <= len(pw) <= 20 and pw.isupper() and pw.isalnum()}
-            )
+                page_keys = [(preview.context, preview.page_number) for preview in previews]
+                attach_images_to_section(
+                    scan_previews(), self.select_ocr_pages(request, analyses, page_keys, run_ocr_on_first_n_pages)
+                )
 
             if pw_list:
                 request.temp_submission_data["passwords"] = sorted(pw_list)
 
-            # Tag any network IOCs found in OCR output
-            self.tag_network_iocs(image_section, extracted_text)
-
             # Write OCR output as specified by submissions params
             if save_ocr_output == "no":
                 pass
             else:
-                with tempfile.NamedTemporaryFile("w", delete=False, suffix=".txt") as extracted_text_fh:
-                    extracted_text_fh.write(extracted_text)
-                    extracted_text_fh.flush()
-
-                    # Write content to disk to be uploaded
-                    add_params = {
-                        "path": extracted_text_fh.name,
-                        "name": "ocr_output_dump",
-                        "description": "OCR Output",
-                    }
-                    if save_ocr_output == "as_extracted":
-                        request.add_extracted(**add_params)
-                    elif save_ocr_output == "as_supplementary":
-                        request.add_supplementary(**add_params)
-                    else:
-                        self.log.warning(f"Unknown save method for OCR given: {save_ocr_output}")
+                # Write content to disk to be uploaded
+                add_params = {
+                    "path": extracted_text_path,
+                    "name": "ocr_output_dump",
+                    "description": "OCR Output",
+                }
+                if save_ocr_output == "as_extracted":
+                    request.add_extracted(**add_params)
+                elif save_ocr_output == "as_supplementary":
+                    request.add_supplementary(**add_params)
+                else:
+                    self.log.warning(f"Unknown save method for OCR given: {save_ocr_output}")
 
             # Check to see if we're dealing with a suspicious PDF
             if request.file_type == "document/pdf":
                 try:
                     doc = _open_fitz_doc(request.file_path)
-                    if doc.page_count == 1 and "click" in extracted_text.lower():
+                    if doc.page_count == 1 and mentions_click:
                         # Suspected document is part of a phishing campaign
                         ResultTextSection(
                             "Suspected Phishing",
@@ -752,7 +1145,67 @@ class DocumentPreview(ServiceBase):
                 except Exception:  # noqa: BLE001, S110
                     # There was a problem fetching the page count from the PDF, move on..
                     pass
+
+        if self.deadline.skipped:
+            # Let analysts know the result is partial, each stage says whether it ran out of time or into another limit
+            skipped_section = ResultKeyValueSection("Parts of the analysis were skipped", parent=result)
+            for stage, reason in self.deadline.skipped.items():
+                skipped_section.set_item(stage, reason)
         image_section.promote_as_screenshot()
         result.add_section(image_section)
         request.result = result
-        self.log.debug(f"Runtime: {time() - start}s")
+        [preview.close() for preview in previews]
+        self.previews = []
+        self.report_stage_metrics(request, time() - start)
+
+    # MARK: Instrumentation
+    def release_memory(self, stage: str) -> None:
+        """Release what memory can be released once the service runs low on it.
+
+        Args:
+            stage (str): The stage that just ended.
+        """
+        self.log.warning(f"Running low on memory after {stage}, releasing cached documents and pages")
+        # Pages waiting to be attached are written out now instead of when they're attached, and are only loaded back
+        # if they're scanned again
+        for preview in self.previews:
+            preview.release(self.working_directory)
+        release_documents()
+        release_free_memory()
+
+    def log_stage_totals(self) -> None:
+        """Log the totals of each stage across the analyses since the service started."""
+        totals = {
+            stage: {key: round(value, 3) for key, value in stage_total.items()}
+            for stage, stage_total in stage_totals().items()
+        }
+        self.log.info(f"Stage totals: {json.dumps({'analyses': self.analyses, 'stages': totals})}")
+
+    def report_stage_metrics(self, request: Request, runtime: float) -> None:
+        """Log the time and resources used by each stage of the analysis, and attach them if configured to.
+
+        Args:
+            request (Request): The service request object containing parameters and file information.
+            runtime (float): The total time taken by the analysis, in seconds.
+        """
+        stage_metrics = {
+            "sha256": request.sha256,
+            "file_type": request.file_type,
+            "runtime_s": round(runtime, 3),
+            "stages": self.metrics.as_dict(),
+            "skipped": self.deadline.skipped,
+        }
+        self.log.info(f"Stage metrics: {json.dumps(stage_metrics)}")
+        self.analyses += 1
+        if self.stage_totals_interval and self.analyses % self.stage_totals_interval == 0:
+            self.log_stage_totals()
+
+        if self.stage_metrics_supplementary:
+            metrics_path = os.path.join(self.working_directory, "stage_metrics.json")
+            with open(metrics_path, "w") as fh:
+                json.dump(stage_metrics, fh, indent=2)
+            request.add_supplementary(
+                metrics_path,
+                name="stage_metrics.json",
+                description="Time and resources used by each stage of the analysis",
+            )
@@ -0,0 +1,314 @@
+"""Extraction of images embedded in documents."""
+
+import logging
+import os
+import shutil
+import zlib
+from hashlib import sha256
+from zipfile import BadZipFile, ZipFile, ZipInfo
+
+import fitz
+
+from document_preview.render import DocumentAnalysis, _open_fitz_doc
+
+# Number of bytes needed to recognize an image from its header, enough to get past the prolog of most SVG images
+SNIFF_BYTES = 4096
+
+# Magic bytes of the image formats found in documents, by offset
+IMAGE_SIGNATURES = [
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"GIF87a"),
+    (0, b"GIF89a"),
+    (0, b"BM"),  # Bitmap
+    (0, b"II*\x00"),  # TIFF (little-endian)
+    (0, b"MM\x00*"),  # TIFF (big-endian)
+    (0, b"II\xbc"),  # JPEG XR/HD Photo
+    (0, b"\x00\x00\x00\x0cjP  \r\n\x87\n"),  # JPEG 2000
+    (0, b"\xffO\xffQ"),  # JPEG 2000 codestream
+    (0, b"\x00\x00\x01\x00"),  # Icon
+    (0, b"\xd7\xcd\xc6\x9a"),  # Placeable WMF
+    (0, b"\x01\x00\x09\x00"),  # WMF
+    (0, b"\x02\x00\x09\x00"),  # WMF
+    (40, b" EMF"),
+    (8, b"WEBP"),
+]
+
+# Major brands of the HEIF and AVIF images, which are ISO media files
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif", b"avis"}
+
+
+def _is_svg(header: bytes) -> bool:
+    """Check whether the header of a file is the start of an SVG image.
+
+    Args:
+        header (bytes): The first SNIFF_BYTES of the file.
+
+    Returns:
+        bool: Whether the root element of the XML document is an SVG image.
+
+    """
+    data = header.removeprefix(b"\xef\xbb\xbf").lstrip()
+    # Skip over the XML declaration, processing instructions, comments and DOCTYPE that may come before the root
+    while data[:4].lower() != b"<svg":
+        if data.startswith(b"<?"):
+            end = data.find(b"?>")
+        elif data.startswith(b"<!--"):
+            end = data.find(b"-->")
+        elif data[:9].upper() == b"<!DOCTYPE":
+            # The internal subset holds declarations of its own, the DOCTYPE only ends after it
+            end = data.find(b">")
+            subset = data.find(b"[", 0, end if end >= 0 else len(data))
+            if subset >= 0:
+                subset_end = data.find(b"]", subset)
+                end = data.find(b">", subset_end) if subset_end >= 0 else -1
+        else:
+            return False
+        if end < 0:
+            # Prolog goes on past the header
+            return False
+        data = data[data.index(b">", end) + 1 :].lstrip()
+    return data[4:5] in (b"", b">", b"/") or data[4:5].isspace()
+
+
+def is_image(header: bytes) -> bool:
+    """Check whether the header of a file belongs to an image.
+
+    Args:
+        header (bytes): The first SNIFF_BYTES of the file.
+
+    Returns:
+        bool: Whether the file is an image.
+
+    """
+    if any(header.startswith(magic, offset) for offset, magic in IMAGE_SIGNATURES):
+        return True
+    if header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS:
+        return True
+    return _is_svg(header)
+
+
+def _extract_media_image(zf: ZipFile, media: ZipInfo, output_directory: str) -> str | None:
+    """Extract a media file from an Office document if it's an image.
+
+    Args:
+        zf (ZipFile): The Office document.
+        media (ZipInfo): The media file.
+        output_directory (str): The directory to extract to, the path of the media file is kept.
+
+    Returns:
+        str | None: The path of the extracted image, or None if it's not an image.
+
+    """
+    with zf.open(media) as src:
+        header = src.read(SNIFF_BYTES)
+        if not is_image(header):
+            return None
+
+        # Sanitize the path the same way ZipFile.extract() does
+        parts = [part for part in media.filename.split("/") if part not in ("", os.path.curdir, os.path.pardir)]
+        media_path = os.path.join(output_directory, *parts)
+        os.makedirs(os.path.dirname(media_path), exist_ok=True)
+        with open(media_path, "wb") as dst:
+            dst.write(header)
+            shutil.copyfileobj(src, dst)
+    return media_path
+
+
+def extract_office_images(
+    fp: str,
+    output_directory: str,
+    max_members: int = 500,
+    max_member_size: int = 50 * 1024 * 1024,
+    max_total_size: int = 250 * 1024 * 1024,
+    log: logging.Logger | None = None,
+) -> list[tuple[str, str]]:
+    """Extract the images from the media of an Office document.
+
+    Media is identified from its header as it's streamed out of the document, only images are written to disk.
+
+    Args:
+        fp (str): The path to the Office document.
+        output_directory (str): The directory to extract to.
+        max_members (int, optional): The most distinct media files to look at. Defaults to 500.
+        max_member_size (int, optional): Skip media files larger than this many bytes. Defaults to 50MB.
+        max_total_size (int, optional): Stop once the images extracted would take more than this many bytes, which
+            guards against zip bombs. Defaults to 250MB.
+        log (logging.Logger, optional): The logger to use. Defaults to None.
+
+    Returns:
+        list[tuple[str, str]]: The path each image was extracted to, and its name in the document.
+
+    """
+    log = log or logging.getLogger(__name__)
+    images = []
+    try:
+        with ZipFile(fp, "r") as zf:
+            seen, total_size = set(), 0
+            for media in zf.infolist():
+                if media.is_dir():
+                    # Skipping directories
+                    continue
+                elif "/media/" not in media.filename:
+                    # Not a media file, skip
+                    continue
+                elif (media.CRC, media.file_size) in seen:
+                    # Same content as media we've already looked at
+                    continue
+
+                seen.add((media.CRC, media.file_size))
+                if len(seen) > max_members:
+                    log.warning(f"Office document has too many media files, checked the first {len(seen) - 1}")
+                    break
+                elif media.file_size > max_member_size:
+                    continue
+                elif total_size + media.file_size > max_total_size:
+                    # Possible zip bomb
+                    log.warning("Office document media is too large to extract in full")
+                    break
+
+                try:
+                    media_path = _extract_media_image(zf, media, output_directory)
+                except (BadZipFile, EOFError, NotImplementedError, OSError, zlib.error) as e:
+                    log.debug(f"Unable to extract {media.filename}: {e}")
+                    continue
+                if media_path:
+                    total_size += media.file_size
+                    images.append((media_path, media.filename))
+    except BadZipFile:
+        # Can't extract media from the file, likely not a valid Office document
+        pass
+    return images
+
+
+class ExtractedImage:
+    """An image embedded in a document, written out to disk."""
+
+    def __init__(self, path: str, width: int, height: int, digest: str) -> None:
+        """Initialize the image.
+
+        Args:
+            path (str): The path the image was written to.
+            width (int): The width of the image, in pixels.
+            height (int): The height of the image, in pixels.
+            digest (str): The SHA256 of the image's content.
+
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self.digest = digest
+        # Pages the image appears on, in the order they were visited
+        self.pages: list[int] = []
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """The width and height of the image, in pixels."""
+        return self.width, self.height
+
+
+class ImageExtractor:
+    """Extracts each distinct image embedded in documents once, skipping images outside of the size limits."""
+
+    def __init__(
+        self,
+        output_directory: str,
+        min_dimension: int = 16,
+        max_dimension: int = 10000,
+        max_bytes: int = 20 * 1024 * 1024,
+    ) -> None:
+        """Initialize the extractor.
+
+        Args:
+            output_directory (str): The directory to write images to.
+            min_dimension (int, optional): Skip images narrower or shorter than this many pixels. Defaults to 16.
+            max_dimension (int, optional): Skip images wider or taller than this many pixels, 0 for no limit.
+                Defaults to 10000.
+            max_bytes (int, optional): Skip images whose data is larger than this, 0 for no limit. Defaults to 20MB.
+
+        """
+        self.output_directory = output_directory
+        self.min_dimension = min_dimension
+        self.max_dimension = max_dimension
+        self.max_bytes = max_bytes
+        # Images by content, and by the document and xref they were extracted from (None if it was skipped)
+        self.images: dict[str, ExtractedImage] = {}
+        self._xrefs: dict[tuple[str, int], ExtractedImage | None] = {}
+
+    def _within_limits(self, width: int, height: int, size: int | None = None) -> bool:
+        """Check an image against the size limits.
+
+        Args:
+            width (int): The width of the image, in pixels.
+            height (int): The height of the image, in pixels.
+            size (int, optional): The size of the image's data, if known. Defaults to None.
+
+        Returns:
+            bool: Whether the image should be extracted.
+
+        """
+        if min(width, height) < self.min_dimension:
+            return False
+        if self.max_dimension and max(width, height) > self.max_dimension:
+            return False
+        return not (self.max_bytes and size is not None and size > self.max_bytes)
+
+    def extract(self, analysis: DocumentAnalysis) -> list[ExtractedImage]:
+        """Extract the images found on the pages of a document.
+
+        Args:
+            analysis (DocumentAnalysis): The image references collected from the pages of the document.
+
+        Returns:
+            list[ExtractedImage]: The images that hadn't already been extracted, in the order they appear.
+
+        """
+        doc = _open_fitz_doc(analysis.path)
+        new_images = []
+        for page_number, page_images in zip(analysis.page_numbers, analysis.images):
+            for xref, width, height in page_images:
+                key = (analysis.path, xref)
+                if key not in self._xrefs:
+                    self._xrefs[key] = image = self._extract_xref(doc, xref, width, height)
+                    if image and not image.pages:
+                        new_images.append(image)
+                image = self._xrefs[key]
+                if image and page_number not in image.pages:
+                    image.pages.append(page_number)
+        return new_images
+
+    def _extract_xref(self, doc: fitz.Document, xref: int, width: int, height: int) -> ExtractedImage | None:
+        """Extract an image from a document, unless it's outside of the limits or a copy of another image.
+
+        Args:
+            doc (fitz.Document): The document.
+            xref (int): The xref of the image.
+            width (int): The width of the image, in pixels.
+            height (int): The height of the image, in pixels.
+
+        Returns:
+            ExtractedImage | None: The image, or None if it was skipped.
+
+        """
+        # Check what we can before paying to decode the image
+        length_type, length = doc.xref_get_key(xref, "Length")
+        if not self._within_limits(width, height, int(length) if length_type == "int" else None):
+            return None
+
+        base_image = doc.extract_image(xref)
+        if not base_image:
+            return None
+        image_data = base_image["image"]
+        if not self._within_limits(base_image["width"], base_image["height"], len(image_data)):
+            return None
+
+        digest = sha256(image_data).hexdigest()
+        if digest in self.images:
+            # Same image stored under a different xref
+            return self.images[digest]
+
+        output_path = os.path.join(self.output_directory, f"extracted_image-{len(self.images):03d}.{base_image['ext']}")
+        with open(output_path, "wb") as f:
+            f.write(image_data)
+        self.images[digest] = ExtractedImage(output_path, base_image["width"], base_image["height"], digest)
+        return self.images[digest]
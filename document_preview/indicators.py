@@ -0,0 +1,48 @@
+"""Incremental indicator detection over text as it's extracted."""
+
+from assemblyline_v4_service.common.ocr import OCR_INDICATORS_TERMS, OCR_INDICATORS_THRESHOLD
+
+
+class IndicatorDetector:
+    """Equivalent of the service base's OCR `detections`, fed one chunk of text at a time.
+
+    Chunks are expected to end on a line boundary (ie. the text of a page).
+    """
+
+    def __init__(self) -> None:
+        """Initialize the detector."""
+        # Terms of each indicator that were found, and the lines they were found on (in order of appearance)
+        self._hits: dict[str, set[str]] = {indicator: set() for indicator in OCR_INDICATORS_TERMS}
+        self._lines: dict[str, dict[str, None]] = {indicator: {} for indicator in OCR_INDICATORS_TERMS}
+        self._terms = {
+            indicator: [(term, term.lower()) for term in terms] for indicator, terms in OCR_INDICATORS_TERMS.items()
+        }
+
+    def feed(self, chunk: str) -> None:
+        """Scan a chunk of text for indicator terms.
+
+        Args:
+            chunk (str): The text to scan.
+
+        """
+        lowered_chunk = chunk.lower()
+        for indicator, terms in self._terms.items():
+            # Perform a pre-check to see if the terms even exist in the chunk
+            if not any(lowered_term in lowered_chunk for _, lowered_term in terms):
+                continue
+
+            for line in chunk.split("\n"):
+                lowered_line = line.lower()
+                found = [term for term, lowered_term in terms if lowered_term in lowered_line]
+                if found:
+                    self._hits[indicator].update(found)
+                    self._lines[indicator][line] = None
+
+    @property
+    def detections(self) -> dict[str, list[str]]:
+        """The lines of each indicator that met its hit threshold."""
+        return {
+            indicator: list(lines)
+            for indicator, lines in self._lines.items()
+            if lines and len(self._hits[indicator]) >= OCR_INDICATORS_THRESHOLD.get(indicator, 1)
+        }
@@ -0,0 +1,148 @@
+"""Memory accounting and caches bounded by the memory they hold."""
+
+import ctypes
+import ctypes.util
+import gc
+import os
+import resource
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"))
+    _malloc_trim = _libc.malloc_trim
+except (OSError, AttributeError, TypeError):
+    # Not glibc, freed memory is returned to the OS by the allocator on its own terms
+    _malloc_trim = None
+
+
+def current_rss_mb() -> float:
+    """Get the resident memory of the service process right now.
+
+    Returns:
+        float: The resident set size in MB, or 0 if it can't be read.
+
+    """
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE / (1024 * 1024)
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    """Get the peak resident memory of the service process since it started, or since the peak was last reset.
+
+    Returns:
+        float: The peak resident set size in MB.
+
+    """
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    # Never reset, reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of the service process to its current resident memory.
+
+    Returns:
+        bool: Whether the peak was reset, which isn't supported on kernels older than 4.0 (or outside of Linux).
+
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def release_free_memory() -> None:
+    """Collect garbage and hand memory that's been freed back to the OS."""
+    gc.collect()
+    if _malloc_trim:
+        _malloc_trim(0)
+
+
+class ByteBudgetCache:
+    """A least-recently-used cache bounded by the size of its values rather than how many there are.
+
+    Values larger than the whole budget are returned to the caller without being cached.
+    """
+
+    def __init__(
+        self, max_bytes: int, sizeof: Callable[[Any], int], close: Callable[[Any], None] | None = None
+    ) -> None:
+        """Initialize the cache.
+
+        Args:
+            max_bytes (int): The total size of the values that can be cached.
+            sizeof (Callable[[Any], int]): Estimates the memory held by a value, in bytes.
+            close (Callable[[Any], None], optional): Releases what a value holds when the cache is cleared. Evicted
+                values may still be in use by whoever loaded them, and are left to be garbage collected.
+                Defaults to None.
+
+        """
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.close = close
+        self.size = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Get the number of cached values.
+
+        Returns:
+            int: The number of cached values.
+
+        """
+        return len(self._entries)
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """Get a cached value, loading and caching it if it isn't cached.
+
+        Args:
+            key (Hashable): The key of the value.
+            load (Callable[[], Any]): Loads the value.
+
+        Returns:
+            Any: The value.
+
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        value = load()
+        size = self.sizeof(value)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self.size += size
+                # Evict the least recently used values until everything fits
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return value
+
+    def clear(self) -> None:
+        """Drop every cached value, closing them if the cache was given a way to."""
+        with self._lock:
+            values = [value for value, _ in self._entries.values()]
+            self._entries.clear()
+            self.size = 0
+        if self.close:
+            for value in values:
+                self.close(value)
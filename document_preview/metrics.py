@@ -0,0 +1,139 @@
+"""Per-stage timing and resource usage."""
+
+import threading
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from time import perf_counter, thread_time
+
+from document_preview.memory import current_rss_mb, peak_rss_mb, reset_peak_rss
+
+# Totals of every stage since the service started, logged by the service every so often and when it stops
+STAGE_TOTALS: dict[str, dict[str, float]] = {}
+_totals_lock = threading.Lock()
+
+# Peak memory seen by each stage that's running, across all threads. The peak of the process is reset whenever a
+# stage starts, so it's first folded into the peaks of the stages already running.
+_running_peaks: list[list[float]] = []
+_peaks_lock = threading.Lock()
+
+
+def _fold_peak() -> None:
+    """Fold the peak memory of the process into the peaks of the running stages (with _peaks_lock held)."""
+    peak = peak_rss_mb()
+    for running in _running_peaks:
+        running[0] = max(running[0], peak)
+
+
+def _start_peak() -> list[float]:
+    """Start tracking the peak memory of a stage.
+
+    Returns:
+        list[float]: The peak of the stage so far, updated as other stages start and end.
+
+    """
+    with _peaks_lock:
+        _fold_peak()
+        # Without a reset the peak is the one of the whole process, which is all that can be measured
+        reset_peak_rss()
+        running = [current_rss_mb()]
+        _running_peaks.append(running)
+        return running
+
+
+def _end_peak(running: list[float]) -> float:
+    """Stop tracking the peak memory of a stage.
+
+    Args:
+        running (list[float]): What was returned when the stage started.
+
+    Returns:
+        float: The peak resident memory of the process while the stage ran, in MB.
+
+    """
+    with _peaks_lock:
+        _fold_peak()
+        _running_peaks.remove(running)
+        return running[0]
+
+
+def stage_totals() -> dict[str, dict[str, float]]:
+    """Get a snapshot of the totals of every stage since the service started.
+
+    Returns:
+        dict[str, dict[str, float]]: The number of calls, wall time and CPU time of each stage.
+
+    """
+    with _totals_lock:
+        return {stage: dict(totals) for stage, totals in STAGE_TOTALS.items()}
+
+
+class StageMetrics:
+    """Wall time, CPU time and peak memory of each stage of an analysis.
+
+    CPU time is what the stage used in the service process, work done by other processes (ie. DocBuilder, Chrome,
+    Tesseract) only shows up in the wall time. Memory is that of the service process: its peak while the stage ran
+    (which includes anything running alongside it), along with its resident memory when the stage ended and how much
+    that grew during the stage.
+    """
+
+    def __init__(self, memory_limit_mb: float = 0, on_memory_pressure: Callable[[str], None] | None = None) -> None:
+        """Initialize the metrics.
+
+        Args:
+            memory_limit_mb (float, optional): The resident memory past which on_memory_pressure is called at the end
+                of a stage, 0 for no limit. Defaults to 0.
+            on_memory_pressure (Callable[[str], None], optional): Releases what memory it can, given the name of the
+                stage that ended. Defaults to None.
+
+        """
+        self.stages: dict[str, dict[str, float]] = {}
+        self.memory_limit_mb = memory_limit_mb
+        self.on_memory_pressure = on_memory_pressure
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        """Measure a stage, adding to its totals if it runs more than once.
+
+        Args:
+            name (str): The name of the stage.
+
+        """
+        running_peak = _start_peak()
+        wall_start, cpu_start, rss_start = perf_counter(), thread_time(), current_rss_mb()
+        try:
+            yield
+        finally:
+            wall, cpu = perf_counter() - wall_start, thread_time() - cpu_start
+            rss_mb, stage_peak_mb = current_rss_mb(), _end_peak(running_peak)
+            with self._lock:
+                metrics = self.stages.setdefault(
+                    name,
+                    {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rss_mb": 0.0, "rss_growth_mb": 0.0, "peak_rss_mb": 0.0},
+                )
+                metrics["calls"] += 1
+                metrics["wall_s"] += wall
+                metrics["cpu_s"] += cpu
+                metrics["rss_mb"] = max(metrics["rss_mb"], rss_mb)
+                metrics["rss_growth_mb"] = max(metrics["rss_growth_mb"], rss_mb - rss_start)
+                metrics["peak_rss_mb"] = max(metrics["peak_rss_mb"], stage_peak_mb)
+            with _totals_lock:
+                totals = STAGE_TOTALS.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+                totals["calls"] += 1
+                totals["wall_s"] += wall
+                totals["cpu_s"] += cpu
+            if self.memory_limit_mb and self.on_memory_pressure and rss_mb > self.memory_limit_mb:
+                self.on_memory_pressure(name)
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        """Get the metrics of each stage, rounded for reporting.
+
+        Returns:
+            dict[str, dict[str, float]]: The metrics of each stage, in the order the stages first ran.
+
+        """
+        with self._lock:
+            return {
+                stage: {key: round(value, 3) for key, value in metrics.items()}
+                for stage, metrics in self.stages.items()
+            }
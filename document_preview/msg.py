@@ -0,0 +1,329 @@
+"""Conversion of Outlook messages (MSG) to email messages, without going through msgconvert."""
+
+import codecs
+import struct
+from datetime import UTC, datetime, timedelta
+from email.message import EmailMessage
+from email.parser import HeaderParser
+from email.utils import format_datetime, formataddr
+
+import olefile
+
+# MAPI properties used to put the message back together
+PR_MESSAGE_CLASS = 0x001A
+PR_SUBJECT = 0x0037
+PR_CLIENT_SUBMIT_TIME = 0x0039
+PR_SENT_REPRESENTING_NAME = 0x0042
+PR_SENT_REPRESENTING_EMAIL_ADDRESS = 0x0065
+PR_TRANSPORT_MESSAGE_HEADERS = 0x007D
+PR_SENDER_NAME = 0x0C1A
+PR_SENDER_EMAIL_ADDRESS = 0x0C1F
+PR_RECIPIENT_TYPE = 0x0C15
+PR_MESSAGE_DELIVERY_TIME = 0x0E06
+PR_BODY = 0x1000
+PR_HTML = 0x1013
+PR_INTERNET_MESSAGE_ID = 0x1035
+PR_DISPLAY_NAME = 0x3001
+PR_EMAIL_ADDRESS = 0x3003
+PR_ATTACH_DATA = 0x3701
+PR_ATTACH_FILENAME = 0x3704
+PR_ATTACH_LONG_FILENAME = 0x3707
+PR_ATTACH_MIME_TAG = 0x370E
+PR_ATTACH_CONTENT_ID = 0x3712
+PR_SMTP_ADDRESS = 0x39FE
+PR_INTERNET_CPID = 0x3FDE
+PR_MESSAGE_CODEPAGE = 0x3FFD
+PR_SENDER_SMTP_ADDRESS = 0x5D01
+
+# Property types
+PT_LONG = 0x0003
+PT_SYSTIME = 0x0040
+PT_STRING8 = 0x001E
+PT_UNICODE = 0x001F
+PT_BINARY = 0x0102
+
+# Recipient types
+MAPI_TO, MAPI_CC = 1, 2
+
+# Size of the header in front of the fixed-length properties of the message, its recipients and attachments
+PROPERTIES_STREAM = "__properties_version1.0"
+MESSAGE_PROPERTIES_HEADER = 32
+CHILD_PROPERTIES_HEADER = 8
+
+# Headers taken as-is from the ones the message was received with, the rest describe the original MIME structure
+TRANSPORT_HEADERS = ["From", "Sender", "Reply-To", "To", "Cc", "Date", "Subject", "Message-ID"]
+
+# Code pages that Python doesn't know by their number
+CODEPAGES = {1200: "utf-16-le", 20127: "ascii", 28591: "latin-1", 50220: "iso2022_jp", 65001: "utf-8"}
+
+
+class MsgParseError(Exception):
+    """Raised when an Outlook message can't be converted to an email message."""
+
+
+def _codec(codepage: int | None, default: str = "cp1252") -> str:
+    """Get the Python codec of a Windows code page.
+
+    Args:
+        codepage (int | None): The code page.
+        default (str, optional): The codec to use if the code page is unknown. Defaults to "cp1252".
+
+    Returns:
+        str: The name of the codec.
+
+    """
+    name = CODEPAGES.get(codepage, f"cp{codepage}")
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return default
+
+
+def _filetime(value: int) -> datetime | None:
+    """Convert a FILETIME (100ns intervals since 1601) to a datetime.
+
+    Args:
+        value (int): The FILETIME.
+
+    Returns:
+        datetime | None: The time, or None if it isn't set.
+
+    """
+    if not value:
+        return None
+    try:
+        return datetime(1601, 1, 1, tzinfo=UTC) + timedelta(microseconds=value // 10)
+    except OverflowError:
+        return None
+
+
+class _Storage:
+    """The properties of a message, recipient or attachment, stored in an OLE storage."""
+
+    def __init__(self, ole: olefile.OleFileIO, path: list[str], header_size: int, encoding: str) -> None:
+        """Read the fixed-length properties of the storage.
+
+        Args:
+            ole (olefile.OleFileIO): The Outlook message.
+            path (list[str]): The path of the storage, empty for the message itself.
+            header_size (int): The size of the header in front of the fixed-length properties.
+            encoding (str): The codec of the 8-bit strings in the storage.
+
+        """
+        self.ole = ole
+        self.path = path
+        self.encoding = encoding
+        self.fixed: dict[int, bytes] = {}
+        properties = self._read(PROPERTIES_STREAM) or b""
+        for offset in range(header_size, len(properties) - 15, 16):
+            tag, _, value = struct.unpack_from("<II8s", properties, offset)
+            self.fixed[tag] = value
+
+    def _read(self, name: str) -> bytes | None:
+        """Read a stream of the storage.
+
+        Args:
+            name (str): The name of the stream.
+
+        Returns:
+            bytes | None: The content of the stream, or None if it doesn't exist.
+
+        """
+        path = [*self.path, name]
+        if self.ole.exists("/".join(path)) and self.ole.get_type(path) == olefile.STGTY_STREAM:
+            return self.ole.openstream(path).read()
+        return None
+
+    def binary(self, property_id: int) -> bytes | None:
+        """Get a binary property.
+
+        Args:
+            property_id (int): The ID of the property.
+
+        Returns:
+            bytes | None: The value, or None if it isn't set.
+
+        """
+        return self._read(f"__substg1.0_{property_id:04X}{PT_BINARY:04X}")
+
+    def string(self, property_id: int) -> str | None:
+        """Get a string property, stored either as Unicode or 8-bit.
+
+        Args:
+            property_id (int): The ID of the property.
+
+        Returns:
+            str | None: The value, or None if it isn't set.
+
+        """
+        value = self._read(f"__substg1.0_{property_id:04X}{PT_UNICODE:04X}")
+        if value is not None:
+            return value.decode("utf-16-le", errors="replace").rstrip("\x00")
+        value = self._read(f"__substg1.0_{property_id:04X}{PT_STRING8:04X}")
+        if value is not None:
+            return value.decode(self.encoding, errors="replace").rstrip("\x00")
+        return None
+
+    def long(self, property_id: int) -> int | None:
+        """Get a 32-bit integer property.
+
+        Args:
+            property_id (int): The ID of the property.
+
+        Returns:
+            int | None: The value, or None if it isn't set.
+
+        """
+        value = self.fixed.get(property_id << 16 | PT_LONG)
+        return struct.unpack_from("<i", value)[0] if value else None
+
+    def time(self, property_id: int) -> datetime | None:
+        """Get a time property.
+
+        Args:
+            property_id (int): The ID of the property.
+
+        Returns:
+            datetime | None: The value, or None if it isn't set.
+
+        """
+        value = self.fixed.get(property_id << 16 | PT_SYSTIME)
+        return _filetime(struct.unpack_from("<Q", value)[0]) if value else None
+
+    def children(self, prefix: str) -> list[list[str]]:
+        """List the storages of the recipients or attachments.
+
+        Args:
+            prefix (str): The prefix of the storage names.
+
+        Returns:
+            list[list[str]]: The paths of the storages, in order.
+
+        """
+        depth = len(self.path) + 1
+        return sorted(
+            entry
+            for entry in self.ole.listdir(streams=False, storages=True)
+            if len(entry) == depth and entry[:-1] == self.path and entry[-1].startswith(prefix)
+        )
+
+
+def _address(name: str | None, address: str | None) -> str | None:
+    """Format a name and an email address for a header.
+
+    Args:
+        name (str | None): The display name.
+        address (str | None): The email address.
+
+    Returns:
+        str | None: The formatted address, or None if neither is set.
+
+    """
+    if address and "@" in address:
+        return formataddr((name or "", address))
+    return name or address or None
+
+
+def msg_to_email(path: str) -> EmailMessage:
+    """Convert an Outlook message to an email message.
+
+    Only what's needed to preview the message is kept: its headers, bodies and attachments. Messages that can't be
+    faithfully converted (ie. signed or encrypted messages, or messages with only an RTF body) are left to msgconvert.
+
+    Args:
+        path (str): The path to the Outlook message.
+
+    Returns:
+        EmailMessage: The email message.
+
+    Raises:
+        MsgParseError: If the file isn't an Outlook message that can be converted.
+
+    """
+    if not olefile.isOleFile(path):
+        raise MsgParseError("Not an OLE compound file")
+
+    with olefile.OleFileIO(path) as ole:
+        # 8-bit strings are encoded in the message's code page, which is only known once its properties are read
+        message = _Storage(ole, [], MESSAGE_PROPERTIES_HEADER, "cp1252")
+        message.encoding = _codec(message.long(PR_MESSAGE_CODEPAGE))
+
+        message_class = message.string(PR_MESSAGE_CLASS) or ""
+        if "SMIME" in message_class.upper():
+            raise MsgParseError(f"Unsupported message class: {message_class}")
+
+        plain_body = message.string(PR_BODY)
+        html_body = message.binary(PR_HTML)
+        if html_body is not None:
+            html_body = html_body.decode(_codec(message.long(PR_INTERNET_CPID), "utf-8"), errors="replace")
+        else:
+            html_body = message.string(PR_HTML)
+        if not plain_body and not html_body:
+            raise MsgParseError("No plain text or HTML body")
+
+        msg = EmailMessage()
+        transport_headers = HeaderParser().parsestr(message.string(PR_TRANSPORT_MESSAGE_HEADERS) or "")
+        for name in TRANSPORT_HEADERS:
+            for value in transport_headers.get_all(name, []):
+                msg[name] = value.replace("\r", "").replace("\n", "")
+
+        # Messages that were never sent (ie. drafts) only have the headers that can be made from their properties
+        if "From" not in msg and (
+            sender := _address(
+                message.string(PR_SENDER_NAME) or message.string(PR_SENT_REPRESENTING_NAME),
+                message.string(PR_SENDER_SMTP_ADDRESS)
+                or message.string(PR_SENDER_EMAIL_ADDRESS)
+                or message.string(PR_SENT_REPRESENTING_EMAIL_ADDRESS),
+            )
+        ):
+            msg["From"] = sender
+        if "To" not in msg and "Cc" not in msg:
+            recipients = {MAPI_TO: [], MAPI_CC: []}
+            for recipient_path in message.children("__recip_version1.0_"):
+                recipient = _Storage(ole, recipient_path, CHILD_PROPERTIES_HEADER, message.encoding)
+                address = _address(
+                    recipient.string(PR_DISPLAY_NAME),
+                    recipient.string(PR_SMTP_ADDRESS) or recipient.string(PR_EMAIL_ADDRESS),
+                )
+                if address and recipient.long(PR_RECIPIENT_TYPE) in recipients:
+                    recipients[recipient.long(PR_RECIPIENT_TYPE)].append(address)
+            if recipients[MAPI_TO]:
+                msg["To"] = ", ".join(recipients[MAPI_TO])
+            if recipients[MAPI_CC]:
+                msg["Cc"] = ", ".join(recipients[MAPI_CC])
+        if "Subject" not in msg and (subject := message.string(PR_SUBJECT)):
+            msg["Subject"] = subject
+        if "Date" not in msg and (
+            date := message.time(PR_CLIENT_SUBMIT_TIME) or message.time(PR_MESSAGE_DELIVERY_TIME)
+        ):
+            msg["Date"] = format_datetime(date)
+        if "Message-ID" not in msg and (message_id := message.string(PR_INTERNET_MESSAGE_ID)):
+            msg["Message-ID"] = message_id
+
+        if plain_body:
+            msg.set_content(plain_body)
+            if html_body:
+                msg.add_alternative(html_body, subtype="html")
+        else:
+            msg.set_content(html_body, subtype="html")
+
+        for attachment_path in message.children("__attach_version1.0_"):
+            attachment = _Storage(ole, attachment_path, CHILD_PROPERTIES_HEADER, message.encoding)
+            # Embedded messages and OLE objects are stored as storages rather than binary data, and aren't previewed
+            data = attachment.binary(PR_ATTACH_DATA)
+            if data is None:
+                continue
+            maintype, _, subtype = (attachment.string(PR_ATTACH_MIME_TAG) or "").lower().partition("/")
+            if not maintype or not subtype:
+                maintype, subtype = "application", "octet-stream"
+            content_id = attachment.string(PR_ATTACH_CONTENT_ID)
+            msg.add_attachment(
+                data,
+                maintype=maintype,
+                subtype=subtype,
+                filename=attachment.string(PR_ATTACH_LONG_FILENAME) or attachment.string(PR_ATTACH_FILENAME),
+                # Images referenced by the HTML body are shown inline
+                disposition="inline" if content_id else "attachment",
+                cid=f"<{content_id.strip('<>')}>" if content_id else None,
+            )
+    return msg
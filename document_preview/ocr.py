@@ -0,0 +1,134 @@
+"""OCR of images embedded in documents."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pytesseract
+from assemblyline_v4_service.common.ocr import detections as ocr_text_detections
+from PIL import Image
+
+from document_preview.deadline import Deadline
+from document_preview.images import ExtractedImage
+
+# Longest a single image is run through Tesseract, same as the service base's OCR
+OCR_TIMEOUT = 15
+
+
+def _ocr_detections(path: str, deadline: Deadline | None = None) -> dict[str, list[str]] | None:
+    """Run an image through Tesseract and collect the indicators found (runs in a worker thread).
+
+    Args:
+        path (str): The path to the image.
+        deadline (Deadline, optional): The time left for the analysis, Tesseract is killed once it's reached.
+            Defaults to None.
+
+    Returns:
+        dict[str, list[str]] | None: The lines found for each indicator, or None if there wasn't time to finish.
+
+    """
+    timeout = OCR_TIMEOUT
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None:
+        if remaining <= 0:
+            return None
+        timeout = min(timeout, remaining)
+
+    try:
+        with Image.open(path) as image:
+            text = pytesseract.image_to_string(image, timeout=timeout)
+    except (TypeError, OSError, pytesseract.TesseractError, Image.DecompressionBombError):
+        # Image isn't supported by Tesseract, or is larger than a page is allowed to be
+        return {}
+    except RuntimeError:
+        # Tesseract timed out and was killed, which only counts as skipped if it was cut short by the deadline
+        return None if timeout < OCR_TIMEOUT else {}
+    return ocr_text_detections(text)
+
+
+class EmbeddedImageOCR:
+    """Runs OCR over embedded images, skipping tiny images and duplicates."""
+
+    def __init__(self, workers: int = 4, min_pixels: int = 1024, log: logging.Logger | None = None) -> None:
+        """Initialize the scheduler.
+
+        Args:
+            workers (int, optional): The maximum number of images to OCR at the same time. Defaults to 4.
+            min_pixels (int, optional): Images with fewer pixels than this (ie. icons) aren't worth running through
+                OCR. Defaults to 1024.
+            log (logging.Logger, optional): The logger to use. Defaults to None.
+
+        """
+        self.workers = max(workers, 1)
+        self.min_pixels = min_pixels
+        self.log = log or logging.getLogger(__name__)
+        self._executor = None
+
+    def start(self) -> None:
+        """Start the worker threads."""
+        if self._executor is None:
+            # Tesseract runs in its own process, so threads are enough to OCR several images at once
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ocr")
+
+    def stop(self) -> None:
+        """Stop the worker threads, abandoning anything that hasn't started."""
+        if self._executor:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _select(self, images: list[ExtractedImage]) -> list[str]:
+        """Pick out the images that are worth running through OCR.
+
+        Args:
+            images (list[ExtractedImage]): The images.
+
+        Returns:
+            list[str]: The paths of the first copy of each image large enough to OCR.
+
+        """
+        selected = {}
+        for image in images:
+            if image.width * image.height >= self.min_pixels:
+                selected.setdefault(image.digest, image.path)
+
+        skipped = len(images) - len(selected)
+        if skipped:
+            self.log.debug(f"Skipping OCR of {skipped} embedded image(s) that are too small or duplicated")
+        return list(selected.values())
+
+    def detections(self, images: list[ExtractedImage], deadline: Deadline | None = None) -> dict[str, list[str]]:
+        """Run OCR over images and collect the indicators found.
+
+        Args:
+            images (list[ExtractedImage]): The images.
+            deadline (Deadline, optional): The time left for the analysis, images that haven't been run through OCR
+                when it's reached are skipped. Defaults to None.
+
+        Returns:
+            dict[str, list[str]]: The lines found for each indicator across all images.
+
+        """
+        self.start()
+        selected = self._select(images)
+        futures = [self._executor.submit(_ocr_detections, path, deadline) for path in selected]
+        _, pending = wait(futures, timeout=deadline.remaining() if deadline else None)
+        # Images still waiting for a worker are dropped, those already running have their Tesseract killed once the
+        # deadline is reached, so that none of this carries over into the next analysis
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+        detections: dict[str, dict[str, None]] = {}
+        skipped = 0
+        for future in futures:
+            image_detections = None if future.cancelled() else future.result()
+            if image_detections is None:
+                skipped += 1
+                continue
+            for indicator, lines in image_detections.items():
+                detections.setdefault(indicator, {}).update(dict.fromkeys(lines))
+        if skipped:
+            deadline.skip(
+                "ocr.embedded_images",
+                f"{skipped} of {len(selected)} image(s) not run through OCR before the time ran out",
+            )
+        return {indicator: list(lines) for indicator, lines in detections.items()}
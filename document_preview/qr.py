@@ -0,0 +1,345 @@
+"""QR code/barcode decoding.
+
+Images are decoded in-process through libzbar when it's available, otherwise zbarimg is used as a fallback.
+Results are formatted the same way as zbarimg's output (`type:value`, one code per line) regardless of backend.
+"""
+
+import os
+import subprocess
+from base64 import b64decode
+from collections.abc import Iterable, Iterator
+from ctypes import c_char_p, c_int
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from xml.etree import ElementTree
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from document_preview.images import ExtractedImage
+from document_preview.memory import ByteBudgetCache
+
+try:
+    from pyzbar import pyzbar
+    from pyzbar.wrapper import ZBarSymbol, zbar_function
+
+    # Used to name symbols the same way zbarimg does (ie. "QR-Code" rather than "QRCODE")
+    _zbar_get_symbol_name = zbar_function("zbar_get_symbol_name", c_char_p, c_int)
+except (ImportError, AttributeError):
+    # libzbar isn't available, fall back to running zbarimg
+    pyzbar = None
+
+BACKEND = "libzbar" if pyzbar else "zbarimg"
+
+ZBAR_XML_NS = "{http://zbar.sourceforge.net/2008/barcode}"
+
+# Ways a QR code might be sliced up to deter scanning: (columns, rows)
+# Pieces are reassembled left-to-right, top-to-bottom in the order they appear in the document
+SPLIT_LAYOUTS = [
+    (2, 1),  # Halves, side-by-side
+    (1, 2),  # Halves, top-to-bottom
+    (3, 1),  # Strips, side-by-side
+    (1, 3),  # Strips, top-to-bottom
+    (2, 2),  # Quarters
+]
+
+# Pieces of the same code can differ by a pixel when its side doesn't divide evenly (ie. a 296px code in strips)
+SIZE_TOLERANCE = 1
+
+# Exit status of zbarimg when it ran fine but didn't find any code
+ZBARIMG_NOTHING_FOUND = 4
+
+
+class QRDecodeError(Exception):
+    """Raised when the QR code decoder fails, rather than finding nothing."""
+
+
+def _grayscale(image: Image.Image) -> Image.Image:
+    """Get the luminance of an image, which is all that zbar looks at.
+
+    Args:
+        image (Image.Image): The image to convert.
+
+    Returns:
+        Image.Image: The grayscale image.
+
+    """
+    return image if image.mode == "L" else image.convert("L")
+
+
+def _libzbar_decode(image: Image.Image) -> str:
+    """Decode an image in-process using libzbar.
+
+    Args:
+        image (Image.Image): The grayscale image to decode.
+
+    Returns:
+        str: The decoded content in zbarimg's format, otherwise an empty string.
+
+    """
+    return "\n".join(
+        f"{_zbar_get_symbol_name(ZBarSymbol[symbol.type]).decode()}:{symbol.data.decode(errors='replace')}"
+        for symbol in pyzbar.decode(image)
+    )
+
+
+def _zbarimg(*paths: str) -> str:
+    """Decode image files using zbarimg.
+
+    Args:
+        *paths (str): The image files to decode.
+
+    Returns:
+        str: The decoded content of all images, otherwise an empty string.
+
+    Raises:
+        QRDecodeError: If zbarimg failed to scan the images.
+
+    """
+    process = subprocess.run(
+        ["zbarimg", "-q", *paths],
+        capture_output=True,
+        text=True,
+        errors="replace",
+        check=False,
+    )
+    if process.returncode not in (0, ZBARIMG_NOTHING_FOUND):
+        raise QRDecodeError(f"zbarimg exited with status {process.returncode}: {process.stderr.strip()}")
+    return process.stdout.strip()
+
+
+def _zbarimg_batch(paths: list[str]) -> list[str]:
+    """Decode many image files using a single zbarimg call.
+
+    Args:
+        paths (list[str]): The image files to decode.
+
+    Returns:
+        list[str]: The decoded content of each image, in the order given.
+
+    """
+    process = subprocess.run(["zbarimg", "-q", "--xml", *paths], capture_output=True, check=False)
+    if process.returncode not in (0, ZBARIMG_NOTHING_FOUND):
+        # Scanning stops at the first image that fails, scan them one at a time to tell which one it was
+        return [_zbarimg(path) for path in paths]
+    try:
+        root = ElementTree.fromstring(process.stdout)
+    except ElementTree.ParseError:
+        # Unable to tell which image a code came from, scan them one at a time instead
+        return [_zbarimg(path) for path in paths]
+
+    results = dict.fromkeys(paths, "")
+    for source in root.iter(f"{ZBAR_XML_NS}source"):
+        codes = []
+        for symbol in source.iter(f"{ZBAR_XML_NS}symbol"):
+            data = symbol.find(f"{ZBAR_XML_NS}data")
+            value = (data.text or "") if data is not None else ""
+            if data is not None and data.get("format") == "base64":
+                # Binary content is base64-encoded in XML output
+                value = b64decode(value).decode(errors="replace")
+            codes.append(f"{symbol.get('type')}:{value}")
+        results[source.get("href")] = "\n".join(codes)
+    return [results[path] for path in paths]
+
+
+def _decode_batch(images: list[Image.Image]) -> list[str]:
+    """Decode grayscale images with whichever backend is available.
+
+    Args:
+        images (list[Image.Image]): The grayscale images to decode.
+
+    Returns:
+        list[str]: The decoded content of each image, in the order given.
+
+    """
+    if pyzbar:
+        return [_libzbar_decode(image) for image in images]
+
+    if len(images) == 1:
+        with NamedTemporaryFile(suffix=".pgm") as tmp_qr:
+            # Uncompressed PGM is much cheaper to write than PNG
+            images[0].save(tmp_qr.name, format="PPM")
+            return [_zbarimg(tmp_qr.name)]
+
+    with TemporaryDirectory() as tmp_dir:
+        paths = []
+        for index, image in enumerate(images):
+            path = os.path.join(tmp_dir, f"{index}.pgm")
+            image.save(path, format="PPM")
+            paths.append(path)
+        return _zbarimg_batch(paths)
+
+
+def batch_scan_for_QR_codes(images: list[Image.Image]) -> list[str]:
+    """Scan many images for QR codes in one go.
+
+    Any image where nothing was found is scanned again with its colours inverted.
+
+    Args:
+        images (list[Image.Image]): The images to scan for QR codes.
+
+    Returns:
+        list[str]: The decoded content of each image (or an empty string), in the order given.
+
+    """
+    if not images:
+        return []
+
+    images = [_grayscale(image) for image in images]
+    results = _decode_batch(images)
+
+    # Try scanning with a color invert of the images that didn't decode
+    retry = [index for index, result in enumerate(results) if not result]
+    if retry:
+        for index, result in zip(retry, _decode_batch([ImageOps.invert(images[index]) for index in retry])):
+            results[index] = result
+    return results
+
+
+def _decoded_size(image: Image.Image | None) -> int:
+    """Estimate the memory held by a decoded image.
+
+    Args:
+        image (Image.Image | None): The image.
+
+    Returns:
+        int: The size of its pixel data, in bytes.
+
+    """
+    return image.width * image.height * len(image.getbands()) if image else 0
+
+
+def _group_by_size(images: list[ExtractedImage]) -> list[list[ExtractedImage]]:
+    """Group images that are the same size, give or take SIZE_TOLERANCE pixels.
+
+    Args:
+        images (list[ExtractedImage]): The images, in the order they appear in the document.
+
+    Returns:
+        list[list[ExtractedImage]]: The groups, each in the order its images appear in the document.
+
+    """
+    groups: list[list[ExtractedImage]] = []
+    for image in images:
+        for group in groups:
+            if (
+                abs(group[0].width - image.width) <= SIZE_TOLERANCE
+                and abs(group[0].height - image.height) <= SIZE_TOLERANCE
+            ):
+                group.append(image)
+                break
+        else:
+            groups.append([image])
+    return groups
+
+
+def _grid(
+    pieces: list[ExtractedImage] | list[Image.Image], columns: int
+) -> tuple[list[tuple[int, int]], tuple[int, int]] | None:
+    """Lay pieces out in a grid, at their actual sizes.
+
+    Args:
+        pieces (list[ExtractedImage] | list[Image.Image]): The pieces, left-to-right, top-to-bottom.
+        columns (int): The number of columns.
+
+    Returns:
+        tuple[list[tuple[int, int]], tuple[int, int]] | None: The offset of each piece and the size of the whole
+        grid, or None if the grid isn't square (give or take SIZE_TOLERANCE pixels per piece across).
+
+    """
+    offsets = []
+    width, height = 0, 0
+    for start in range(0, len(pieces), columns):
+        row = pieces[start : start + columns]
+        x = 0
+        for piece in row:
+            offsets.append((x, height))
+            x += piece.width
+        width = max(width, x)
+        height += max(piece.height for piece in row)
+    if abs(width - height) > SIZE_TOLERANCE * max(columns, len(pieces) // columns):
+        return None
+    return offsets, (width, height)
+
+
+def iter_qr_candidates(
+    images: list[ExtractedImage], max_combinations: int = 64, max_bytes: int = 64 * 1024 * 1024
+) -> Iterator[Image.Image]:
+    """Find the embedded images that might be QR codes, including codes that were split into several images.
+
+    Only images that could be part of a code are loaded, and candidates are produced one at a time so that they
+    don't all have to be held in memory at once.
+
+    Args:
+        images (list[ExtractedImage]): The embedded images, in the order they appear in the document.
+        max_combinations (int, optional): The maximum number of reassembled images to produce. Defaults to 64.
+        max_bytes (int, optional): The memory that decoded pieces can be kept in while reassembling them, pieces
+            are decoded again once they've been evicted. Defaults to 64MB.
+
+    Yields:
+        Image.Image: The square images, followed by the reassembled images.
+
+    """
+    opened = ByteBudgetCache(max_bytes, sizeof=_decoded_size)
+
+    def open_image(path: str) -> Image.Image | None:
+        try:
+            image = Image.open(path)
+            image.load()
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+            return None
+        return image
+
+    def load(image: ExtractedImage) -> Image.Image | None:
+        return opened.get_or_load(image.path, lambda: open_image(image.path))
+
+    # Image is a perfect square, let's check if it's a QR code
+    for image in images:
+        if image.width == image.height and (square := load(image)):
+            yield square
+
+    # Pieces of the same code will all be (about) the same size
+    combinations = 0
+    for pieces in _group_by_size(images):
+        for columns, rows in SPLIT_LAYOUTS:
+            # Try each run of consecutive pieces that would make a square, before decoding any of them
+            for start in range(len(pieces) - columns * rows + 1):
+                if combinations >= max_combinations:
+                    return
+
+                run = pieces[start : start + columns * rows]
+                if not _grid(run, columns):
+                    continue
+                group = [load(piece) for piece in run]
+                # Lay out the decoded pieces, in case their size doesn't match what the document said
+                grid = None if None in group else _grid(group, columns)
+                if not grid:
+                    continue
+                offsets, size = grid
+                combined_image = Image.new("RGB", size, "white")
+                for piece, offset in zip(group, offsets):
+                    combined_image.paste(piece, offset)
+                yield combined_image
+                combinations += 1
+
+
+def scan_qr_candidates(candidates: Iterable[Image.Image], max_batch_bytes: int = 64 * 1024 * 1024) -> list[str]:
+    """Scan images for QR codes in batches, only holding on to one batch of decoded images at a time.
+
+    Args:
+        candidates (Iterable[Image.Image]): The images to scan.
+        max_batch_bytes (int, optional): The memory a batch of decoded images can take up. Defaults to 64MB.
+
+    Returns:
+        list[str]: The decoded content of each image where a code was found.
+
+    """
+    detections = []
+    batch, batch_bytes = [], 0
+    for candidate in candidates:
+        batch.append(candidate)
+        batch_bytes += _decoded_size(candidate)
+        if batch_bytes >= max_batch_bytes:
+            detections += [qr for qr in batch_scan_for_QR_codes(batch) if qr]
+            batch, batch_bytes = [], 0
+    if batch:
+        detections += [qr for qr in batch_scan_for_QR_codes(batch) if qr]
+    return detections
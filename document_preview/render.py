@@ -0,0 +1,471 @@
+"""Page rasterization helpers.
+
+Kept separate from the service module so that rendering workers only need to import PyMuPDF.
+"""
+
+import math
+import multiprocessing
+import os
+from collections.abc import Collection, Iterable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from hashlib import sha256
+
+import fitz
+from natsort import natsorted
+from PIL import Image
+
+from document_preview.memory import ByteBudgetCache
+
+PDF_DPI = int(os.environ.get("PDF_DPI", 150))
+
+# Pages are rendered as RGB without alpha
+BYTES_PER_PIXEL = 3
+
+# Memory held by an opened document for each of its objects and pages (ie. parsed dictionaries, the page tree), on top
+# of the file itself which MuPDF keeps buffered
+DOCUMENT_OBJECT_BYTES = 1024
+
+
+def _document_size(doc: fitz.Document) -> int:
+    """Estimate the memory held by an opened document.
+
+    Args:
+        doc (fitz.Document): The opened PyMuPDF document.
+
+    Returns:
+        int: The estimated size in bytes.
+
+    """
+    return os.path.getsize(doc.name) + (doc.xref_length() + doc.page_count) * DOCUMENT_OBJECT_BYTES
+
+
+# Documents opened during an analysis, weighted by what they hold in memory (the service sets the budget)
+DOCUMENT_CACHE = ByteBudgetCache(256 * 1024 * 1024, sizeof=_document_size, close=lambda doc: doc.close())
+
+
+def _open_fitz_doc(fp: str) -> fitz.Document:
+    """Open and cache a PyMuPDF document.
+
+    Args:
+        fp (str): The file path to the PDF document.
+
+    Returns:
+        fitz.Document: The opened PyMuPDF document.
+
+    """
+    return DOCUMENT_CACHE.get_or_load(fp, lambda: fitz.open(fp))
+
+
+def release_documents() -> None:
+    """Close the cached documents, and drop what MuPDF decoded from any document (ie. images and fonts)."""
+    DOCUMENT_CACHE.clear()
+    fitz.TOOLS.store_shrink(100)
+
+
+class RenderedPage:
+    """A rendered preview page, kept as a pixel buffer in memory until it has to be written to disk."""
+
+    def __init__(self, context: str, page_number: int, pixmap: fitz.Pixmap, path: str | None = None) -> None:
+        """Initialize the rendered page.
+
+        Args:
+            context (str): The context the page was rendered in (ie. "original", "plain").
+            page_number (int): The one-based page number.
+            pixmap (fitz.Pixmap): The rendered pixels.
+            path (str, optional): The path to the page on disk, if it's already been written. Defaults to None.
+
+        """
+        self.context = context
+        self.page_number = page_number
+        self.pixmap = pixmap
+        self.path = path
+        # Kept so the size of the page is known once its pixels were released
+        self.width, self.height = pixmap.width, pixmap.height
+        # Hash the samples in place, there's no need for an encoded copy to deduplicate pages
+        self.digest = sha256(pixmap.samples_mv).hexdigest()
+        self._gray = None
+        self._gray_view = None
+        self._gray_image = None
+
+    @property
+    def name(self) -> str:
+        """The file name of the page preview."""
+        return f"output_{self.context}-{self.page_number}.png"
+
+    @classmethod
+    def from_file(cls, path: str) -> "RenderedPage":
+        """Load a preview that was written directly to disk (ie. a browser screenshot).
+
+        Args:
+            path (str): The path to the preview, named as "output_{context}-{page_number}.png".
+
+        Returns:
+            RenderedPage: The loaded page.
+
+        """
+        context, page_number = os.path.basename(path)[7:-4].split("-")
+        return cls(context, int(page_number), fitz.Pixmap(path), path=path)
+
+    def grayscale(self) -> Image.Image:
+        """Get a grayscale view of the page, which is all that barcode decoding needs.
+
+        Returns:
+            Image.Image: A PIL image backed by the grayscale pixel buffer (not a copy).
+
+        """
+        if self._gray_image is None:
+            if self.pixmap is None:
+                # The pixels were released, load them back from the page written to disk
+                self.pixmap = fitz.Pixmap(self.path)
+            pixmap = fitz.Pixmap(self.pixmap, 0) if self.pixmap.alpha else self.pixmap
+            # Pages that were rendered in grayscale can be used as is
+            self._gray = pixmap if pixmap.n == 1 else fitz.Pixmap(fitz.csGRAY, pixmap)
+            self._gray_view = self._gray.samples_mv
+            self._gray_image = Image.frombuffer(
+                "L", (self._gray.width, self._gray.height), self._gray_view, "raw", "L", self._gray.stride, 1
+            )
+        return self._gray_image
+
+    def save(self, output_directory: str) -> str:
+        """Encode the page as PNG, this is only done once for pages that are attached to the result.
+
+        Args:
+            output_directory (str): The directory to write the page to.
+
+        Returns:
+            str: The path to the PNG file.
+
+        """
+        if not self.path:
+            self.path = os.path.join(output_directory, self.name)
+            self.pixmap.save(self.path)
+        return self.path
+
+    def release(self, output_directory: str) -> None:
+        """Write the page to disk and release its pixel buffers, they're loaded back from the file if needed again.
+
+        Args:
+            output_directory (str): The directory to write the page to.
+
+        """
+        if self.pixmap is not None:
+            self.save(output_directory)
+            self.close()
+
+    def release_grayscale(self) -> None:
+        """Release the grayscale view of the page, it's converted again if needed again."""
+        # Views on the buffers have to be dropped before the pixmaps that own them
+        self._gray_image = None
+        self._gray_view = None
+        self._gray = None
+
+    def close(self) -> None:
+        """Release the pixel buffers held by the page."""
+        self.release_grayscale()
+        self.pixmap = None
+
+
+def page_zooms(
+    doc: fitz.Document,
+    page_numbers: list[int],
+    dpi: int = PDF_DPI,
+    max_page_pixels: int = 0,
+    max_total_pixels: int = 0,
+    detail_pages: Collection[int] = (),
+    detail_dpi: int | None = None,
+) -> list[tuple[int, float]]:
+    """Pick the zoom to render each page at, keeping within the pixel budgets.
+
+    Pages that would go over the budget of a single page, or over what's left of the overall budget, are downscaled
+    to fit. Once a page can't fit at even half resolution, the rest of the pages aren't rendered (and are left out of
+    the zooms returned).
+
+    Args:
+        doc (fitz.Document): The opened PyMuPDF document.
+        page_numbers (list[int]): The zero-based page numbers to render.
+        dpi (int, optional): The resolution to render pages at. Defaults to PDF_DPI.
+        max_page_pixels (int, optional): The most pixels to render a single page with, 0 for no limit. Defaults to 0.
+        max_total_pixels (int, optional): The most pixels to render across all pages, 0 for no limit. Defaults to 0.
+        detail_pages (Collection[int], optional): The numbers of the pages to render at detail_dpi instead.
+            Defaults to none.
+        detail_dpi (int, optional): The resolution to render the detail pages at. Defaults to None (dpi).
+
+    Returns:
+        list[tuple[int, float]]: The page number and zoom of each page to render.
+
+    """
+    zooms = []
+    remaining = max_total_pixels
+    for page_num in page_numbers:
+        # Size of the page in points, based on the area that gets rendered
+        rect = doc.page_cropbox(page_num) if doc.is_pdf else doc[page_num].rect
+        zoom = ((detail_dpi or dpi) if page_num + 1 in detail_pages else dpi) / 72  # 72 is the default DPI for PDFs
+        pixels = rect.width * rect.height * zoom**2
+        if max_page_pixels and pixels > max_page_pixels:
+            # Oversized (or crafted) page, render it at a lower resolution
+            zoom *= math.sqrt(max_page_pixels / pixels)
+            pixels = max_page_pixels
+        if max_total_pixels:
+            if pixels > remaining:
+                if remaining < pixels / 4:
+                    # Not enough left to render the page at even half resolution
+                    break
+                zoom *= math.sqrt(remaining / pixels)
+                pixels = remaining
+            remaining -= pixels
+        zooms.append((page_num, zoom))
+    return zooms
+
+
+def _render_page(page: fitz.Page, zoom: float, gray: bool = False) -> fitz.Pixmap:
+    """Render a page.
+
+    Args:
+        page (fitz.Page): The page to render.
+        zoom (float): The zoom to render the page at.
+        gray (bool, optional): Render the page in grayscale rather than RGB. Defaults to False.
+
+    Returns:
+        fitz.Pixmap: The rendered pixels.
+
+    """
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY if gray else fitz.csRGB)
+
+
+def _render_page_slice(fp: str, plan: list[tuple[int, float, bool]]) -> list[tuple[int, int, int, bool, bytes]]:
+    """Render a subset of pages from a document (runs inside a rendering worker).
+
+    Args:
+        fp (str): The file path to the PDF document.
+        plan (list[tuple[int, float, bool]]): The zero-based page number, zoom and whether to render in grayscale,
+            of each page to render.
+
+    Returns:
+        list[tuple[int, int, int, bool, bytes]]: The page number, width, height, whether it's grayscale and samples
+        of each rendered page.
+
+    """
+    # Each worker owns its document handle, PyMuPDF documents can't be shared across processes
+    with fitz.open(fp) as doc:
+        rendered = []
+        for page_num, zoom, gray in plan:
+            pix = _render_page(doc[page_num], zoom, gray)
+            rendered.append((page_num, pix.width, pix.height, gray, pix.samples))
+        return rendered
+
+
+def create_render_pool(workers: int) -> ProcessPoolExecutor:
+    """Create a process pool for rendering pages in parallel.
+
+    Workers are started from a fork server rather than forked from the service process, which holds
+    onto a browser session and other resources that shouldn't be duplicated.
+
+    Args:
+        workers (int): The number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: The rendering pool.
+
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+
+
+class DocumentAnalysis:
+    """Everything collected from a document in a single pass over its pages."""
+
+    def __init__(self, context: str, path: str) -> None:
+        """Initialize the analysis.
+
+        Args:
+            context (str): The context the document was rendered in (ie. "original", "plain").
+            path (str): The path to the document.
+
+        """
+        self.context = context
+        self.path = path
+        # Number, text and images (xref, width, height) of each visited page, in page order
+        self.page_numbers: list[int] = []
+        self.text: list[str] = []
+        self.images: list[list[tuple[int, int, int]]] = []
+        # How much of each visited page is text rather than images when it was measured, see text_layer()
+        self.layout: list[tuple[int, float, float]] = []
+        # URIs of hyperlinks on the visited pages
+        self.links: list[str] = []
+        self.pages: list[RenderedPage] = []
+        # Numbers of the pages that weren't rendered because they would have gone over the pixel budget
+        self.unrendered: list[int] = []
+
+
+def text_layer(page: fitz.Page, text: str) -> tuple[int, float, float]:
+    """Measure how much of a page is made of text that can be extracted, rather than images.
+
+    Args:
+        page (fitz.Page): The page.
+        text (str): The text of the page.
+
+    Returns:
+        tuple[int, float, float]: The number of characters of text (ignoring whitespace), the share of the page
+        covered by images and the number of characters per square inch of the page.
+
+    """
+    chars = sum(not c.isspace() for c in text)
+    area = abs(page.rect)
+    if not area:
+        return chars, 0.0, 0.0
+    # Images placed more than once are counted for each placement, overlapping images may add up past the whole page
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return chars, min(covered / area, 1.0), chars / (area / 72**2)
+
+
+def needs_ocr(
+    layout: tuple[int, float, float], min_chars: int = 50, min_image_coverage: float = 0.5, min_density: float = 5
+) -> bool:
+    """Decide whether a page has to go through OCR for its content to be analyzed.
+
+    Pages with little to no text are OCRed (ie. scans, or text drawn as vector paths), as are pages mostly covered by
+    images with only sparse text around them (ie. a lure in a page-sized image). Anything else has a text layer that
+    says what the page says.
+
+    Args:
+        layout (tuple[int, float, float]): How much of the page is text rather than images, from text_layer().
+        min_chars (int, optional): Pages with fewer characters of text are OCRed. Defaults to 50.
+        min_image_coverage (float, optional): The share of a page covered by images from which it's OCRed if its
+            text is sparse. Defaults to 0.5.
+        min_density (float, optional): The characters per square inch under which text is sparse. Defaults to 5.
+
+    Returns:
+        bool: Whether the page should be OCRed.
+
+    """
+    chars, image_coverage, density = layout
+    return chars < min_chars or (image_coverage >= min_image_coverage and density < min_density)
+
+
+def select_ocr_pages(
+    analyses: list[DocumentAnalysis],
+    page_keys: Iterable[tuple[str, int]],
+    ocr_pages: int,
+    deep_scan: bool = False,
+    routing: dict[str, float] | None = None,
+) -> set[tuple[str, int]]:
+    """Pick the pages to run through OCR.
+
+    Args:
+        analyses (list[DocumentAnalysis]): What was collected from each PDF, empty if there's none (ie. images).
+        page_keys (Iterable[tuple[str, int]]): The context and number of each page.
+        ocr_pages (int): The number of leading pages to run through OCR, unless it's a deep scan.
+        deep_scan (bool, optional): Consider every page rather than only the leading ones. Defaults to False.
+        routing (dict[str, float], optional): The thresholds of needs_ocr() to decide for each page from its own text
+            layer. Defaults to None (no pages are OCRed if the first document has text).
+
+    Returns:
+        set[tuple[str, int]]: The context and number of each page to run through OCR.
+
+    """
+    page_routes = None
+    if analyses and routing is not None:
+        # Decide which pages need OCR from their own text layer, so that a page-sized image isn't passed over because
+        # another page has text
+        page_routes = {
+            (analysis.context, page_number): needs_ocr(layout, **routing)
+            for analysis in analyses
+            for page_number, layout in zip(analysis.page_numbers, analysis.layout)
+        }
+    elif analyses and any(text.strip() for text in analyses[0].text):
+        # We were able to extract content, which is analyzed instead of running OCR on the pages
+        return set()
+
+    page_keys = natsorted(page_keys)
+    if not deep_scan:
+        # Trigger OCR on the first N pages as specified in the submission
+        page_keys = page_keys[:ocr_pages]
+    # The text layer of the pages that aren't routed to OCR already says what they say
+    return {key for key in page_keys if page_routes is None or page_routes.get(key, True)}
+
+
+def analyze_pages(
+    fp: str,
+    first_page: int = 1,
+    last_page: int | None = None,
+    context: str = "original",
+    render: bool = True,
+    extract: bool = True,
+    layout: bool = False,
+    pool: Executor | None = None,
+    workers: int = 1,
+    dpi: int = PDF_DPI,
+    max_page_pixels: int = 0,
+    max_total_pixels: int = 0,
+    detail_pages: Collection[int] = (),
+    detail_dpi: int | None = None,
+    grayscale: bool = False,
+) -> DocumentAnalysis:
+    """Visit each page of a PDF/Mobi/EPUB once, rendering it and collecting its text, images and links.
+
+    Args:
+        fp (str): The file path to the PDF document.
+        first_page (int, optional): The first page to visit. Defaults to 1.
+        last_page (int, optional): The last page to visit. Defaults to None, which means all pages.
+        context (str, optional): A context string to include in the output file names. Defaults to "original".
+        render (bool, optional): Render the pages. Defaults to True.
+        extract (bool, optional): Collect the text, image xrefs and links of the pages. Defaults to True.
+        layout (bool, optional): Also measure how much of each page is text rather than images (ie. to decide which
+            pages need OCR), when extracting. Defaults to False.
+        pool (Executor, optional): A process pool to spread rendering across. Defaults to None (render in-process).
+        workers (int, optional): The number of slices to split the page range into when using a pool. Defaults to 1.
+        dpi (int, optional): The resolution to render pages at. Defaults to PDF_DPI.
+        max_page_pixels (int, optional): The most pixels to render a single page with, 0 for no limit. Defaults to 0.
+        max_total_pixels (int, optional): The most pixels to render across all pages, 0 for no limit. Defaults to 0.
+        detail_pages (Collection[int], optional): The numbers of the pages that need more detail (ie. for OCR), these
+            are rendered at detail_dpi and in color. Defaults to none.
+        detail_dpi (int, optional): The resolution to render the detail pages at. Defaults to None (dpi).
+        grayscale (bool, optional): Render the other pages in grayscale. Defaults to False.
+
+    Returns:
+        DocumentAnalysis: What was collected from the pages.
+
+    """
+    doc = _open_fitz_doc(fp)
+    end_page = min(last_page, doc.page_count) if last_page else doc.page_count
+    page_numbers = list(range(first_page - 1, end_page))
+    analysis = DocumentAnalysis(context, fp)
+
+    plan = {}
+    if render:
+        # Pages that only go into the gallery can be rendered with less detail
+        plan = {
+            page_num: (zoom, grayscale and page_num + 1 not in detail_pages)
+            for page_num, zoom in page_zooms(
+                doc, page_numbers, dpi, max_page_pixels, max_total_pixels, detail_pages, detail_dpi
+            )
+        }
+        analysis.unrendered = [page_num + 1 for page_num in page_numbers if page_num not in plan]
+    futures = []
+    if render and pool is not None and workers >= 2 and len(plan) >= 2:
+        # Interleave pages across workers so that slices are balanced regardless of where the heavy pages are
+        slices = min(workers, len(plan))
+        plan_items = [(page_num, zoom, gray) for page_num, (zoom, gray) in plan.items()]
+        futures = [pool.submit(_render_page_slice, fp, plan_items[i::slices]) for i in range(slices)]
+        # Pages are rendered by the pool while we extract content here
+        render = False
+
+    if render or extract:
+        for page_num in page_numbers:
+            page = doc[page_num]
+            if extract:
+                analysis.page_numbers.append(page_num + 1)
+                analysis.text.append(page.get_text())
+                if layout:
+                    analysis.layout.append(text_layer(page, analysis.text[-1]))
+                analysis.images.append([img_ref[0:1] + img_ref[2:4] for img_ref in page.get_images(full=True)])
+                analysis.links += [link["uri"] for link in page.get_links() if link.get("uri")]
+            if render and page_num in plan:
+                analysis.pages.append(RenderedPage(context, page_num + 1, _render_page(page, *plan[page_num])))
+
+    for future in futures:
+        # Surface any rendering errors from the workers
+        for page_num, width, height, gray, samples in future.result():
+            pix = fitz.Pixmap(fitz.csGRAY if gray else fitz.csRGB, width, height, samples, 0)
+            analysis.pages.append(RenderedPage(context, page_num + 1, pix))
+    analysis.pages.sort(key=lambda page: page.page_number)
+    return analysis
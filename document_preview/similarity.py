@@ -0,0 +1,87 @@
+"""Perceptual hashing of rendered pages, to find pages that look the same without being pixel-for-pixel identical."""
+
+from typing import Any
+
+from PIL import Image
+
+
+def dhash(image: Image.Image, hash_size: int = 16) -> int:
+    """Compute the difference hash of an image.
+
+    The image is shrunk to (hash_size + 1) x hash_size pixels, and each bit of the hash is whether a pixel is brighter
+    than its right neighbour. Renders of the same page that differ by a few pixels (ie. anti-aliasing, a different
+    font, a timestamp) end up with hashes that differ by a few bits.
+
+    Args:
+        image (Image.Image): The grayscale image.
+        hash_size (int, optional): The number of rows and columns compared, the hash has hash_size² bits.
+            Defaults to 16.
+
+    Returns:
+        int: The hash.
+
+    """
+    # Averaging over boxes is fast on large pages, and isn't thrown off by single pixels like nearest neighbour
+    pixels = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX).tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = value << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class PerceptualIndex:
+    """An index of perceptual hashes, looked up by Hamming distance.
+
+    Hashes are split into max_distance + 1 bands: two hashes that differ by at most max_distance bits have to be
+    identical in at least one band, so only hashes sharing a band with the one looked up are compared.
+    """
+
+    def __init__(self, max_distance: int, hash_bits: int) -> None:
+        """Initialize the index.
+
+        Args:
+            max_distance (int): The most bits by which two hashes can differ to be considered a match.
+            hash_bits (int): The number of bits in each hash.
+
+        """
+        self.max_distance = max_distance
+        bands = min(max_distance + 1, hash_bits)
+        # Spread the bits over the bands, the first ones taking any remainder
+        widths = [hash_bits // bands + (band < hash_bits % bands) for band in range(bands)]
+        self._bands = []
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._buckets: list[dict[int, list[tuple[int, Any]]]] = [{} for _ in self._bands]
+
+    def find(self, value: int) -> Any | None:
+        """Find the item added with the hash closest to the one given.
+
+        Args:
+            value (int): The hash to look up.
+
+        Returns:
+            Any | None: The item of the closest match, or None if no hash is close enough.
+
+        """
+        best, best_distance = None, self.max_distance + 1
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            for candidate, item in buckets.get(value >> shift & mask, []):
+                distance = (candidate ^ value).bit_count()
+                if distance < best_distance:
+                    best, best_distance = item, distance
+        return best
+
+    def add(self, value: int, item: Any) -> None:
+        """Add a hash to the index.
+
+        Args:
+            value (int): The hash.
+            item (Any): What to return when a close hash is looked up.
+
+        """
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            buckets.setdefault(value >> shift & mask, []).append((value, item))
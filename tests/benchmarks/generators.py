@@ -0,0 +1,264 @@
+"""Generators of synthetic documents for benchmarking.
+
+Everything is generated from a fixed seed so that runs on different revisions work on the same inputs.
+"""
+
+import csv
+import io
+import os
+import random
+
+import fitz
+import xlsxwriter
+from PIL import Image, ImageDraw
+
+SEED = 1337
+
+LOREM = [
+    "Lorem",
+    "ipsum",
+    "dolor",
+    "sit",
+    "amet,",
+    "consectetur",
+    "adipiscing",
+    "elit,",
+    "sed",
+    "do",
+    "eiusmod",
+    "tempor",
+    "incididunt",
+    "ut",
+    "labore",
+    "et",
+    "dolore",
+    "magna",
+    "aliqua.",
+    "Please",
+    "enable",
+    "editing",
+    "and",
+    "click",
+    "here",
+    "to",
+    "view",
+    "the",
+    "invoice.",
+    "Password:",
+    "INVOICE2024",
+]
+
+
+def _sentences(rng: random.Random, count: int) -> list[str]:
+    return [" ".join(rng.choices(LOREM, k=rng.randint(8, 16))).capitalize() + "." for _ in range(count)]
+
+
+def qr_like_image(rng: random.Random, modules: int = 29, scale: int = 8) -> Image.Image:
+    """Generate an image that looks like a QR code (finder patterns and random modules).
+
+    The content isn't decodable, but it costs the same to scan as a real code.
+
+    Args:
+        rng (random.Random): The random number generator to use.
+        modules (int, optional): The number of modules along each side. Defaults to 29.
+        scale (int, optional): The size of each module, in pixels. Defaults to 8.
+
+    Returns:
+        Image.Image: The image, with a quiet zone of 4 modules around it.
+
+    """
+    size = (modules + 8) * scale
+    image = Image.new("L", (size, size), 255)
+    draw = ImageDraw.Draw(image)
+
+    def module(x: int, y: int) -> None:
+        draw.rectangle(
+            [(x + 4) * scale, (y + 4) * scale, (x + 5) * scale - 1, (y + 5) * scale - 1],
+            fill=0,
+        )
+
+    for x in range(modules):
+        for y in range(modules):
+            if rng.random() < 0.5:
+                module(x, y)
+
+    # Finder patterns in three of the corners
+    for ox, oy in [(0, 0), (modules - 7, 0), (0, modules - 7)]:
+        draw.rectangle([(ox + 4) * scale, (oy + 4) * scale, (ox + 11) * scale - 1, (oy + 11) * scale - 1], fill=255)
+        for i in range(7):
+            for j in range(7):
+                if i in (0, 6) or j in (0, 6) or (2 <= i <= 4 and 2 <= j <= 4):
+                    module(ox + i, oy + j)
+    return image
+
+
+def split_image(image: Image.Image, columns: int, rows: int) -> list[Image.Image]:
+    """Slice an image into a grid of pieces.
+
+    Args:
+        image (Image.Image): The image to slice.
+        columns (int): The number of columns.
+        rows (int): The number of rows.
+
+    Returns:
+        list[Image.Image]: The pieces, left-to-right, top-to-bottom.
+
+    """
+    width, height = image.width // columns, image.height // rows
+    return [
+        image.crop((column * width, row * height, (column + 1) * width, (row + 1) * height))
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def _png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def generate_pdf(
+    path: str,
+    pages: int = 10,
+    images: int = 10,
+    duplicates: int = 10,
+    split_qr_codes: int = 1,
+    seed: int = SEED,
+) -> str:
+    """Generate a PDF with text, embedded images and split QR codes.
+
+    Args:
+        path (str): The path to write the PDF to.
+        pages (int, optional): The number of pages. Defaults to 10.
+        images (int, optional): The number of distinct photo-like images, spread across the pages. Defaults to 10.
+        duplicates (int, optional): The number of pages that repeat the same logo. Defaults to 10.
+        split_qr_codes (int, optional): The number of QR codes split into halves, strips and quarters.
+            Defaults to 1.
+        seed (int, optional): The seed for the random content. Defaults to SEED.
+
+    Returns:
+        str: The path to the PDF.
+
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 400), "\n".join(_sentences(rng, 12)), fontsize=10)
+
+    logo = _png(Image.new("RGB", (120, 40), (200, 30, 30)))
+    for page_number in range(min(duplicates, pages)):
+        doc[page_number].insert_image(fitz.Rect(450, 10, 570, 50), stream=logo)
+
+    for index in range(images):
+        photo = Image.effect_noise((320, 240), rng.randint(32, 96)).convert("RGB")
+        doc[index % pages].insert_image(fitz.Rect(50, 420, 370, 660), stream=_png(photo))
+
+    for index in range(split_qr_codes):
+        code = qr_like_image(rng)
+        for columns, rows in [(2, 1), (1, 2), (3, 1), (1, 3), (2, 2)]:
+            page = doc[index % pages]
+            for piece in split_image(code, columns, rows):
+                page.insert_image(fitz.Rect(400, 420, 550, 570), stream=_png(piece))
+
+    doc.save(path)
+    return path
+
+
+def generate_html(path: str, paragraphs: int = 200, scripts: bool = False, seed: int = SEED) -> str:
+    """Generate an HTML page, optionally with scripts and styling.
+
+    Args:
+        path (str): The path to write the page to.
+        paragraphs (int, optional): The number of paragraphs. Defaults to 200.
+        scripts (bool, optional): Include scripts and styles (rendered again without them). Defaults to False.
+        seed (int, optional): The seed for the random content. Defaults to SEED.
+
+    Returns:
+        str: The path to the page.
+
+    """
+    rng = random.Random(seed)
+    head = ""
+    if scripts:
+        head = (
+            "<style>p { font-family: serif; color: #333; } .hidden { display: none; }</style>"
+            "<script>document.addEventListener('DOMContentLoaded', () => {"
+            "for (const p of document.querySelectorAll('p')) { p.dataset.seen = Date.now(); }});</script>"
+        )
+    body = "".join(f"<p>{sentence}</p>" for sentence in _sentences(rng, paragraphs))
+    with open(path, "w") as fh:
+        fh.write(f"<!DOCTYPE html><html><head><title>Benchmark</title>{head}</head><body>{body}</body></html>")
+    return path
+
+
+def generate_csv(path: str, rows: int = 100_000, columns: int = 12, seed: int = SEED) -> str:
+    """Generate a large CSV file.
+
+    Args:
+        path (str): The path to write the CSV to.
+        rows (int, optional): The number of rows. Defaults to 100,000.
+        columns (int, optional): The number of columns. Defaults to 12.
+        seed (int, optional): The seed for the random content. Defaults to SEED.
+
+    Returns:
+        str: The path to the CSV.
+
+    """
+    rng = random.Random(seed)
+    with open(path, "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow([f"column_{index}" for index in range(columns)])
+        for row in range(rows):
+            writer.writerow([row, *(rng.choice(LOREM) if i % 2 else rng.random() for i in range(columns - 1))])
+    return path
+
+
+def generate_xlsx(path: str, sheets: int = 5, rows: int = 2_000, columns: int = 10, seed: int = SEED) -> str:
+    """Generate a spreadsheet with several sheets and an embedded image.
+
+    Args:
+        path (str): The path to write the spreadsheet to.
+        sheets (int, optional): The number of sheets. Defaults to 5.
+        rows (int, optional): The number of rows on each sheet. Defaults to 2,000.
+        columns (int, optional): The number of columns on each sheet. Defaults to 10.
+        seed (int, optional): The seed for the random content. Defaults to SEED.
+
+    Returns:
+        str: The path to the spreadsheet.
+
+    """
+    rng = random.Random(seed)
+    with xlsxwriter.Workbook(path) as workbook:
+        for index in range(sheets):
+            worksheet = workbook.add_worksheet(f"Sheet{index + 1}")
+            for row in range(rows):
+                worksheet.write_row(row, 0, [rng.choice(LOREM) if i % 2 else rng.random() for i in range(columns)])
+        worksheet.insert_image(
+            "B2", "logo.png", {"image_data": io.BytesIO(_png(Image.new("RGB", (120, 40), (200, 30, 30))))}
+        )
+    return path
+
+
+def generate_all(directory: str) -> dict[str, str]:
+    """Generate the full set of benchmark inputs.
+
+    Args:
+        directory (str): The directory to write the inputs to.
+
+    Returns:
+        dict[str, str]: The path of each input, by name.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    return {
+        "pdf_small": generate_pdf(os.path.join(directory, "small.pdf"), pages=2, images=2, duplicates=2),
+        "pdf_large": generate_pdf(
+            os.path.join(directory, "large.pdf"), pages=50, images=40, duplicates=50, split_qr_codes=3
+        ),
+        "html_plain": generate_html(os.path.join(directory, "plain.html")),
+        "html_scripts": generate_html(os.path.join(directory, "scripts.html"), scripts=True),
+        "csv_large": generate_csv(os.path.join(directory, "large.csv")),
+        "xlsx_sheets": generate_xlsx(os.path.join(directory, "sheets.xlsx")),
+    }
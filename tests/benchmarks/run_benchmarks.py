@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+"""Benchmarks of the service's rendering, extraction, QR scanning and conversion stages.
+
+Each benchmark runs in a fresh process so that its peak memory can be measured on its own. Results can be saved as
+a baseline and compared against when benchmarking another revision:
+
+    python tests/benchmarks/run_benchmarks.py --save main
+    python tests/benchmarks/run_benchmarks.py --compare main
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from PIL import Image
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASELINES_FOLDER = os.path.join(BENCHMARKS_FOLDER, "baselines")
+SERVICE_FOLDER = os.path.join(BENCHMARKS_FOLDER, "..", "..")
+
+sys.path[:0] = [BENCHMARKS_FOLDER, SERVICE_FOLDER]
+os.environ.setdefault("SERVICE_MANIFEST_PATH", os.path.join(SERVICE_FOLDER, "service_manifest.yml"))
+
+# Services started by the benchmark running in this process
+_services = []
+
+
+class SkipBenchmark(Exception):
+    """Raised when a benchmark can't run in this environment."""
+
+
+class BenchmarkRequest:
+    """The parts of a service request used by the conversion stages."""
+
+    def __init__(self, file_path: str, file_type: str) -> None:
+        """Initialize the request.
+
+        Args:
+            file_path (str): The path to the file.
+            file_type (str): The Assemblyline file type.
+
+        """
+        self.file_path = file_path
+        self.file_type = file_type
+        self.extracted = []
+
+    @property
+    def file_contents(self) -> bytes:
+        """The content of the file."""
+        with open(self.file_path, "rb") as fh:
+            return fh.read()
+
+    def add_extracted(self, path: str, name: str, description: str, **_) -> None:
+        """Keep track of extracted files."""
+        self.extracted.append(name)
+
+
+def _service(working_directory: str):
+    """Start the service, as needed by benchmarks of stages that use Chrome or DocBuilder.
+
+    Args:
+        working_directory (str): The directory the service writes its output to.
+
+    Returns:
+        DocumentPreview: The started service.
+
+    Raises:
+        SkipBenchmark: If the service can't be started (ie. Chrome isn't installed).
+
+    """
+    try:
+        from document_preview.document_preview import DocumentPreview
+
+        service = DocumentPreview({"render_cache": {"enabled": False}})
+        service.start()
+    except Exception as e:  # noqa: BLE001
+        raise SkipBenchmark(f"unable to start the service: {str(e).splitlines()[0]}")
+    service._working_directory = working_directory
+    _services.append(service)
+    return service
+
+
+def _require(module: str, *names: str) -> list:
+    """Import what a benchmark needs, which may not exist in the revision being benchmarked.
+
+    Args:
+        module (str): The module to import from.
+        *names (str): The names to import.
+
+    Returns:
+        list: The imported objects, in the order given.
+
+    Raises:
+        SkipBenchmark: If the module or any of the names can't be imported.
+
+    """
+    try:
+        imported = importlib.import_module(module)
+        return [getattr(imported, name) for name in names]
+    except (ImportError, AttributeError) as e:
+        raise SkipBenchmark(f"not available in this revision: {e}")
+
+
+def _require_qr_backend() -> None:
+    """Check that QR codes can be decoded.
+
+    Raises:
+        SkipBenchmark: If neither libzbar nor zbarimg is installed.
+
+    """
+    try:
+        from pyzbar import pyzbar  # noqa: F401
+    except ImportError:
+        if not shutil.which("zbarimg"):
+            raise SkipBenchmark("neither libzbar nor zbarimg is installed")
+
+
+# MARK: Benchmarks
+# Each benchmark takes its inputs and a scratch directory, and returns a function running a single iteration along
+# with the number of units (pages, images, rows, etc.) processed per iteration. Benchmarks go through the same calls as
+# the service does, falling back to the service's methods from before they were split out of it, so that any two
+# revisions can be compared. Benchmarks of stages that a revision doesn't have are reported as skipped.
+
+
+def bench_render_pages(inputs: dict[str, str], scratch: str):
+    """Render every page of a large PDF and write them out as PNG.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    try:
+        (analyze_pages,) = _require("document_preview.render", "analyze_pages")
+    except SkipBenchmark:
+        # Pages used to be written straight to disk by the service module
+        (render_pages,) = _require("document_preview.document_preview", "render_pages")
+        return lambda: render_pages(inputs["pdf_large"], scratch), 50, "pages"
+
+    def run() -> None:
+        for page in analyze_pages(inputs["pdf_large"], extract=False).pages:
+            page.save(scratch)
+            page.close()
+
+    return run, 50, "pages"
+
+
+def bench_extract_pdf_text(inputs: dict[str, str], scratch: str):
+    """Extract the text of every page of a large PDF.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    try:
+        (analyze_pages,) = _require("document_preview.render", "analyze_pages")
+    except SkipBenchmark:
+        service = _service(scratch)
+        return lambda: service.extract_pdf_text(inputs["pdf_large"], 50), 50, "pages"
+
+    def run() -> None:
+        "".join(analyze_pages(inputs["pdf_large"], render=False).text)
+
+    return run, 50, "pages"
+
+
+def bench_extract_pdf_images(inputs: dict[str, str], scratch: str):
+    """Extract the images embedded in a large PDF.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    try:
+        (image_extractor,) = _require("document_preview.images", "ImageExtractor")
+        (analyze_pages,) = _require("document_preview.render", "analyze_pages")
+    except SkipBenchmark:
+        service = _service(scratch)
+        references = len(service.extract_pdf_images(inputs["pdf_large"], 50))
+        return lambda: service.extract_pdf_images(inputs["pdf_large"], 50), references, "image references"
+
+    analysis = analyze_pages(inputs["pdf_large"], render=False)
+    references = sum(len(page_images) for page_images in analysis.images)
+
+    def run() -> None:
+        image_extractor(tempfile.mkdtemp(dir=scratch), min_dimension=16).extract(analysis)
+
+    return run, references, "image references"
+
+
+def bench_scan_for_QR_codes(inputs: dict[str, str], scratch: str):
+    """Scan rendered pages and embedded images (including split codes) for QR codes.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    _require_qr_backend()
+    try:
+        batch_scan, iter_candidates, scan_candidates = _require(
+            "document_preview.qr", "batch_scan_for_QR_codes", "iter_qr_candidates", "scan_qr_candidates"
+        )
+        (image_extractor,) = _require("document_preview.images", "ImageExtractor")
+        (analyze_pages,) = _require("document_preview.render", "analyze_pages")
+    except SkipBenchmark:
+        # Each image used to be scanned on its own by the service
+        service = _service(scratch)
+        (render_pages,) = _require("document_preview.document_preview", "render_pages")
+        render_pages(inputs["pdf_small"], scratch)
+        images = [Image.open(os.path.join(scratch, name)) for name in sorted(os.listdir(scratch))]
+        images += [Image.open(path) for path in service.extract_pdf_images(inputs["pdf_large"], 50)]
+        return lambda: [service.scan_for_QR_codes(image) for image in images], len(images), "images"
+
+    pages = [page.grayscale() for page in analyze_pages(inputs["pdf_small"], extract=False).pages]
+    embedded_images = image_extractor(scratch).extract(analyze_pages(inputs["pdf_large"], render=False))
+
+    def run() -> None:
+        batch_scan(pages)
+        scan_candidates(iter_candidates(embedded_images))
+
+    return run, len(pages) + len(embedded_images), "images"
+
+
+def bench_html_render(inputs: dict[str, str], scratch: str):
+    """Render HTML documents through the browser.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    service = _service(scratch)
+    contents = [BenchmarkRequest(inputs[name], "code/html") for name in ("html_plain", "html_scripts")]
+
+    def run() -> None:
+        for request in contents:
+            service.render_documents(request, max_pages=5)
+
+    return run, len(contents), "documents"
+
+
+def bench_office_conversion(inputs: dict[str, str], scratch: str):
+    """Convert a spreadsheet and a CSV to PDF.
+
+    Args:
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        scratch (str): A directory to write to.
+
+    Returns:
+        tuple: The function running an iteration, the number of units per iteration and the name of the units.
+
+    """
+    service = _service(scratch)
+    requests = [
+        BenchmarkRequest(inputs["xlsx_sheets"], "document/office/excel"),
+        BenchmarkRequest(inputs["csv_large"], "text/csv"),
+    ]
+
+    def run() -> None:
+        for request in requests:
+            service.render_documents(request, max_pages=5)
+
+    return run, len(requests), "documents"
+
+
+BENCHMARKS = {
+    "render_pages": bench_render_pages,
+    "extract_pdf_text": bench_extract_pdf_text,
+    "extract_pdf_images": bench_extract_pdf_images,
+    "scan_for_QR_codes": bench_scan_for_QR_codes,
+    "html_render": bench_html_render,
+    "office_conversion": bench_office_conversion,
+}
+
+
+def run_benchmark(name: str, inputs: dict[str, str], iterations: int) -> dict:
+    """Run a benchmark (inside its own process).
+
+    Args:
+        name (str): The name of the benchmark.
+        inputs (dict[str, str]): The paths of the generated inputs, by name.
+        iterations (int): The number of times to run the benchmark, after a warm-up run.
+
+    Returns:
+        dict: The results of the benchmark, or the reason it was skipped.
+
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        try:
+            run, units, unit_name = BENCHMARKS[name](inputs, scratch)
+            # Warm up any caches, pools and browsers
+            run()
+        except SkipBenchmark as e:
+            return {"skipped": str(e)}
+
+        # Benchmarks going through the service also have the time taken by each of its stages
+        from document_preview.metrics import StageMetrics
+
+        for service in _services:
+            service.metrics = StageMetrics()
+
+        timings = []
+        for _ in range(iterations):
+            start = perf_counter()
+            run()
+            timings.append(perf_counter() - start)
+        service_stages = {
+            stage: {"calls": metrics["calls"], "wall_s": round(metrics["wall_s"] / iterations, 4)}
+            for service in _services
+            for stage, metrics in service.metrics.as_dict().items()
+        }
+        for service in _services:
+            service.stop()
+
+    median = statistics.median(timings)
+    results = {
+        "iterations": iterations,
+        "units": units,
+        "unit_name": unit_name,
+        "median_s": round(median, 4),
+        "min_s": round(min(timings), 4),
+        "max_s": round(max(timings), 4),
+        "throughput": round(units / median, 2) if median else None,
+        # Reported in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if service_stages:
+        results["stages"] = service_stages
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    """Compare results against a baseline.
+
+    Args:
+        results (dict[str, dict]): The results of this run, by benchmark.
+        baseline (dict[str, dict]): The results of the baseline, by benchmark.
+        threshold (float): The relative increase in time or memory that's considered a regression.
+
+    Returns:
+        list[str]: A description of each regression.
+
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if "skipped" in current or not previous or "skipped" in previous:
+            continue
+        for key in ("median_s", "peak_rss_mb"):
+            change = (current[key] - previous[key]) / previous[key] if previous[key] else 0
+            print(f"  {name:<20} {key:<12} {previous[key]:>10} -> {current[key]:>10} ({change:+.1%})")
+            if change > threshold:
+                regressions.append(f"{name} {key} increased by {change:.1%}")
+    return regressions
+
+
+def main() -> int:
+    """Run the benchmarks.
+
+    Returns:
+        int: The exit code, non-zero if regressions were found against the baseline.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"Benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("-n", "--iterations", type=int, default=5, help="Iterations of each benchmark")
+    parser.add_argument("--save", metavar="NAME", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Compare the results against a baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative increase considered a regression (default: 0.2)"
+    )
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    from generators import generate_all
+
+    with tempfile.TemporaryDirectory() as input_directory:
+        print("Generating inputs..")
+        inputs = generate_all(input_directory)
+
+        results = {}
+        for name in args.benchmarks or BENCHMARKS:
+            # Run each benchmark in a fresh process so its peak memory isn't affected by the others
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[name] = executor.submit(run_benchmark, name, inputs, args.iterations).result()
+
+            if "skipped" in results[name]:
+                print(f"{name:<20} skipped: {results[name]['skipped']}")
+            else:
+                r = results[name]
+                print(
+                    f"{name:<20} median {r['median_s']:>8.3f}s  {r['throughput']:>10} {r['unit_name']}/s  "
+                    f"peak RSS {r['peak_rss_mb']:>8.1f}MB"
+                )
+
+    regressions = []
+    if args.compare:
+        with open(os.path.join(BASELINES_FOLDER, f"{args.compare}.json")) as fh:
+            baseline = json.load(fh)
+        print(f"Comparing against baseline {args.compare} ({baseline.get('revision') or 'unknown revision'}):")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+
+    if args.save:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=SERVICE_FOLDER, check=False
+        ).stdout.strip()
+        os.makedirs(BASELINES_FOLDER, exist_ok=True)
+        with open(os.path.join(BASELINES_FOLDER, f"{args.save}.json"), "w") as fh:
+            json.dump({"revision": revision, "python": platform.python_version(), "results": results}, fh, indent=2)
+        print(f"Saved baseline {args.save}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Tests for handing out files to the worker processes of a batch."""
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from document_preview import batch
+from document_preview.batch import run_pool
+
+
+def _process(path: str) -> dict:
+    """Pretend to analyze a file, the worker process dies on the file named "crash".
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        dict: The result of the file.
+
+    """
+    if path == "crash":
+        os._exit(1)
+    return {"path": path, "status": "completed"}
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    """Create a pool whose workers pretend to analyze files.
+
+    Yields:
+        ProcessPoolExecutor: The pool.
+
+    """
+    # Forked workers see the replaced analysis
+    monkeypatch.setattr(batch, "_process", _process)
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as executor:
+        yield executor
+
+
+def test_processes_all_files(executor):
+    """Every file is processed, and its result written as soon as it's done."""
+    written = []
+    queue = deque(["a", "b", "c", "d", "e"])
+
+    assert run_pool(executor, queue, 2, written.append) == []
+    assert sorted(record["path"] for record in written) == ["a", "b", "c", "d", "e"]
+    assert not queue
+
+
+def test_stops_when_a_worker_dies(executor):
+    """A worker dying only takes down the files in flight, the others are left for the next pool."""
+    written = []
+    queue = deque(["a", "crash", "b", "c"])
+
+    broken = run_pool(executor, queue, 1, written.append)
+
+    assert broken == ["crash"]
+    assert written == [{"path": "a", "status": "completed"}]
+    assert list(queue) == ["b", "c"]
@@ -0,0 +1,168 @@
+"""Tests for the pool of browser sessions."""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from selenium.webdriver import ChromeOptions
+
+from document_preview import browser
+from document_preview.browser import BrowserPool
+
+
+class FakeChrome:
+    """Stands in for a browser, with a home tab that can be closed and commands that can hang."""
+
+    def __init__(self, options: ChromeOptions, service: object = None) -> None:
+        """Launch the browser.
+
+        Args:
+            options (ChromeOptions): The options to launch the browser with.
+            service (object, optional): The chromedriver service. Defaults to None.
+
+        """
+        self.current_window_handle = "home"
+        self.handles = ["home"]
+        self.quit_called = False
+        self.killed = False
+        # Commands block while the browser is hung
+        self.responding = threading.Event()
+        self.responding.set()
+        self.service = SimpleNamespace(process=SimpleNamespace(kill=self.kill))
+        self.switch_to = SimpleNamespace(window=self.switch_to_window)
+
+    def set_network_conditions(self, **conditions) -> None:
+        """Throttle the network of the browser."""
+
+    def set_window_size(self, width: int, height: int) -> None:
+        """Resize the window of the browser."""
+
+    @property
+    def window_handles(self) -> list[str]:
+        """The handles of the open windows."""
+        self.responding.wait()
+        return list(self.handles)
+
+    def switch_to_window(self, handle: str) -> None:
+        """Switch to a window.
+
+        Args:
+            handle (str): The handle of the window.
+
+        """
+        self.current_window_handle = handle
+
+    def close(self) -> None:
+        """Close the current window."""
+        self.handles.remove(self.current_window_handle)
+
+    def quit(self) -> None:
+        """Shut down the browser."""
+        self.responding.wait()
+        self.quit_called = True
+
+    def kill(self) -> None:
+        """Kill the browser."""
+        self.killed = True
+        self.responding.set()
+
+
+@pytest.fixture
+def drivers(monkeypatch):
+    """Have browser sessions launch fake browsers.
+
+    Returns:
+        list[FakeChrome]: The browsers launched, in order.
+
+    """
+    launched = []
+
+    def launch(options, service=None):
+        launched.append(FakeChrome(options, service))
+        return launched[-1]
+
+    monkeypatch.setattr(browser, "Chrome", launch)
+    return launched
+
+
+def _render(pool: BrowserPool, popups: int = 0) -> FakeChrome:
+    """Borrow a browser from the pool, opening windows as a page would.
+
+    Args:
+        pool (BrowserPool): The pool.
+        popups (int, optional): The number of windows to open. Defaults to 0.
+
+    Returns:
+        FakeChrome: The browser used.
+
+    """
+    with pool.session() as driver:
+        driver.handles += [f"popup-{index}" for index in range(popups)]
+        return driver
+
+
+def test_reuses_sessions(drivers):
+    """Browsers are launched on first use, and reused with only their home tab left open."""
+    pool = BrowserPool(ChromeOptions())
+    assert drivers == []
+
+    first = _render(pool, popups=2)
+
+    assert _render(pool) is first
+    assert first.handles == ["home"]
+    pool.close()
+    assert first.quit_called
+
+
+def test_recycles_after_max_uses(drivers):
+    """A browser is relaunched once it's been used for the maximum number of renders."""
+    pool = BrowserPool(ChromeOptions(), max_uses=2)
+
+    renders = [_render(pool) for _ in range(3)]
+
+    assert renders[1] is renders[0]
+    assert renders[2] is not renders[0]
+    assert renders[0].quit_called
+    pool.close()
+
+
+def test_relaunches_broken_browser(drivers):
+    """A browser whose home tab was closed is relaunched."""
+    pool = BrowserPool(ChromeOptions())
+    first = _render(pool)
+    first.handles.clear()
+
+    assert _render(pool) is not first
+    assert first.quit_called
+    pool.close()
+
+
+def test_relaunches_hung_browser(drivers):
+    """A browser that stops answering is killed and relaunched once the command timeout is reached."""
+    pool = BrowserPool(ChromeOptions(), command_timeout=0.1)
+    first = _render(pool)
+    first.responding.clear()
+
+    start = time.monotonic()
+    assert _render(pool) is not first
+    assert time.monotonic() - start < 1
+    assert first.killed
+    pool.close()
+
+
+def test_shuts_down_idle_browsers(drivers):
+    """Browsers that haven't been used for the idle timeout are shut down."""
+    pool = BrowserPool(ChromeOptions(), idle_timeout=0.1)
+    first = _render(pool)
+
+    for _ in range(50):
+        if first.quit_called:
+            break
+        time.sleep(0.05)
+    assert first.quit_called
+    assert pool._idle == []
+
+    # The next render launches a new browser
+    assert _render(pool) is not first
+    pool.close()
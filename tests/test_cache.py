@@ -0,0 +1,100 @@
+"""Tests for the on-disk cache of converted documents and rendered pages."""
+
+import os
+
+import pytest
+
+from document_preview.cache import RenderCache
+
+
+def _write(path: str, size: int) -> str:
+    """Write a file of the given size.
+
+    Args:
+        path (str): The path to the file.
+        size (int): The size of the file in bytes.
+
+    Returns:
+        str: The path to the file.
+
+    """
+    with open(path, "wb") as fh:
+        fh.write(os.urandom(size))
+    return path
+
+
+@pytest.fixture
+def rendered(tmp_path):
+    """Write a converted PDF and its rendered pages, as they would be in the working directory.
+
+    Returns:
+        tuple: The context and path of the PDF, and the paths of the pages.
+
+    """
+    working_directory = tmp_path / "rendered"
+    working_directory.mkdir()
+    pdf_paths = [("original", _write(str(working_directory / "converted.pdf"), 1000))]
+    page_paths = [_write(str(working_directory / f"output_original-{page}.png"), 2000) for page in (1, 2)]
+    return pdf_paths, page_paths
+
+
+def test_fetch_after_store(tmp_path, rendered):
+    """A stored entry is copied into the output directory as it was stored."""
+    pdf_paths, page_paths = rendered
+    cache = RenderCache(str(tmp_path / "cache"))
+    key = RenderCache.key("sha256", "document/pdf", 5)
+    cache.store(key, pdf_paths, page_paths)
+
+    output_directory = tmp_path / "output"
+    output_directory.mkdir()
+    fetched = cache.fetch(key, str(output_directory))
+
+    assert [context for context, _ in fetched] == ["original"]
+    with open(fetched[0][1], "rb") as fh, open(pdf_paths[0][1], "rb") as original:
+        assert fh.read() == original.read()
+    assert sorted(os.listdir(output_directory)) == [
+        "cached_original.pdf",
+        "output_original-1.png",
+        "output_original-2.png",
+    ]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_fetch_missing(tmp_path):
+    """Fetching an entry that isn't cached copies nothing."""
+    cache = RenderCache(str(tmp_path / "cache"))
+    output_directory = tmp_path / "output"
+    output_directory.mkdir()
+
+    assert cache.fetch(RenderCache.key("sha256"), str(output_directory)) is None
+    assert os.listdir(output_directory) == []
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_key_covers_parameters():
+    """Entries rendered with different parameters don't share a key."""
+    assert RenderCache.key("sha256", {"dpi": 96}) == RenderCache.key("sha256", {"dpi": 96})
+    assert RenderCache.key("sha256", {"dpi": 96}) != RenderCache.key("sha256", {"dpi": 150})
+
+
+def test_evicts_least_recently_used(tmp_path, rendered):
+    """Once the cache goes over its size, the entries used the longest time ago are evicted first."""
+    pdf_paths, page_paths = rendered
+    cache = RenderCache(str(tmp_path / "cache"))
+    # Each entry takes 5000 bytes, leave room for two
+    cache.max_size = 12000
+    keys = [RenderCache.key("sha256", index) for index in range(3)]
+    output_directory = tmp_path / "output"
+
+    cache.store(keys[0], pdf_paths, page_paths)
+    cache.store(keys[1], pdf_paths, page_paths)
+    # Both entries were stored a while ago, using the first one makes the second the least recently used
+    entries = [cache._entry_path(key) for key in keys]
+    os.utime(entries[0], (1, 1))
+    os.utime(entries[1], (2, 2))
+    output_directory.mkdir()
+    assert cache.fetch(keys[0], str(output_directory))
+    cache.store(keys[2], pdf_paths, page_paths)
+
+    assert [os.path.exists(entry) for entry in entries] == [True, False, True]
+    assert not [name for name in os.listdir(cache.directory) if name.startswith(".")]
@@ -0,0 +1,140 @@
+"""Tests for the long-lived conversion worker."""
+
+import textwrap
+
+import pytest
+
+from document_preview.conversion import ConversionError, ConversionTimeout, ConversionWorker
+
+# Stands in for DocBuilder in the worker process, behaving according to the content of the document it's given
+FAKE_DOCBUILDER = """
+import os
+import time
+
+
+class CDocBuilder:
+    def OpenFile(self, fp, params):
+        with open(fp) as fh:
+            self.content = fh.read()
+        if self.content == "hang":
+            time.sleep(60)
+        if self.content == "crash":
+            os._exit(1)
+        if self.content == "invalid":
+            raise RuntimeError("invalid document")
+
+    def SaveFile(self, fmt, output_path):
+        with open(output_path, "w") as fh:
+            fh.write(f"{fmt} {os.getpid()}")
+
+    def CloseFile(self):
+        if self.content == "stuck":
+            raise RuntimeError("unable to close")
+"""
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    """Create a conversion worker that converts documents with a fake DocBuilder.
+
+    Yields:
+        ConversionWorker: The worker, stopped once the test is done.
+
+    """
+    package = tmp_path / "fake" / "documentbuilder"
+    package.mkdir(parents=True)
+    (package / "__init__.py").write_text("")
+    (package / "docbuilder.py").write_text(textwrap.dedent(FAKE_DOCBUILDER))
+    # The worker process is started with the path of the test process
+    monkeypatch.syspath_prepend(str(tmp_path / "fake"))
+
+    worker = ConversionWorker(timeout=5, max_conversions=0, max_rss_mb=0)
+    yield worker
+    worker.stop()
+
+
+def _document(tmp_path, content: str) -> str:
+    """Write a document the fake DocBuilder reacts to.
+
+    Args:
+        tmp_path (Path): The directory to write the document to.
+        content (str): What the fake DocBuilder should do with it.
+
+    Returns:
+        str: The path to the document.
+
+    """
+    path = tmp_path / f"{content}.docx"
+    path.write_text(content)
+    return str(path)
+
+
+def _convert(worker: ConversionWorker, tmp_path, content: str = "valid") -> int:
+    """Convert a document.
+
+    Args:
+        worker (ConversionWorker): The worker.
+        tmp_path (Path): The directory to write the document and the PDF to.
+        content (str, optional): What the fake DocBuilder should do with the document. Defaults to "valid".
+
+    Returns:
+        int: The process ID of the worker that converted the document.
+
+    """
+    output_path = tmp_path / "converted.pdf"
+    worker.convert(_document(tmp_path, content), str(output_path))
+    return int(output_path.read_text().split()[1])
+
+
+def test_reuses_worker(worker, tmp_path):
+    """Documents are converted one after the other by the same process."""
+    first = _convert(worker, tmp_path)
+
+    assert _convert(worker, tmp_path) == first
+    assert worker.conversions == 2
+
+
+def test_failed_conversion_keeps_worker(worker, tmp_path):
+    """A document the worker can't convert is reported, and the worker carries on with the next one."""
+    first = _convert(worker, tmp_path)
+
+    with pytest.raises(ConversionError, match="invalid document"):
+        _convert(worker, tmp_path, "invalid")
+    assert _convert(worker, tmp_path) == first
+
+
+def test_kills_worker_on_timeout(worker, tmp_path):
+    """A conversion that doesn't finish in time kills the worker, and the next one gets a new worker."""
+    worker.timeout = 1
+    first = _convert(worker, tmp_path)
+
+    with pytest.raises(ConversionTimeout):
+        _convert(worker, tmp_path, "hang")
+    assert worker._process is None
+    assert _convert(worker, tmp_path) != first
+
+
+def test_replaces_crashed_worker(worker, tmp_path):
+    """A worker that dies during a conversion is replaced for the next one."""
+    first = _convert(worker, tmp_path)
+
+    with pytest.raises(ConversionError, match="terminated unexpectedly"):
+        _convert(worker, tmp_path, "crash")
+    assert _convert(worker, tmp_path) != first
+
+
+def test_replaces_worker_unable_to_close_document(worker, tmp_path):
+    """A worker that can't close a document isn't given another one."""
+    first = _convert(worker, tmp_path, "stuck")
+
+    assert _convert(worker, tmp_path) != first
+
+
+def test_recycles_after_max_conversions(worker, tmp_path):
+    """The worker is restarted once it's done the maximum number of conversions."""
+    worker.max_conversions = 2
+    first = _convert(worker, tmp_path)
+
+    assert _convert(worker, tmp_path) == first
+    assert worker._process is None
+    assert _convert(worker, tmp_path) != first
@@ -0,0 +1,59 @@
+"""Tests for the time budget shared by the stages of an analysis."""
+
+import pytest
+
+from document_preview import deadline as deadline_module
+from document_preview.deadline import Deadline
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the clock the deadline reads with one the test moves forward.
+
+    Returns:
+        list[float]: The current time, in seconds.
+
+    """
+    now = [100.0]
+    monkeypatch.setattr(deadline_module, "monotonic", lambda: now[0])
+    return now
+
+
+def test_no_budget_always_allows(clock):
+    """Without a budget, every stage runs however long the analysis took."""
+    deadline = Deadline(costs={"ocr": 5})
+    clock[0] += 10000
+
+    assert deadline.remaining() is None
+    assert deadline.allows("ocr")
+    assert deadline.skipped == {}
+
+
+def test_remaining_excludes_reserve(clock):
+    """The time left to optional stages is what's left of the budget before the reserve."""
+    deadline = Deadline(budget=60, reserve=10)
+    clock[0] += 20
+
+    assert deadline.remaining() == 30
+    clock[0] += 100
+    assert deadline.remaining() == 0
+
+
+def test_refuses_stages_that_cost_more_than_remaining(clock):
+    """A stage is skipped once the time left isn't more than its least cost, and the reason recorded."""
+    deadline = Deadline(budget=60, reserve=10, costs={"ocr": 5})
+    clock[0] += 46
+
+    assert deadline.allows("text_extraction")
+    assert not deadline.allows("ocr")
+    assert deadline.skipped == {"ocr": "Not enough time left (4.0s, needs at least 5s)"}
+
+
+def test_skip_recorded_once(clock):
+    """Only the first reason a stage was skipped is kept."""
+    deadline = Deadline(budget=60)
+    deadline.skip("render_pages", "first")
+    deadline.skip("render_pages", "second")
+    deadline.skip("ocr", "third")
+
+    assert deadline.skipped == {"render_pages": "first", "ocr": "third"}
@@ -0,0 +1,194 @@
+"""Tests for the extraction of images embedded in documents."""
+
+import io
+import random
+from zipfile import ZipFile
+
+import fitz
+import pytest
+from PIL import Image
+
+from document_preview.images import ImageExtractor, extract_office_images, is_image
+from document_preview.render import analyze_pages
+
+
+def _png(side: int, seed: int) -> bytes:
+    """Generate a square PNG of noise.
+
+    Args:
+        side (int): The width and height of the image.
+        seed (int): Picks the noise, images with different seeds have different content.
+
+    Returns:
+        bytes: The PNG.
+
+    """
+    rng = random.Random(seed)
+    image = Image.new("L", (side, side))
+    image.putdata([rng.randrange(256) for _ in range(side * side)])
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _pixels(fp: str | io.BytesIO) -> bytes:
+    """Decode an image to grayscale.
+
+    Args:
+        fp (str | io.BytesIO): The image.
+
+    Returns:
+        bytes: The pixels of the image.
+
+    """
+    with Image.open(fp) as image:
+        return image.convert("L").tobytes()
+
+
+def _document(tmp_path, pages: list[list[bytes]]) -> str:
+    """Write a PDF with the given images on each page, each page stored with its own copy of its images.
+
+    Args:
+        tmp_path (Path): The directory to write the PDF to.
+        pages (list[list[bytes]]): The images on each page.
+
+    Returns:
+        str: The path to the PDF.
+
+    """
+    doc = fitz.open()
+    for images in pages:
+        # Pages built separately don't share their images
+        page_doc = fitz.open()
+        page = page_doc.new_page()
+        for index, image in enumerate(images):
+            page.insert_image(fitz.Rect(0, index * 100, 100, index * 100 + 100), stream=image)
+        doc.insert_pdf(page_doc)
+    path = str(tmp_path / "document.pdf")
+    doc.save(path)
+    return path
+
+
+def test_extracts_each_image_once(tmp_path):
+    """An image is written out once, however many pages or xrefs it's stored under, and remembers its pages."""
+    first, second = _png(64, 1), _png(64, 2)
+    fp = _document(tmp_path, [[first], [first, second], [second, first]])
+    output_directory = tmp_path / "images"
+    output_directory.mkdir()
+    extractor = ImageExtractor(str(output_directory))
+    analysis = analyze_pages(fp, render=False)
+
+    images = extractor.extract(analysis)
+
+    assert [image.pages for image in images] == [[1, 2, 3], [2, 3]]
+    assert [_pixels(image.path) for image in images] == [_pixels(io.BytesIO(first)), _pixels(io.BytesIO(second))]
+    assert len(list(output_directory.iterdir())) == 2
+    # Documents visited again (ie. several contexts of the same file) don't extract the images again
+    assert extractor.extract(analysis) == []
+
+
+def test_skips_images_outside_of_limits(tmp_path):
+    """Images too small, too large or with too much data aren't extracted."""
+    icon, image, large = _png(8, 1), _png(64, 2), _png(200, 3)
+    fp = _document(tmp_path, [[icon, image, large]])
+    analysis = analyze_pages(fp, render=False)
+
+    def extracted(**limits) -> list[tuple[int, int]]:
+        return [image.size for image in ImageExtractor(str(tmp_path), **limits).extract(analysis)]
+
+    assert extracted() == [(64, 64), (200, 200)]
+    assert extracted(max_dimension=100) == [(64, 64)]
+    # 64x64 pixels of noise take about 4KB, 200x200 about 40KB
+    assert extracted(max_bytes=10000) == [(64, 64)]
+    assert extracted(min_dimension=0, max_dimension=0, max_bytes=0) == [(8, 8), (64, 64), (200, 200)]
+
+
+# How SVG images exported by Illustrator start
+ILLUSTRATOR_SVG = (
+    b'<?xml version="1.0"?>\n<!-- Generator: Adobe Illustrator 24.0.0, SVG Export Plug-In . SVG Version: 6.00 '
+    b'Build 0)  -->\n<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+    b'"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd" [\n\t<!ENTITY ns_graphs "http://ns.adobe.com/Graphs/1.0/">'
+    b'\n]>\n<SVG version="1.1">'
+)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR",
+        b"\x00\x00\x00\x0cjP  \r\n\x87\n\x00\x00\x00\x14ftypjp2 ",
+        b"\xffO\xffQ\x00/\x00\x00",
+        b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic",
+        b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00avifmif1miaf",
+        b'<svg xmlns="http://www.w3.org/2000/svg"/>',
+        b'\xef\xbb\xbf<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<svg>',
+        ILLUSTRATOR_SVG,
+    ],
+)
+def test_recognizes_images(header):
+    """Images are recognized from their header, including SVG images preceded by a long prolog."""
+    assert is_image(header)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"",
+        b"PK\x03\x04\x14\x00\x06\x00",
+        b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom",
+        b'<?xml version="1.0"?>\n<document><!-- <svg> --></document>',
+        b"Plain text that mentions <svg> images",
+    ],
+)
+def test_rejects_other_files(header):
+    """Files that aren't images, including XML and videos, aren't mistaken for images."""
+    assert not is_image(header)
+
+
+def test_extracts_office_media_once(tmp_path):
+    """Media stored several times in an Office document is extracted once, and only if it's an image."""
+    image = _png(16, 1)
+    fp = str(tmp_path / "document.docx")
+    with ZipFile(fp, "w") as zf:
+        zf.writestr("word/document.xml", "<document/>")
+        zf.writestr("word/media/image1.png", image)
+        zf.writestr("word/media/image2.png", image)
+        zf.writestr("word/media/video.mp4", b"\x00\x00\x00\x18ftypmp42")
+        zf.writestr("word/media/image3.png", _png(16, 2))
+        zf.writestr("word/embeddings/image.png", image)
+    output_directory = str(tmp_path / "media")
+
+    images = extract_office_images(fp, output_directory)
+
+    assert [name for _, name in images] == ["word/media/image1.png", "word/media/image3.png"]
+    with open(images[0][0], "rb") as fh:
+        assert fh.read() == image
+
+
+def test_office_media_limits(tmp_path):
+    """Media is only looked at up to the limits on the number and size of media files."""
+    fp = str(tmp_path / "document.docx")
+    with ZipFile(fp, "w") as zf:
+        for index in range(4):
+            zf.writestr(f"word/media/image{index}.png", _png(16 * (index + 1), index))
+
+    def extracted(**limits) -> list[str]:
+        return [name for _, name in extract_office_images(fp, str(tmp_path / "media"), **limits)]
+
+    assert len(extracted()) == 4
+    assert extracted(max_members=2) == ["word/media/image0.png", "word/media/image1.png"]
+    sizes = [len(_png(16 * (index + 1), index)) for index in range(4)]
+    assert extracted(max_member_size=sizes[2]) == [
+        "word/media/image0.png",
+        "word/media/image1.png",
+        "word/media/image2.png",
+    ]
+    assert extracted(max_total_size=sizes[0] + sizes[1]) == ["word/media/image0.png", "word/media/image1.png"]
+
+
+def test_not_a_zip(tmp_path):
+    """Documents that aren't ZIP containers have no media to extract."""
+    fp = tmp_path / "document.doc"
+    fp.write_bytes(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")
+
+    assert extract_office_images(str(fp), str(tmp_path / "media")) == []
@@ -0,0 +1,45 @@
+"""Tests for the incremental detection of indicators in extracted text."""
+
+import pytest
+from assemblyline_v4_service.common.ocr import OCR_INDICATORS_TERMS, OCR_INDICATORS_THRESHOLD, detections
+
+from document_preview.indicators import IndicatorDetector
+
+PAGES = [
+    "Your files were encrypted\nDownload the Tor Browser to pay\n",
+    "Install Tor from www torproject org\nThe PASSWORD is 1234\n",
+    "Nothing to see here\n",
+    "Enable Content to view this document\nDownload the Tor Browser to pay\n",
+    "Enable Editing, then Enable Macros\n",
+]
+
+
+@pytest.fixture(autouse=True)
+def thresholds(monkeypatch):
+    """Set a hit threshold for every indicator, as the service does when it starts."""
+    for indicator in OCR_INDICATORS_TERMS:
+        if indicator not in OCR_INDICATORS_THRESHOLD:
+            monkeypatch.setitem(OCR_INDICATORS_THRESHOLD, indicator, 1)
+
+
+@pytest.mark.parametrize("pages", [PAGES, PAGES[:1], PAGES[2:3], PAGES[::-1], []])
+def test_matches_detections_over_the_whole_text(pages):
+    """Feeding the text a page at a time finds what the service base finds in all of the text at once."""
+    detector = IndicatorDetector()
+    for page in pages:
+        detector.feed(page)
+
+    assert detector.detections == detections("".join(pages))
+
+
+def test_threshold_spans_pages(monkeypatch):
+    """Distinct terms found on different pages count towards the same threshold."""
+    indicator, terms = next((indicator, terms) for indicator, terms in OCR_INDICATORS_TERMS.items() if len(terms) >= 2)
+    monkeypatch.setitem(OCR_INDICATORS_THRESHOLD, indicator, 2)
+    detector = IndicatorDetector()
+
+    detector.feed(f"first {terms[0]}\n")
+    assert indicator not in detector.detections
+
+    detector.feed(f"second {terms[1].upper()}\n")
+    assert detector.detections[indicator] == [f"first {terms[0]}", f"second {terms[1].upper()}"]
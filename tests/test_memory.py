@@ -0,0 +1,49 @@
+"""Tests for the cache bounded by the memory its values hold."""
+
+from document_preview.memory import ByteBudgetCache
+
+
+def test_caches_loaded_values():
+    """A value is only loaded the first time it's asked for."""
+    loads = []
+    cache = ByteBudgetCache(100, sizeof=len)
+
+    for _ in range(3):
+        assert cache.get_or_load("key", lambda: loads.append("key") or "value") == "value"
+
+    assert loads == ["key"]
+    assert (len(cache), cache.size) == (1, 5)
+
+
+def test_evicts_least_recently_used():
+    """Once the values go over the budget, those used the longest time ago are evicted first."""
+    cache = ByteBudgetCache(10, sizeof=len)
+    cache.get_or_load("a", lambda: "aaaa")
+    cache.get_or_load("b", lambda: "bbbb")
+    cache.get_or_load("a", lambda: "unused")
+    cache.get_or_load("c", lambda: "cccc")
+
+    assert list(cache._entries) == ["a", "c"]
+    assert cache.size == 8
+
+
+def test_oversized_values_not_cached():
+    """A value larger than the whole budget is returned without evicting anything."""
+    cache = ByteBudgetCache(10, sizeof=len)
+    cache.get_or_load("a", lambda: "aaaa")
+
+    assert cache.get_or_load("big", lambda: "x" * 11) == "x" * 11
+    assert list(cache._entries) == ["a"]
+
+
+def test_clear_closes_values():
+    """Clearing the cache closes every value still in it."""
+    closed = []
+    cache = ByteBudgetCache(10, sizeof=len, close=closed.append)
+    cache.get_or_load("a", lambda: "aaaa")
+    cache.get_or_load("b", lambda: "bbbb")
+
+    cache.clear()
+
+    assert sorted(closed) == ["aaaa", "bbbb"]
+    assert (len(cache), cache.size) == (0, 0)
@@ -0,0 +1,356 @@
+"""Tests for the conversion of Outlook messages to email messages."""
+
+import os
+import shutil
+import struct
+import subprocess
+from email import message_from_bytes, policy
+from email.utils import getaddresses, parsedate_to_datetime
+from itertools import pairwise
+
+import olefile
+import pytest
+from cart import unpack_file
+
+from document_preview.msg import MsgParseError, msg_to_email
+
+SAMPLES_FOLDER = os.path.join(os.path.dirname(__file__), "samples")
+RESULTS_FOLDER = os.path.join(os.path.dirname(__file__), "results")
+
+# Sector markers of a compound file
+END_OF_CHAIN, FREE_SECTOR, FAT_SECTOR, NO_STREAM = 0xFFFFFFFE, 0xFFFFFFFF, 0xFFFFFFFD, 0xFFFFFFFF
+SECTOR_SIZE, MINI_SECTOR_SIZE, MINI_STREAM_CUTOFF = 512, 64, 4096
+
+
+def _write_compound_file(path: str, tree: dict) -> None:
+    """Write a minimal OLE compound file, as Outlook stores messages.
+
+    Args:
+        path (str): The path to write the file to.
+        tree (dict): The streams (bytes) and storages (dict) of the root storage, by name.
+
+    """
+    # Name, type (1: storage, 2: stream, 5: root), children and data of each directory entry
+    entries = []
+
+    def add(name: str, node: bytes | dict, entry_type: int = 0) -> int:
+        index = len(entries)
+        if isinstance(node, dict):
+            entries.append([name, entry_type or 1, [], b""])
+            entries[index][2] = [add(child, value) for child, value in node.items()]
+        else:
+            entries.append([name, 2, [], node])
+        return index
+
+    add("Root Entry", tree, 5)
+
+    def sectors(size: int, sector_size: int = SECTOR_SIZE) -> int:
+        return (size + sector_size - 1) // sector_size
+
+    # Small streams go in the mini stream, larger ones get sectors of their own
+    start, mini_stream, mini_fat = {}, b"", []
+    large = [i for i, entry in enumerate(entries) if entry[1] == 2 and len(entry[3]) >= MINI_STREAM_CUTOFF]
+    for i, (_, entry_type, _, data) in enumerate(entries):
+        if entry_type != 2 or len(data) >= MINI_STREAM_CUTOFF:
+            continue
+        count = sectors(len(data), MINI_SECTOR_SIZE)
+        start[i] = len(mini_fat) if count else END_OF_CHAIN
+        mini_fat += [len(mini_fat) + k + 1 for k in range(count - 1)] + [END_OF_CHAIN] * bool(count)
+        mini_stream += data.ljust(count * MINI_SECTOR_SIZE, b"\0")
+
+    directory_sectors = sectors(len(entries) * 128)
+    mini_fat_sectors = sectors(len(mini_fat) * 4)
+    data_sectors = (
+        directory_sectors
+        + mini_fat_sectors
+        + sectors(len(mini_stream))
+        + sum(sectors(len(entries[i][3])) for i in large)
+    )
+    fat_sectors = 1
+    while data_sectors + fat_sectors > fat_sectors * SECTOR_SIZE // 4:
+        fat_sectors += 1
+    fat = [FAT_SECTOR] * fat_sectors
+
+    def chain(count: int) -> int:
+        if not count:
+            return END_OF_CHAIN
+        first = len(fat)
+        fat.extend([first + k + 1 for k in range(count - 1)] + [END_OF_CHAIN])
+        return first
+
+    directory_start = chain(directory_sectors)
+    mini_fat_start = chain(mini_fat_sectors)
+    mini_stream_start = chain(sectors(len(mini_stream)))
+    for i in large:
+        start[i] = chain(sectors(len(entries[i][3])))
+    fat += [FREE_SECTOR] * (fat_sectors * SECTOR_SIZE // 4 - len(fat))
+
+    directory = bytearray()
+    for i, (name, entry_type, children, data) in enumerate(entries):
+        encoded_name = name.encode("utf-16-le") + b"\0\0"
+        if entry_type == 5:
+            first, size = (mini_stream_start if mini_stream else END_OF_CHAIN), len(mini_stream)
+        elif entry_type == 1:
+            first, size = 0, 0
+        else:
+            first, size = start[i], len(data)
+        child = children[0] if children else NO_STREAM
+        directory += struct.pack(
+            "<64sHBBIII16sIQQIQ", encoded_name, len(encoded_name), entry_type, 1, NO_STREAM, NO_STREAM, child,
+            b"\0" * 16, 0, 0, 0, first, size,
+        )  # fmt: skip
+    # Siblings are chained through their right pointers rather than balanced in a tree, which readers accept
+    for _, _, children, _ in entries:
+        for left, right in pairwise(children):
+            struct.pack_into("<I", directory, left * 128 + 72, right)
+
+    header = struct.pack(
+        "<8s16sHHHHH6sIIIIIIIII",
+        b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", b"\0" * 16, 0x3E, 3, 0xFFFE, 9, 6, b"\0" * 6, 0, fat_sectors,
+        directory_start, 0, MINI_STREAM_CUTOFF, mini_fat_start if mini_fat else END_OF_CHAIN, mini_fat_sectors,
+        END_OF_CHAIN, 0,
+    ) + struct.pack("<109I", *(list(range(fat_sectors)) + [FREE_SECTOR] * (109 - fat_sectors)))  # fmt: skip
+    body = struct.pack(f"<{len(fat)}I", *fat)
+    body += bytes(directory).ljust(directory_sectors * SECTOR_SIZE, b"\0")
+    body += struct.pack(f"<{len(mini_fat)}I", *mini_fat).ljust(mini_fat_sectors * SECTOR_SIZE, b"\xff")
+    body += mini_stream.ljust(sectors(len(mini_stream)) * SECTOR_SIZE, b"\0")
+    for i in large:
+        body += entries[i][3].ljust(sectors(len(entries[i][3])) * SECTOR_SIZE, b"\0")
+    with open(path, "wb") as fh:
+        fh.write(header + body)
+
+
+def _unicode(value: str) -> bytes:
+    """Encode a string property as Outlook does.
+
+    Args:
+        value (str): The value.
+
+    Returns:
+        bytes: The encoded value.
+
+    """
+    return value.encode("utf-16-le")
+
+
+def _properties(header_size: int, *properties: tuple[int, bytes]) -> bytes:
+    """Build the stream of fixed-length properties of a message, recipient or attachment.
+
+    Args:
+        header_size (int): The size of the header in front of the properties.
+        *properties (tuple[int, bytes]): The tag and value of each property.
+
+    Returns:
+        bytes: The content of the stream.
+
+    """
+    return b"\0" * header_size + b"".join(struct.pack("<II8s", tag, 6, value) for tag, value in properties)
+
+
+def _message(**streams: bytes | dict) -> dict:
+    """Build the storage of an unsent message to two recipients, with a plain text body and an attachment.
+
+    Args:
+        **streams (bytes | dict): Streams and storages to add or replace.
+
+    Returns:
+        dict: The streams and storages of the message.
+
+    """
+    # 2023-11-14 22:13:20 UTC as a FILETIME
+    submit_time = (1700000000 + 11644473600) * 10**7
+    message = {
+        "__substg1.0_001A001F": _unicode("IPM.Note"),
+        "__substg1.0_0037001F": _unicode("Invoice ready – click to view"),
+        "__substg1.0_1000001F": _unicode("Please find the invoice attached."),
+        "__substg1.0_0C1A001F": _unicode("Accounts"),
+        "__substg1.0_5D01001F": _unicode("accounts@example.com"),
+        "__properties_version1.0": _properties(32, (0x00390040, struct.pack("<Q", submit_time))),
+        "__recip_version1.0_#00000000": {
+            "__substg1.0_3001001F": _unicode("Bob"),
+            "__substg1.0_39FE001F": _unicode("bob@example.com"),
+            "__properties_version1.0": _properties(8, (0x0C150003, struct.pack("<i", 1).ljust(8, b"\0"))),
+        },
+        "__recip_version1.0_#00000001": {
+            "__substg1.0_3001001F": _unicode("Carol"),
+            "__substg1.0_3003001E": b"carol@example.com",
+            "__properties_version1.0": _properties(8, (0x0C150003, struct.pack("<i", 2).ljust(8, b"\0"))),
+        },
+        "__attach_version1.0_#00000000": {
+            "__substg1.0_37010102": b"PK\x03\x04" + b"\0" * 5000,
+            "__substg1.0_3707001F": _unicode("invoice.zip"),
+            "__properties_version1.0": _properties(8),
+        },
+    }
+    message.update(streams)
+    return message
+
+
+def test_unsent_message(tmp_path):
+    """A message without transport headers gets its headers from its properties."""
+    path = str(tmp_path / "message.msg")
+    _write_compound_file(path, _message())
+
+    msg = msg_to_email(path)
+
+    assert msg["From"] == "Accounts <accounts@example.com>"
+    assert msg["To"] == "Bob <bob@example.com>"
+    assert msg["Cc"] == "Carol <carol@example.com>"
+    assert msg["Subject"] == "Invoice ready – click to view"
+    assert parsedate_to_datetime(msg["Date"]).timestamp() == 1700000000
+    assert msg.get_body(("plain",)).get_content().strip() == "Please find the invoice attached."
+    attachments = list(msg.iter_attachments())
+    assert [(part.get_filename(), len(part.get_content())) for part in attachments] == [("invoice.zip", 5004)]
+
+
+def test_transport_headers(tmp_path):
+    """Headers the message was received with are used over the ones that can be made from its properties."""
+    path = str(tmp_path / "message.msg")
+    headers = (
+        "Received: from mx.example.com\r\n"
+        "From: Real Sender <real@example.org>\r\n"
+        "To: someone@example.net\r\n"
+        "Subject: Received subject\r\n"
+        "Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n"
+        "Content-Type: multipart/mixed; boundary=unused\r\n\r\n"
+    )
+    _write_compound_file(path, _message(**{"__substg1.0_007D001F": _unicode(headers)}))
+
+    msg = msg_to_email(path)
+
+    assert msg["From"] == "Real Sender <real@example.org>"
+    assert msg["To"] == "someone@example.net"
+    assert msg["Cc"] is None
+    assert msg["Subject"] == "Received subject"
+    assert "Received" not in msg
+    # The MIME structure is the one of the converted message, not the original
+    assert msg.get_content_type() == "multipart/mixed"
+    assert msg.get_boundary() != "unused"
+
+
+def test_html_body_with_inline_image(tmp_path):
+    """HTML bodies are decoded with the message's code page and images they reference are attached inline."""
+    path = str(tmp_path / "message.msg")
+    html = "<html><body><p>Héllo</p><img src='cid:logo@example'></body></html>"
+    _write_compound_file(
+        path,
+        _message(
+            **{
+                "__substg1.0_10130102": html.encode("utf-8"),
+                "__properties_version1.0": _properties(32, (0x3FDE0003, struct.pack("<i", 65001).ljust(8, b"\0"))),
+                "__attach_version1.0_#00000001": {
+                    "__substg1.0_37010102": b"\x89PNG\r\n\x1a\n" + b"\0" * 100,
+                    "__substg1.0_3707001F": _unicode("logo.png"),
+                    "__substg1.0_370E001F": _unicode("image/png"),
+                    "__substg1.0_3712001F": _unicode("logo@example"),
+                    "__properties_version1.0": _properties(8),
+                },
+            }
+        ),
+    )
+
+    msg = msg_to_email(path)
+
+    assert "<p>Héllo</p>" in msg.get_body(("html",)).get_content()
+    inline = [part for part in msg.walk() if part.get_content_disposition() == "inline"]
+    assert [(part.get_content_type(), part["Content-ID"]) for part in inline] == [("image/png", "<logo@example>")]
+
+
+@pytest.mark.parametrize(
+    ("streams", "removed"),
+    [
+        # Signed messages can't be put back together from their properties
+        ({"__substg1.0_001A001F": _unicode("IPM.Note.SMIME.MultipartSigned")}, []),
+        # Only an RTF body
+        ({"__substg1.0_10090102": b"{\\rtf1}"}, ["__substg1.0_1000001F"]),
+    ],
+)
+def test_left_to_msgconvert(tmp_path, streams, removed):
+    """Messages that can't be faithfully converted are refused, for msgconvert to convert instead."""
+    path = str(tmp_path / "message.msg")
+    message = _message(**streams)
+    for name in removed:
+        del message[name]
+    _write_compound_file(path, message)
+
+    with pytest.raises(MsgParseError):
+        msg_to_email(path)
+
+
+def test_not_a_message(tmp_path):
+    """Files that aren't compound files are refused."""
+    path = tmp_path / "message.msg"
+    path.write_bytes(b"Not an Outlook message")
+
+    with pytest.raises(MsgParseError):
+        msg_to_email(str(path))
+
+
+def _outlook_samples() -> list[str]:
+    """Find the Outlook messages among the samples that results are kept for.
+
+    Returns:
+        list[str]: The SHA256 of each Outlook message that could be found.
+
+    """
+    locations = [SAMPLES_FOLDER, os.environ.get("FULL_SAMPLES_LOCATION", "")]
+    samples = []
+    for sample in sorted(os.listdir(RESULTS_FOLDER)):
+        sha256 = sample.split("_", 1)[0]
+        for location in filter(os.path.isdir, locations):
+            carted = os.path.join(location, f"{sha256}.cart")
+            if os.path.exists(carted):
+                samples.append(carted)
+                break
+    return samples
+
+
+def _summary(msg) -> dict:
+    """Summarize what a preview of an email message shows.
+
+    Args:
+        msg (email.message.EmailMessage): The email message.
+
+    Returns:
+        dict: The addresses, subject, date, body text and attachment names.
+
+    """
+    body = msg.get_body(("plain", "html"))
+    date = msg["Date"]
+    return {
+        header: sorted(address.lower() for _, address in getaddresses(msg.get_all(header, [])) if address)
+        for header in ("From", "To", "Cc")
+    } | {
+        "Subject": str(msg["Subject"] or "").strip(),
+        "Date": parsedate_to_datetime(date).timestamp() if date else None,
+        "Body": " ".join(body.get_content().split()) if body else "",
+        "Attachments": sorted(part.get_filename() or "" for part in msg.iter_attachments()),
+    }
+
+
+@pytest.mark.skipif(not shutil.which("msgconvert"), reason="msgconvert isn't installed")
+def test_matches_msgconvert(tmp_path):
+    """Messages of the sample set are converted to what msgconvert would convert them to, as far as previews go."""
+    compared = 0
+    for carted in _outlook_samples():
+        path = str(tmp_path / os.path.basename(carted)[:-5])
+        unpack_file(carted, path)
+        if not olefile.isOleFile(path):
+            continue
+        with olefile.OleFileIO(path) as ole:
+            if not ole.exists("__properties_version1.0"):
+                continue
+        try:
+            converted = msg_to_email(path)
+        except MsgParseError:
+            # Left to msgconvert by the service
+            continue
+
+        subprocess.run(["msgconvert", "-outfile", f"{path}.eml", path], check=True, capture_output=True)
+        with open(f"{path}.eml", "rb") as fh:
+            expected = message_from_bytes(fh.read(), policy=policy.default)
+        assert _summary(converted) == _summary(expected), os.path.basename(path)
+        compared += 1
+
+    if not compared:
+        pytest.skip("No Outlook messages in the sample set")
@@ -0,0 +1,103 @@
+"""Tests for the OCR of embedded images."""
+
+import time
+
+import pytest
+from PIL import Image
+
+from document_preview import ocr
+from document_preview.deadline import Deadline
+from document_preview.images import ExtractedImage
+from document_preview.ocr import EmbeddedImageOCR
+
+
+@pytest.fixture
+def scheduler():
+    """Create an OCR scheduler with a single worker.
+
+    Yields:
+        EmbeddedImageOCR: The scheduler, stopped once the test is done.
+
+    """
+    scheduler = EmbeddedImageOCR(workers=1, min_pixels=100)
+    yield scheduler
+    scheduler.stop()
+
+
+@pytest.fixture
+def ocr_calls(monkeypatch):
+    """Replace the OCR of an image with one that finds its path, taking a little while to do so.
+
+    Returns:
+        list[str]: The paths of the images run through OCR.
+
+    """
+    calls = []
+
+    def fake_detections(path, deadline=None):
+        calls.append(path)
+        time.sleep(0.1)
+        return {"ransomware": [path]}
+
+    monkeypatch.setattr(ocr, "_ocr_detections", fake_detections)
+    return calls
+
+
+def test_skips_small_and_duplicate_images(scheduler, ocr_calls):
+    """Only the first copy of each image large enough to hold text is run through OCR."""
+    images = [
+        ExtractedImage("first.png", 20, 20, "a"),
+        ExtractedImage("icon.png", 9, 9, "b"),
+        ExtractedImage("copy.png", 20, 20, "a"),
+        ExtractedImage("second.png", 10, 10, "c"),
+    ]
+
+    assert scheduler.detections(images) == {"ransomware": ["first.png", "second.png"]}
+    assert ocr_calls == ["first.png", "second.png"]
+
+
+def test_stops_at_deadline(scheduler, ocr_calls):
+    """Images still waiting for a worker when the deadline is reached are skipped, and reported as such."""
+    images = [ExtractedImage(f"{index}.png", 20, 20, str(index)) for index in range(10)]
+    deadline = Deadline(budget=0.25)
+
+    detections = scheduler.detections(images, deadline)
+
+    assert 0 < len(ocr_calls) < len(images)
+    assert detections == {"ransomware": ocr_calls}
+    skipped = len(images) - len(ocr_calls)
+    assert deadline.skipped == {
+        "ocr.embedded_images": f"{skipped} of 10 image(s) not run through OCR before the time ran out"
+    }
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    """Write an image to run through OCR.
+
+    Returns:
+        str: The path to the image.
+
+    """
+    path = str(tmp_path / "image.png")
+    Image.new("L", (20, 20), 255).save(path)
+    return path
+
+
+def test_no_time_left(image_path, monkeypatch):
+    """An image isn't run through OCR once the deadline has been reached."""
+    monkeypatch.setattr(ocr.pytesseract, "image_to_string", pytest.fail)
+
+    assert ocr._ocr_detections(image_path, Deadline(budget=1, reserve=1)) is None
+
+
+def test_tesseract_timeout(image_path, monkeypatch):
+    """Tesseract timing out only counts as skipped when it was cut short by the deadline."""
+
+    def timeout(image, timeout):
+        raise RuntimeError("Tesseract process timeout")
+
+    monkeypatch.setattr(ocr.pytesseract, "image_to_string", timeout)
+
+    assert ocr._ocr_detections(image_path, Deadline(budget=5)) is None
+    assert ocr._ocr_detections(image_path) == {}
@@ -0,0 +1,140 @@
+"""Tests for scanning images for QR codes, including codes split into several images."""
+
+import hashlib
+import random
+import subprocess
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from document_preview import qr
+from document_preview.images import ExtractedImage
+from document_preview.qr import QRDecodeError, _zbarimg, _zbarimg_batch, iter_qr_candidates
+
+
+def _code(side: int) -> Image.Image:
+    """Generate a square image with enough detail that any misplaced piece shows up.
+
+    Args:
+        side (int): The width and height of the image.
+
+    Returns:
+        Image.Image: The image.
+
+    """
+    rng = random.Random(side)
+    image = Image.new("RGB", (side, side))
+    image.putdata([(rng.randrange(256),) * 3 for _ in range(side * side)])
+    return image
+
+
+def _split(image: Image.Image, columns: int, rows: int) -> list[Image.Image]:
+    """Slice an image into a grid, spreading any remainder over the pieces like a rounding slicer would.
+
+    Args:
+        image (Image.Image): The image to slice.
+        columns (int): The number of columns.
+        rows (int): The number of rows.
+
+    Returns:
+        list[Image.Image]: The pieces, left-to-right, top-to-bottom.
+
+    """
+    xs = [round(column * image.width / columns) for column in range(columns + 1)]
+    ys = [round(row * image.height / rows) for row in range(rows + 1)]
+    return [
+        image.crop((xs[column], ys[row], xs[column + 1], ys[row + 1]))
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def _extracted(pieces: list[Image.Image], directory: Path) -> list[ExtractedImage]:
+    """Write pieces to disk as they would be extracted from a document.
+
+    Args:
+        pieces (list[Image.Image]): The pieces, in the order they appear in the document.
+        directory (Path): The directory to write the pieces to.
+
+    Returns:
+        list[ExtractedImage]: The extracted images.
+
+    """
+    images = []
+    for index, piece in enumerate(pieces):
+        path = str(directory / f"piece-{index}.png")
+        piece.save(path)
+        images.append(ExtractedImage(path, piece.width, piece.height, hashlib.sha256(piece.tobytes()).hexdigest()))
+    return images
+
+
+@pytest.mark.parametrize(
+    ("side", "columns", "rows"),
+    [
+        (296, 3, 1),  # Strips of 99, 98 and 99 pixels
+        (296, 1, 3),
+        (297, 2, 2),  # Quarters of 148 and 149 pixels
+        (297, 2, 1),
+    ],
+)
+def test_reassembles_uneven_splits(tmp_path, side, columns, rows):
+    """Pieces a pixel apart in size are put back together into the original code."""
+    code = _code(side)
+    pieces = _split(code, columns, rows)
+    assert len({piece.size for piece in pieces}) > 1
+
+    candidates = list(iter_qr_candidates(_extracted(pieces, tmp_path)))
+
+    assert any(candidate.tobytes() == code.tobytes() for candidate in candidates)
+
+
+def test_skips_pieces_that_dont_make_a_square(tmp_path):
+    """Images of about the same size that can't be laid out as a square aren't combined."""
+    pieces = [Image.new("RGB", (100, 40), "white") for _ in range(3)]
+
+    assert list(iter_qr_candidates(_extracted(pieces, tmp_path))) == []
+
+
+def test_limits_combinations(tmp_path):
+    """No more than the maximum number of reassembled images are produced."""
+    pieces = _split(_code(200), 2, 1) * 5
+
+    assert len(list(iter_qr_candidates(_extracted(pieces, tmp_path), max_combinations=3))) == 3
+
+
+@pytest.fixture
+def zbarimg(monkeypatch):
+    """Replace zbarimg with one that exits with the status set for each image.
+
+    Returns:
+        dict[str, int]: The exit status of scanning each image, images not listed have no code.
+
+    """
+    statuses = {}
+
+    def run(args, **kwargs):
+        paths = [arg for arg in args if not arg.startswith("-")]
+        # Scanning stops at the first image that can't be read
+        status = next((statuses[path] for path in paths if statuses.get(path, 4) != 4), 4)
+        stdout = "" if status else "<barcodes/>"
+        return subprocess.CompletedProcess(args, status, stdout if kwargs.get("text") else stdout.encode(), "error")
+
+    monkeypatch.setattr(qr.subprocess, "run", run)
+    return statuses
+
+
+def test_nothing_found(zbarimg):
+    """Exiting with the status for no code found isn't an error."""
+    assert _zbarimg("blank.png") == ""
+    assert _zbarimg_batch(["blank.png", "other.png"]) == ["", ""]
+
+
+def test_decoder_failure(zbarimg):
+    """A failing decoder is an error rather than no code found, once narrowed down to the image it failed on."""
+    zbarimg["broken.png"] = 2
+
+    with pytest.raises(QRDecodeError, match="status 2: error"):
+        _zbarimg_batch(["blank.png", "broken.png"])
+    with pytest.raises(QRDecodeError):
+        _zbarimg("broken.png")
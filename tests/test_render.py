@@ -0,0 +1,189 @@
+"""Tests for picking the resolution pages are rendered at."""
+
+import fitz
+import pytest
+
+from document_preview.render import (
+    DocumentAnalysis,
+    RenderedPage,
+    analyze_pages,
+    needs_ocr,
+    page_zooms,
+    select_ocr_pages,
+    text_layer,
+)
+
+# Letter-sized page, in points
+WIDTH, HEIGHT = 612, 792
+
+
+@pytest.fixture
+def doc():
+    """Create a document of four letter-sized pages.
+
+    Returns:
+        fitz.Document: The document.
+
+    """
+    doc = fitz.open()
+    for _ in range(4):
+        doc.new_page(width=WIDTH, height=HEIGHT)
+    return doc
+
+
+def _pixels(zoom: float) -> float:
+    """Get the number of pixels a letter-sized page is rendered with at a zoom.
+
+    Args:
+        zoom (float): The zoom.
+
+    Returns:
+        float: The number of pixels.
+
+    """
+    return WIDTH * HEIGHT * zoom**2
+
+
+def test_no_budget(doc):
+    """Without budgets, every page is rendered at the requested resolution."""
+    assert page_zooms(doc, [0, 1, 2, 3], dpi=144) == [(0, 2), (1, 2), (2, 2), (3, 2)]
+
+
+def test_oversized_page(doc):
+    """Pages over the budget of a single page are downscaled to fit it."""
+    max_page_pixels = int(_pixels(2) / 4)
+
+    zooms = page_zooms(doc, [0, 1], dpi=144, max_page_pixels=max_page_pixels)
+
+    assert [page_num for page_num, _ in zooms] == [0, 1]
+    assert all(_pixels(zoom) == pytest.approx(max_page_pixels) for _, zoom in zooms)
+
+
+def test_total_budget(doc):
+    """Pages are downscaled to fit what's left of the total budget, until not even half resolution fits."""
+    full = _pixels(2)
+    # Two full pages, then a third of a page: the third page fits at a lower resolution, the fourth doesn't fit
+    zooms = page_zooms(doc, [0, 1, 2, 3], dpi=144, max_total_pixels=int(full * 2.34))
+
+    assert [page_num for page_num, _ in zooms] == [0, 1, 2]
+    assert zooms[:2] == [(0, 2), (1, 2)]
+    assert _pixels(zooms[2][1]) == pytest.approx(full * 0.34, rel=1e-3)
+
+
+def test_total_budget_too_small_for_half_resolution(doc):
+    """A page that can't be rendered at even half resolution isn't rendered, nor are the pages after it."""
+    full = _pixels(2)
+
+    assert page_zooms(doc, [0, 1, 2], dpi=144, max_total_pixels=int(full * 1.2)) == [(0, 2)]
+
+
+def test_detail_pages(doc):
+    """The detail pages are rendered at the detail resolution, whichever pages they are."""
+    zooms = dict(page_zooms(doc, [0, 1, 2, 3], dpi=72, detail_pages={2, 4}, detail_dpi=144))
+
+    assert zooms == {0: 1, 1: 2, 2: 1, 3: 2}
+
+
+def test_analysis_lists_unrendered_pages(tmp_path, doc):
+    """The pages left out by the pixel budget are listed, so the result can say which pages are missing."""
+    fp = str(tmp_path / "document.pdf")
+    doc.save(fp)
+
+    analysis = analyze_pages(fp, extract=False, dpi=144, max_total_pixels=int(_pixels(2) * 2))
+
+    assert [page.page_number for page in analysis.pages] == [1, 2]
+    assert analysis.unrendered == [3, 4]
+
+
+def test_release_grayscale(doc):
+    """The grayscale view of a page can be released on its own, and is converted again when needed again."""
+    page = RenderedPage("original", 1, doc[0].get_pixmap())
+    gray = page.grayscale().tobytes()
+
+    page.release_grayscale()
+
+    assert page._gray is None
+    assert page.pixmap is not None
+    assert (page.width, page.height) == (WIDTH, HEIGHT)
+    assert page.grayscale().tobytes() == gray
+    page.close()
+
+
+def test_text_layer(doc):
+    """The text of a page is measured against the area of the page, as is the area covered by images."""
+    page = doc[0]
+    image = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 10, 10))
+    page.insert_image(fitz.Rect(0, 0, WIDTH, HEIGHT / 2), pixmap=image)
+    page.insert_image(fitz.Rect(-100, HEIGHT / 2, WIDTH / 2, HEIGHT), pixmap=image)
+
+    chars, image_coverage, density = text_layer(page, "Some text\n" * 10)
+
+    assert chars == 80
+    # Only the part of the images that's on the page counts
+    assert image_coverage == pytest.approx(0.75)
+    assert density == pytest.approx(80 / (WIDTH * HEIGHT / 72**2))
+
+
+@pytest.mark.parametrize(
+    ("layout", "expected"),
+    [
+        ((0, 0.0, 0.0), True),  # Blank, or text drawn as vector paths
+        ((10, 1.0, 0.1), True),  # Scan with a page number
+        ((200, 0.9, 2.1), True),  # Lure in a page-sized image, with a disclaimer underneath
+        ((200, 0.1, 2.1), False),  # Short letter
+        ((3000, 0.9, 32.0), False),  # Text over a background image
+    ],
+)
+def test_needs_ocr(layout, expected):
+    """Pages are OCRed when they have little text, or sparse text over mostly images."""
+    assert needs_ocr(layout) is expected
+
+
+def _analysis(layouts: list[tuple[int, float, float]]) -> DocumentAnalysis:
+    """Create the analysis of a document whose pages have the given text layers.
+
+    Args:
+        layouts (list[tuple[int, float, float]]): How much of each page is text rather than images.
+
+    Returns:
+        DocumentAnalysis: The analysis.
+
+    """
+    analysis = DocumentAnalysis("original", "document.pdf")
+    analysis.page_numbers = list(range(1, len(layouts) + 1))
+    analysis.text = ["x" * chars for chars, _, _ in layouts]
+    analysis.layout = layouts
+    return analysis
+
+
+# Page keys in the order the previews were written out
+PAGE_KEYS = [("original", 10), ("original", 2), ("original", 1), ("original", 3)]
+
+
+def test_select_leading_pages_without_text():
+    """Without routing, the leading pages are OCRed when the document has no text."""
+    analysis = _analysis([(0, 1.0, 0.0)] * 10)
+
+    assert select_ocr_pages([analysis], PAGE_KEYS, 2) == {("original", 1), ("original", 2)}
+    assert select_ocr_pages([analysis], PAGE_KEYS, 2, deep_scan=True) == set(PAGE_KEYS)
+    # Images have no text layer at all
+    assert select_ocr_pages([], PAGE_KEYS, 1) == {("original", 1)}
+
+
+def test_select_no_pages_with_text():
+    """Without routing, no page is OCRed when the document has text."""
+    analysis = _analysis([(3000, 0.0, 32.0)] + [(0, 1.0, 0.0)] * 9)
+
+    assert select_ocr_pages([analysis], PAGE_KEYS, 10) == set()
+
+
+def test_select_routed_pages():
+    """With routing, each of the leading pages is OCRed if its own text layer isn't enough."""
+    routing = {"min_chars": 50, "min_image_coverage": 0.5, "min_density": 5}
+    analysis = _analysis([(3000, 0.0, 32.0), (0, 1.0, 0.0), (3000, 0.0, 32.0)] + [(0, 1.0, 0.0)] * 7)
+
+    assert select_ocr_pages([analysis], PAGE_KEYS, 3, routing=routing) == {("original", 2)}
+    assert select_ocr_pages([analysis], PAGE_KEYS, 3, deep_scan=True, routing=routing) == {
+        ("original", 2),
+        ("original", 10),
+    }
@@ -0,0 +1,60 @@
+"""Tests for finding pages that look the same."""
+
+import random
+
+from PIL import Image, ImageDraw
+
+from document_preview.similarity import PerceptualIndex, dhash
+
+
+def _page(seed: int) -> Image.Image:
+    """Draw a grayscale page of random blocks.
+
+    Args:
+        seed (int): Picks which blocks are drawn.
+
+    Returns:
+        Image.Image: The page.
+
+    """
+    rng = random.Random(seed)
+    image = Image.new("L", (340, 440), 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(300), rng.randrange(400)
+        draw.rectangle((x, y, x + rng.randrange(10, 40), y + rng.randrange(5, 40)), fill=rng.randrange(200))
+    return image
+
+
+def test_dhash_close_for_similar_pages():
+    """A page with a small change hashes close to the original, a different page doesn't."""
+    page = _page(1)
+    changed = page.copy()
+    ImageDraw.Draw(changed).rectangle((10, 10, 14, 14), fill=0)
+
+    assert dhash(page) == dhash(page.copy())
+    assert (dhash(page) ^ dhash(changed)).bit_count() <= 8
+    assert (dhash(page) ^ dhash(_page(2))).bit_count() > 64
+
+
+def test_finds_hashes_within_distance():
+    """A hash is found as long as it differs by no more than the maximum distance, wherever those bits are."""
+    index = PerceptualIndex(max_distance=4, hash_bits=64)
+    index.add(0, "page")
+
+    # The differing bits spread over every band but one, and all in one band
+    assert index.find(1 | 1 << 16 | 1 << 32 | 1 << 48) == "page"
+    assert index.find(0b1111) == "page"
+    assert index.find(0b11111) is None
+    assert index.find(1 << 63 | 1 << 40 | 1 << 20 | 1 << 10 | 1) is None
+
+
+def test_finds_closest_match():
+    """When several hashes are close enough, the item of the closest one is returned."""
+    index = PerceptualIndex(max_distance=4, hash_bits=64)
+    index.add(0b1111, "far")
+    index.add(0b0001, "near")
+    index.add(0b0111, "between")
+
+    assert index.find(0) == "near"
+    assert PerceptualIndex(max_distance=4, hash_bits=64).find(0) is None